@@ -0,0 +1,54 @@
+"""
+Script điền cột invoices.parsed_date cho dữ liệu cũ (chuẩn hóa từ cột date bằng parse_invoice_date)
+Chạy theo từng chunk id tăng dần, mỗi chunk 1 transaction: có thể dừng giữa chừng và chạy lại an toàn
+Cần chạy migrate_database.py trước để thêm cột parsed_date + index (DB tạo từ trước khi có cột này)
+Sử dụng: python backfill_invoice_dates.py [--batch-size 2000]
+"""
+import time
+import argparse
+from sqlalchemy import select, update, bindparam
+from server import SessionLocal, InvoiceDB, parse_invoice_date
+
+def backfill_chunk(db, last_id: int, batch_size: int) -> tuple:
+    """Xử lý 1 chunk, trả về (id cuối cùng đã xử lý, số dòng đọc được ngày); id cuối = None khi hết dữ liệu"""
+    rows = db.execute(
+        select(InvoiceDB.id, InvoiceDB.date)
+        .where(InvoiceDB.id > last_id, InvoiceDB.parsed_date.is_(None), InvoiceDB.date.isnot(None))
+        .order_by(InvoiceDB.id).limit(batch_size)
+    ).all()
+    if not rows:
+        return None, 0
+
+    values = [{"row_id": row.id, "value": parsed} for row in rows if (parsed := parse_invoice_date(row.date))]
+    if values:
+        table = InvoiceDB.__table__
+        db.execute(update(table).where(table.c.id == bindparam("row_id")).values(parsed_date=bindparam("value")), values)
+    db.commit()
+    return rows[-1].id, len(values)
+
+def main():
+    parser = argparse.ArgumentParser(description="Điền parsed_date cho hóa đơn cũ")
+    parser.add_argument("--batch-size", type=int, default=2000, help="Số invoice mỗi transaction")
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        print("🔄 Đang chuẩn hóa ngày hóa đơn...")
+        start, last_id, parsed = time.perf_counter(), 0, 0
+        while True:
+            last_id, count = backfill_chunk(db, last_id, args.batch_size)
+            if last_id is None:
+                break
+            parsed += count
+            print(f"  ✅ Đến invoice #{last_id}: đã điền {parsed} ngày ({time.perf_counter() - start:.1f}s)")
+
+        missing = db.query(InvoiceDB.id).filter(InvoiceDB.parsed_date.is_(None)).count()
+        print(f"✅ Hoàn tất: đã điền {parsed} ngày, {missing} hóa đơn không đọc được ngày (sẽ không khớp bộ lọc theo ngày)")
+    except Exception as e:
+        db.rollback()
+        print(f"❌ Lỗi backfill (chạy lại để tiếp tục): {e}")
+    finally:
+        db.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Script điền cột invoices.fingerprint cho dữ liệu cũ (invoice_fingerprint: nhà cung cấp + số hóa đơn + ngày + tổng tiền)
+Chạy theo từng chunk id tăng dần, mỗi chunk 1 transaction: có thể dừng giữa chừng và chạy lại an toàn
+Hóa đơn trùng với 1 hóa đơn id nhỏ hơn giữ fingerprint NULL (unique index) và được liệt kê để xử lý tay
+Cần chạy migrate_database.py trước để thêm cột fingerprint + unique index (DB tạo từ trước khi có cột này)
+Sử dụng: python backfill_invoice_fingerprints.py [--batch-size 2000]
+"""
+import time
+import argparse
+from sqlalchemy import select, update, bindparam
+from server import SessionLocal, InvoiceDB, invoice_fingerprint, find_duplicate_invoices
+
+def backfill_chunk(db, last_id: int, batch_size: int) -> tuple:
+    """Xử lý 1 chunk, trả về (id cuối cùng đã xử lý, số dòng đã điền, [(id trùng, id gốc)]); id cuối = None khi hết dữ liệu"""
+    rows = db.execute(
+        select(InvoiceDB.id, InvoiceDB.supplier_name, InvoiceDB.invoice_number, InvoiceDB.date,
+               InvoiceDB.parsed_date, InvoiceDB.total_amount)
+        .where(InvoiceDB.id > last_id, InvoiceDB.fingerprint.is_(None), InvoiceDB.invoice_number.isnot(None))
+        .order_by(InvoiceDB.id).limit(batch_size)
+    ).all()
+    if not rows:
+        return None, 0, []
+
+    fingerprints = {row.id: invoice_fingerprint(row.supplier_name, row.invoice_number, row.date, row.parsed_date, row.total_amount)
+                    for row in rows}
+    owners = find_duplicate_invoices(db, fingerprints.values())
+    values, duplicates = [], []
+    for invoice_id, fingerprint in fingerprints.items():
+        if not fingerprint:
+            continue
+        if fingerprint in owners:
+            duplicates.append((invoice_id, owners[fingerprint]))
+            continue
+        owners[fingerprint] = invoice_id
+        values.append({"row_id": invoice_id, "value": fingerprint})
+    if values:
+        table = InvoiceDB.__table__
+        db.execute(update(table).where(table.c.id == bindparam("row_id")).values(fingerprint=bindparam("value")), values)
+    db.commit()
+    return rows[-1].id, len(values), duplicates
+
+def main():
+    parser = argparse.ArgumentParser(description="Điền fingerprint chống trùng cho hóa đơn cũ")
+    parser.add_argument("--batch-size", type=int, default=2000, help="Số invoice mỗi transaction")
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        print("🔄 Đang tính fingerprint hóa đơn...")
+        start, last_id, filled, duplicates = time.perf_counter(), 0, 0, []
+        while True:
+            last_id, count, found = backfill_chunk(db, last_id, args.batch_size)
+            if last_id is None:
+                break
+            filled += count
+            duplicates.extend(found)
+            print(f"  ✅ Đến invoice #{last_id}: đã điền {filled} fingerprint ({time.perf_counter() - start:.1f}s)")
+
+        print(f"✅ Hoàn tất: đã điền {filled} fingerprint, {len(duplicates)} hóa đơn trùng")
+        for invoice_id, original_id in duplicates[:50]:
+            print(f"  ⚠️  Invoice #{invoice_id} trùng với #{original_id}")
+        if len(duplicates) > 50:
+            print(f"  ... và {len(duplicates) - 50} hóa đơn khác")
+    except Exception as e:
+        db.rollback()
+        print(f"❌ Lỗi backfill (chạy lại để tiếp tục): {e}")
+    finally:
+        db.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+"""
+Benchmark + load test các endpoint chính trên DB seed sẵn, so sánh với baseline đã lưu
+- Seed DB local (mặc định SQLite tạm, hoặc --database-url tới 1 MySQL container dùng riêng cho benchmark)
+- Gọi app trong cùng process qua httpx.ASGITransport (chạy cả lifespan), OCR dùng backend stub;
+  response cache tắt để mọi request đều đi tới DB (đo đường đọc thật, không phải cache hit)
+- Mỗi kịch bản: throughput, p50/p95/p99 và số query SQL trung bình mỗi request
+- --save-baseline ghi kết quả ra file; các lần sau so sánh với file đó, vượt ngưỡng thì exit code 1
+Sử dụng: python benchmark_endpoints.py [--invoices 20000] [--concurrency 16] [--requests 400]
+         [--scenarios invoices,statistics] [--baseline benchmark_baseline.json] [--save-baseline]
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import datetime
+import tempfile
+from benchmark_parser import PRODUCTS, generate_document
+
+MERCHANTS = ["Siêu thị Minh Anh", "Bách Hóa Xanh", "Co.opmart Đà Nẵng", "Nhà sách Phương Nam", "Điện máy Xanh"]
+SEED_CHUNK = 1000
+
+
+def random_items(rng: random.Random, categories: int) -> list:
+    return [{"name": rng.choice(PRODUCTS), "price": rng.randint(1, 500) * 1000,
+             "category_id": rng.choice([None, rng.randint(1, categories)])} for _ in range(rng.randint(1, 8))]
+
+
+# Mỗi kịch bản: (tên, hàm sinh request (method, path, kwargs của httpx) từ rng + cấu hình seed)
+SCENARIOS = [
+    ("GET /invoices", lambda rng, cfg: ("GET", "/invoices", {"params": {"limit": 20, "cursor": rng.randint(21, cfg["invoices"] + 1)}})),
+    ("GET /invoices?date_from&date_to", lambda rng, cfg: ("GET", "/invoices", {"params": {
+        "limit": 20, "date_from": f"2024-{rng.randint(1, 12):02d}-01", "date_to": f"2024-{rng.randint(1, 12):02d}-28"}})),
+    ("GET /products/by-category", lambda rng, cfg: ("GET", "/products/by-category", {"params": {"items_limit": 20}})),
+    ("GET /products/by-category/{id}", lambda rng, cfg: ("GET", f"/products/by-category/{rng.randint(1, cfg['categories'])}", {"params": {"items_limit": 50}})),
+    ("GET /statistics/by-category", lambda rng, cfg: ("GET", "/statistics/by-category", {})),
+    ("POST /invoices", lambda rng, cfg: ("POST", "/invoices", {"json": {
+        "merchant_name": rng.choice(MERCHANTS), "date": "15/06/2024", "total_amount": 100000,
+        "items": random_items(rng, cfg["categories"]), "raw_text": generate_document(rng)}})),
+    ("POST /ocr-invoices", lambda rng, cfg: ("POST", "/ocr-invoices", {"json": {
+        "invoiceNumber": f"HD{rng.randint(1, 10**9)}", "supplierName": rng.choice(MERCHANTS), "date": "15/06/2024",
+        "totalAmount": 100000, "productCategory": {"id": rng.randint(1, cfg["categories"])},
+        "lineItems": [{"productName": rng.choice(PRODUCTS), "quantity": 2, "unitPrice": 5000}]}})),
+    ("POST /invoices/bulk (50)", lambda rng, cfg: ("POST", "/invoices/bulk", {"json": [
+        {"merchant_name": rng.choice(MERCHANTS), "date": "15/06/2024", "total_amount": 100000,
+         "items": random_items(rng, cfg["categories"])} for _ in range(50)]})),
+    # Bytes ngẫu nhiên để không trúng cache OCR: đo cả đường OCR stub + parse
+    ("POST /analyze-invoice (stub OCR)", lambda rng, cfg: ("POST", "/analyze-invoice", {
+        "files": {"file": ("invoice.png", rng.randbytes(2048), "image/png")}})),
+]
+
+
+def seed(server, cfg: dict, rng: random.Random):
+    """Seed danh mục, hóa đơn, item, raw_text nén + bảng thống kê bằng insert theo lô"""
+    from sqlalchemy import insert
+    server.init_schema()
+    invoice_table, item_table, raw_table = server.InvoiceDB.__table__, server.InvoiceItemDB.__table__, server.InvoiceRawTextDB.__table__
+    with server.SessionLocal() as db:
+        existing = db.query(server.ProductCategoryDB).count()
+        if cfg["categories"] > existing:
+            db.execute(insert(server.ProductCategoryDB.__table__), [
+                {"name": f"Danh mục {n}", "description": "Sinh bởi benchmark"} for n in range(existing + 1, cfg["categories"] + 1)])
+        for start in range(1, cfg["invoices"] + 1, SEED_CHUNK):
+            ids = range(start, min(start + SEED_CHUNK, cfg["invoices"] + 1))
+            invoices = []
+            for i in ids:
+                day = datetime.date(2024, 1, 1) + datetime.timedelta(days=rng.randrange(366))
+                invoices.append({"id": i, "invoice_number": f"HD{i:07d}", "merchant_name": rng.choice(MERCHANTS),
+                                 "date": day.strftime("%d/%m/%Y"), "parsed_date": day, "total_amount": rng.randint(1, 5000) * 1000})
+            db.execute(insert(invoice_table), invoices)
+            db.execute(insert(item_table), [
+                {"invoice_id": i, "name": rng.choice(PRODUCTS), "price": rng.randint(1, 500) * 1000,
+                 "category_id": rng.choice([None, rng.randint(1, cfg["categories"])])}
+                for i in ids for _ in range(cfg["items_per_invoice"])])
+            db.execute(insert(raw_table), [{**server.raw_text_values(generate_document(rng)), "invoice_id": i} for i in ids])
+            db.commit()
+        server.category_registry.invalidate()
+        server.rebuild_category_stats(db)
+
+
+async def run_scenario(client, build, cfg: dict, concurrency: int, requests: int, rng: random.Random, counter: list) -> dict:
+    pending = [build(rng, cfg) for _ in range(requests)]
+    latencies, errors = [], []
+
+    async def worker():
+        while pending:
+            method, path, kwargs = pending.pop()
+            start = time.perf_counter()
+            response = await client.request(method, path, **kwargs)
+            await response.aread()
+            if response.status_code >= 400:
+                errors.append(response.status_code)
+            else:
+                latencies.append((time.perf_counter() - start) * 1000)
+
+    counter[0] = 0
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    pick = lambda q: round(latencies[min(int(len(latencies) * q), len(latencies) - 1)], 2) if latencies else 0.0
+    return {"rps": round(len(latencies) / elapsed, 1), "p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99),
+            "queries": round(counter[0] / requests, 2), "errors": len(errors)}
+
+
+def compare(results: dict, baseline: dict, max_regression: float) -> list:
+    """Trả về danh sách vi phạm: latency p95 / throughput tệ hơn quá ngưỡng, hoặc số query mỗi request tăng"""
+    failures = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        if result["errors"]:
+            failures.append(f"{name}: {result['errors']} request lỗi")
+        if result["p95"] > base["p95"] * (1 + max_regression):
+            failures.append(f"{name}: p95 {result['p95']:.1f}ms > baseline {base['p95']:.1f}ms (+{max_regression:.0%})")
+        if result["rps"] < base["rps"] * (1 - max_regression):
+            failures.append(f"{name}: {result['rps']:.0f} req/s < baseline {base['rps']:.0f} req/s (-{max_regression:.0%})")
+        if result["queries"] > base["queries"] + 0.05:  # Số query là tất định: tăng là dấu hiệu N+1
+            failures.append(f"{name}: {result['queries']} query/request > baseline {base['queries']}")
+    return failures
+
+
+async def run(server, cfg: dict, args, rng: random.Random) -> dict:
+    import httpx
+    from sqlalchemy import event
+
+    counter = [0]
+    for engine in (server.engine, server.async_engine.sync_engine):
+        event.listen(engine, "before_cursor_execute", lambda *a: counter.__setitem__(0, counter[0] + 1))
+
+    selected = [s for s in SCENARIOS if not args.scenarios or any(f in s[0] for f in args.scenarios.split(","))]
+    results = {}
+    transport = httpx.ASGITransport(app=server.app)
+    async with server.lifespan(server.app), httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=120) as client:
+        await server.warm_up()
+        print(f"  {'kịch bản':<34} {'req/s':>8} {'p50':>9} {'p95':>9} {'p99':>9} {'query/req':>10}  lỗi")
+        for name, build in selected:
+            await run_scenario(client, build, cfg, args.concurrency, args.warmup, rng, counter)  # Warm-up: cache, pool
+            result = await run_scenario(client, build, cfg, args.concurrency, args.requests, rng, counter)
+            results[name] = result
+            print(f"  {name:<34} {result['rps']:>8,.0f} {result['p50']:>7.1f}ms {result['p95']:>7.1f}ms "
+                  f"{result['p99']:>7.1f}ms {result['queries']:>10}  {result['errors']}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark endpoint + so sánh baseline")
+    parser.add_argument("--database-url", default="", help="DB dùng riêng cho benchmark (sẽ bị ghi dữ liệu); để trống = SQLite tạm")
+    parser.add_argument("--invoices", type=int, default=20000)
+    parser.add_argument("--items-per-invoice", type=int, default=5)
+    parser.add_argument("--categories", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=400, help="Số request đo cho mỗi kịch bản")
+    parser.add_argument("--warmup", type=int, default=20, help="Số request chạy trước (không tính) cho mỗi kịch bản")
+    parser.add_argument("--scenarios", default="", help="Lọc kịch bản theo chuỗi con, phân cách bằng dấu phẩy")
+    parser.add_argument("--baseline", default="benchmark_baseline.json")
+    parser.add_argument("--save-baseline", action="store_true", help="Ghi kết quả lần này làm baseline")
+    parser.add_argument("--max-regression", type=float, default=0.25, help="Ngưỡng tệ hơn cho phép so với baseline (0.25 = 25%%)")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Cấu hình phải có trước khi import server (engine, backend OCR tạo lúc import)
+        os.environ["DATABASE_URL"] = args.database_url or f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+        os.environ.pop("ASYNC_DATABASE_URL", None)
+        os.environ.update({"OCR_BACKEND": "stub", "OCR_HEDGE_BACKEND": "", "OCR_CACHE_DIR": "", "SEARCH_INDEX_ENABLED": "false",
+                           "RESPONSE_CACHE_ENABLED": "false"})
+        os.environ.setdefault("OCR_STUB_FIXTURES_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "ocr_fixtures"))
+        import server
+        logging.getLogger("server").setLevel(logging.WARNING)  # Bớt log mỗi request khi chạy tải
+
+        cfg = {"invoices": args.invoices, "items_per_invoice": args.items_per_invoice, "categories": max(args.categories, 20),
+               "concurrency": args.concurrency, "requests": args.requests, "database": server.engine.dialect.name}
+        rng = random.Random(args.seed)
+        print(f"📊 Seed {cfg['invoices']:,} hóa đơn x {cfg['items_per_invoice']} item, {cfg['categories']} danh mục ({cfg['database']})...")
+        start = time.perf_counter()
+        seed(server, cfg, rng)
+        print(f"  seed: {time.perf_counter() - start:.1f}s; concurrency {args.concurrency}, {args.requests} request/kịch bản")
+        results = asyncio.run(run(server, cfg, args, rng))
+        server.engine.dispose()
+
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({"config": cfg, "results": results}, f, ensure_ascii=False, indent=2)
+        print(f"💾 Đã lưu baseline vào {args.baseline}")
+        return
+    if not os.path.isfile(args.baseline):
+        print(f"ℹ️  Chưa có baseline ({args.baseline}), chạy lại với --save-baseline để lưu")
+        return
+
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    if baseline["config"] != cfg:
+        print(f"⚠️  Cấu hình khác baseline, kết quả so sánh chỉ mang tính tham khảo: {baseline['config']}")
+    failures = compare(results, baseline["results"], args.max_regression)
+    if failures:
+        print("❌ Chậm hơn baseline:")
+        for failure in failures:
+            print(f"  - {failure}")
+        sys.exit(1)
+    print(f"✅ Không có kịch bản nào tệ hơn baseline quá {args.max_regression:.0%}")
+
+
+if __name__ == "__main__":
+    main()
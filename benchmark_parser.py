@@ -0,0 +1,103 @@
+"""
+Benchmark InvoiceParserService: đo số hóa đơn parse được mỗi giây
+So với baseline_parse (parser cũ) trên cùng corpus; độ đúng của parser kiểm tra trong tests/test_invoice_parser.py
+Sử dụng: python benchmark_parser.py [--docs 20000] [--processes 4] [--corpus thư_mục_chứa_file_txt]
+"""
+import os
+import re
+import glob
+import time
+import random
+import argparse
+from invoice_parser import InvoiceParserService
+
+PRODUCTS = ["Sữa tươi Vinamilk", "Bánh mì sandwich", "Nước suối Lavie", "Giấy A4 Double A", "Bút bi Thiên Long",
+            "Cà phê G7", "Mì Hảo Hảo", "Dầu ăn Neptune", "Xi măng Hà Tiên", "Máy in HP LaserJet"]
+
+def generate_document(rng: random.Random) -> str:
+    """Sinh 1 hóa đơn giả giống output OCR (dòng kết thúc bằng \\r\\n hoặc \\n)"""
+    lines = ["SIÊU THỊ MINH ANH", "12 Nguyễn Trãi, Q.1, TP.HCM", "ĐT: 0283 822 1234",
+             f"Ngày: {rng.randint(1, 28):02d}/{rng.randint(1, 12):02d}/2024", f"Số HĐ: HD{rng.randint(1, 99999):05d}"]
+    total = 0
+    for _ in range(rng.randint(3, 25)):
+        qty, unit = rng.randint(1, 10), rng.randint(1, 500) * 1000
+        total += qty * unit
+        if qty == 1 and rng.random() < 0.5:
+            lines.append(f"{rng.choice(PRODUCTS)} {unit:,}".replace(",", "."))  # Chỉ có giá, không có số lượng
+        else:
+            lines.append(f"{rng.choice(PRODUCTS)} {qty} x {unit:,} {qty * unit:,}".replace(",", "."))
+    lines += [f"Tổng cộng: {total:,}đ".replace(",", "."), "Cảm ơn quý khách!"]
+    return rng.choice(["\r\n", "\n"]).join(lines)
+
+def baseline_parse(raw_text: str) -> dict:
+    """Parser cũ trong server.py (trước khi tách ra invoice_parser), giữ nguyên để so tốc độ trên cùng corpus"""
+    default_res = {"merchant_name": "Unknown", "date": "", "items": [], "total_amount": 0, "raw_text": raw_text}
+    if not raw_text: return default_res
+    lines = [line.strip() for line in raw_text.split('\r\n') if line.strip()]
+    if not lines: return default_res
+    default_res["merchant_name"] = lines[0]
+    date_match = re.search(r'\b\d{1,2}[/-]\d{1,2}[/-]\d{4}\b', raw_text)
+    if date_match: default_res["date"] = date_match.group(0)
+    items = []
+    total_amount = 0
+    for line in lines:
+        match = re.search(r'(.+?)[\s\.:]+([\d,.]+)$', line)
+        if match:
+            name = match.group(1).strip()
+            price = int(re.sub(r'[^\d]', '', match.group(2)) or 0)
+            if price > 0 and len(name) > 2:
+                items.append({"name": name, "price": price})
+                total_amount += price
+    default_res["items"] = items
+    default_res["total_amount"] = total_amount
+    return default_res
+
+def load_corpus(corpus_dir: str, docs: int) -> list:
+    texts = []
+    for path in sorted(glob.glob(os.path.join(corpus_dir, "*.txt"))):
+        with open(path, encoding="utf-8", newline="") as f:
+            texts.append(f.read())
+    if not texts:
+        raise SystemExit(f"❌ Không có file .txt nào trong {corpus_dir}")
+    # Lặp lại corpus cho đủ số lượng cần đo
+    return [texts[i % len(texts)] for i in range(max(docs, len(texts)))]
+
+def run(label: str, parse_all, texts: list, repeat: int) -> float:
+    """Lấy lần chạy nhanh nhất trong repeat lần; trả về docs/s"""
+    elapsed, results = float("inf"), []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        results = parse_all(texts)
+        elapsed = min(elapsed, time.perf_counter() - start)
+    items = sum(len(r["items"]) for r in results)
+    rate = len(texts) / elapsed
+    print(f"  {label:<22} {rate:>12,.0f} docs/s   ({elapsed:.3f}s, {items:,} items)")
+    return rate
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark parser hóa đơn")
+    parser.add_argument("--docs", type=int, default=20000, help="Số hóa đơn cần parse")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1, help="Số process cho parse_many")
+    parser.add_argument("--corpus", default="", help="Thư mục chứa text OCR thật (*.txt)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--repeat", type=int, default=3, help="Số lần đo mỗi parser, lấy lần nhanh nhất")
+    args = parser.parse_args()
+
+    if args.corpus:
+        texts = load_corpus(args.corpus, args.docs)
+    else:
+        rng = random.Random(args.seed)
+        texts = [generate_document(rng) for _ in range(args.docs)]
+
+    # baseline chỉ tách dòng theo \r\n (định dạng OCR.space trả về): đưa corpus về \r\n để 2 parser so cùng số dòng
+    texts = [t.replace("\r\n", "\n").replace("\r", "\n").replace("\n", "\r\n") for t in texts]
+    print(f"📊 Benchmark parser: {len(texts):,} hóa đơn")
+    baseline = run("baseline (parser cũ)", lambda batch: [baseline_parse(t) for t in batch], texts, args.repeat)
+    current = run("parse (tuần tự)", lambda batch: [InvoiceParserService.parse(t) for t in batch], texts, args.repeat)
+    print(f"  {'-> so với baseline':<22} {current / baseline:>11.2f}x")
+    if args.processes > 1:
+        run(f"parse_many ({args.processes} proc)",
+            lambda batch: InvoiceParserService.parse_many(batch, processes=args.processes), texts, args.repeat)
+
+if __name__ == "__main__":
+    main()
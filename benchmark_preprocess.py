@@ -0,0 +1,76 @@
+"""
+Benchmark tiền xử lý ảnh trước OCR (image_preprocess.preprocess_image) trên ảnh giả lập chụp bằng điện thoại
+- Kích thước trước / sau, thời gian xử lý p50 mỗi ảnh và throughput với thread pool
+- Thời gian upload ước tính tới OCR backend ở băng thông --uplink-mbps: phần latency tiết kiệm được
+Cần Pillow (pip install pillow)
+Sử dụng: python benchmark_preprocess.py [--images 8] [--workers 4] [--uplink-mbps 10]
+"""
+import io
+import time
+import random
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from image_preprocess import Image, preprocess_image
+
+# (tên, kích thước, định dạng) của ảnh thử
+SAMPLES = [
+    ("điện thoại 12MP JPEG", (4000, 3000), "JPEG"),
+    ("điện thoại 48MP JPEG", (8000, 6000), "JPEG"),
+    ("scan A4 300dpi PNG", (2480, 3508), "PNG"),
+    ("ảnh nhỏ 1MP JPEG", (1280, 960), "JPEG"),
+]
+
+
+def synthetic_photo(size: tuple, fmt: str, rng: random.Random) -> bytes:
+    """Nền giấy + nhiều dòng chữ + nhiễu như ảnh chụp thật (nhiễu làm file nén kém giống ảnh điện thoại)"""
+    from PIL import ImageDraw
+    width, height = size
+    image = Image.new("RGB", size, (238, 232, 218))
+    draw = ImageDraw.Draw(image)
+    for y in range(40, height - 40, max(height // 80, 12)):
+        draw.text((40, y), "HÓA ĐƠN GTGT 0001234  Sữa tươi 2 x 32.000 = 64.000 " * 4, fill=(30, 30, 30))
+    noise = Image.effect_noise(size, 24).convert("RGB")
+    image = Image.blend(image, noise, 0.15)
+    output = io.BytesIO()
+    image.save(output, fmt, **({"quality": 92} if fmt == "JPEG" else {}))
+    return output.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark tiền xử lý ảnh trước OCR")
+    parser.add_argument("--images", type=int, default=8, help="Số ảnh xử lý cho mỗi loại")
+    parser.add_argument("--workers", type=int, default=4, help="Số thread xử lý song song")
+    parser.add_argument("--max-side", type=int, default=2000)
+    parser.add_argument("--quality", type=int, default=85)
+    parser.add_argument("--uplink-mbps", type=float, default=10, help="Băng thông upload tới OCR backend để ước tính thời gian gửi")
+    args = parser.parse_args()
+    if Image is None:
+        print("❌ Cần cài Pillow: pip install pillow")
+        return
+
+    rng = random.Random(42)
+    upload_ms = lambda size: size * 8 / (args.uplink_mbps * 1e6) * 1000
+    print(f"📊 Tiền xử lý ảnh (cạnh dài {args.max_side}px, JPEG q{args.quality}, {args.workers} thread, uplink {args.uplink_mbps:g} Mbps)")
+    print(f"  {'loại ảnh':<24} {'trước':>9} {'sau':>9} {'xử lý p50':>10} {'ảnh/s':>7} {'upload trước':>13} {'upload sau':>11}")
+    for label, size, fmt in SAMPLES:
+        content = synthetic_photo(size, fmt, rng)
+        timings = []
+
+        def run(_):
+            start = time.perf_counter()
+            prepared = preprocess_image(content, "invoice", args.max_side, True, args.quality)
+            timings.append((time.perf_counter() - start) * 1000)
+            return prepared
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            results = list(executor.map(run, range(args.images)))
+        throughput = args.images / (time.perf_counter() - start)
+        after = len(results[0].content)
+        p50 = sorted(timings)[len(timings) // 2]
+        print(f"  {label:<24} {len(content) / 1024:>7.0f}KB {after / 1024:>7.0f}KB {p50:>8.0f}ms {throughput:>7.1f} "
+              f"{upload_ms(len(content)):>11.0f}ms {upload_ms(after):>9.0f}ms")
+
+
+if __name__ == "__main__":
+    main()
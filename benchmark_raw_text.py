@@ -0,0 +1,106 @@
+"""
+Benchmark lưu raw_text: kích thước dòng và độ trễ GET /invoices trước / sau khi chuyển raw_text sang bảng nén
+Chạy trên 1 DB SQLite tạm (không đụng tới DB thật): seed hóa đơn với raw_text inline (như cũ),
+đo, chạy migrate_raw_text rồi đo lại
+Sử dụng: python benchmark_raw_text.py [--invoices 20000] [--requests 200] [--limit 50]
+"""
+import os
+import time
+import random
+import argparse
+import tempfile
+from sqlalchemy import create_engine, insert, func, select, LargeBinary
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from fastapi.testclient import TestClient
+from benchmark_parser import PRODUCTS, generate_document
+from server import app, get_db, Base, InvoiceDB, InvoiceItemDB, InvoiceRawTextDB
+from migrate_raw_text import migrate_chunk
+
+OLD_DEFAULT_FIELDS = "id,merchant_name,date,total_amount,items,raw_text"  # Mặc định của /invoices trước khi tách raw_text
+
+
+def seed(session_factory, invoices: int, rng: random.Random):
+    invoice_table, item_table = InvoiceDB.__table__, InvoiceItemDB.__table__
+    with session_factory() as db:
+        for start in range(1, invoices + 1, 1000):
+            ids = range(start, min(start + 1000, invoices + 1))
+            db.execute(insert(invoice_table), [
+                {"id": i, "merchant_name": "Siêu thị Minh Anh", "date": "01/03/2024", "total_amount": 100000,
+                 "raw_text": generate_document(rng)} for i in ids])
+            db.execute(insert(item_table), [
+                {"invoice_id": i, "name": rng.choice(PRODUCTS), "price": 20000} for i in ids for _ in range(rng.randint(1, 5))])
+        db.commit()
+
+
+def row_sizes(session_factory) -> tuple:
+    """(byte trung bình của raw_text trong bảng invoices, byte trung bình trong invoice_raw_texts)"""
+    with session_factory() as db:
+        inline = db.execute(select(func.avg(func.length(func.cast(InvoiceDB.legacy_raw_text, LargeBinary))))).scalar()
+        side = db.execute(select(func.avg(func.length(InvoiceRawTextDB.content)))).scalar()
+    return inline or 0, side or 0
+
+
+def measure(client: TestClient, label: str, params: dict, invoices: int, requests: int, rng: random.Random):
+    latencies = []
+    for _ in range(requests):
+        cursor = rng.randint(params["limit"] + 1, invoices + 1)
+        start = time.perf_counter()
+        response = client.get("/invoices", params={**params, "cursor": cursor})
+        latencies.append((time.perf_counter() - start) * 1000)
+        response.raise_for_status()
+    latencies.sort()
+    size = len(response.content)
+    print(f"  {label:<36} p50 {latencies[len(latencies) // 2]:6.1f}ms  p95 {latencies[int(len(latencies) * 0.95)]:6.1f}ms  "
+          f"({size / 1024:,.0f} KB/response)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark lưu trữ raw_text")
+    parser.add_argument("--invoices", type=int, default=20000)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--limit", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.db')
+        engine = create_engine(f"sqlite:///{path}")
+        Base.metadata.create_all(bind=engine)
+        session_factory = sessionmaker(bind=engine, autoflush=False)
+        async_engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+        async_session_factory = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+        async def bench_db():
+            async with async_session_factory() as db:
+                yield db
+
+        app.dependency_overrides[get_db] = bench_db
+        try:
+            print(f"📊 Seed {args.invoices:,} hóa đơn (raw_text inline)...")
+            seed(session_factory, args.invoices, rng)
+            client = TestClient(app)
+
+            inline, _ = row_sizes(session_factory)
+            print(f"  raw_text inline: {inline:,.0f} byte/dòng trong bảng invoices")
+            print("⏱  Trước khi migrate:")
+            measure(client, "GET /invoices (mặc định cũ, raw_text)", {"limit": args.limit, "fields": OLD_DEFAULT_FIELDS}, args.invoices, args.requests, rng)
+
+            with session_factory() as db:
+                last_id = 0
+                while last_id is not None:
+                    last_id, _ = migrate_chunk(db, last_id, 1000)
+
+            _, side = row_sizes(session_factory)
+            print(f"  raw_text nén: {side:,.0f} byte/dòng trong invoice_raw_texts ({side / inline:.0%}), bảng invoices không còn raw_text")
+            print("⏱  Sau khi migrate:")
+            measure(client, "GET /invoices (mặc định mới)", {"limit": args.limit}, args.invoices, args.requests, rng)
+            measure(client, "GET /invoices (fields=...,raw_text)", {"limit": args.limit, "fields": OLD_DEFAULT_FIELDS}, args.invoices, args.requests, rng)
+        finally:
+            app.dependency_overrides.pop(get_db, None)
+            engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
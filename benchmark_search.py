@@ -0,0 +1,54 @@
+"""
+Benchmark InvoiceSearchIndex: dựng index từ dữ liệu giả rồi đo độ trễ tìm kiếm (p50/p95/p99)
+Sử dụng: python benchmark_search.py [--items 1000000] [--queries 2000]
+"""
+import time
+import random
+import argparse
+from benchmark_parser import PRODUCTS, generate_document
+from search_index import InvoiceSearchIndex, WEIGHT_MERCHANT, WEIGHT_ITEM, WEIGHT_RAW_TEXT
+
+MERCHANTS = ["Siêu thị Minh Anh", "Bách Hóa Xanh", "Co.opmart Đà Nẵng", "Nhà sách Phương Nam", "Điện máy Xanh",
+             "Công ty TNHH Thiên Long", "Cửa hàng Vật liệu Hà Tiên", "Circle K", "WinMart", "Tạp hóa Cô Ba"]
+QUERIES = ["banh mi", "sua tuoi", "vinamilk", "Xi măng", "phuong nam", "giay a4", "co.opmart da nang", "thien long but",
+           "may in hp", "mi hao hao", "ca phe g7", "hd00123", "tong cong", "dau an neptune", "circle", "không có gì"]
+
+
+def percentile(samples: list, q: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * q), len(ordered) - 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark tìm kiếm hóa đơn")
+    parser.add_argument("--items", type=int, default=1_000_000, help="Tổng số invoice item trong corpus")
+    parser.add_argument("--items-per-invoice", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    index = InvoiceSearchIndex()
+    invoices = max(args.items // args.items_per_invoice, 1)
+    print(f"📊 Dựng index: {invoices:,} hóa đơn, {invoices * args.items_per_invoice:,} item")
+    start = time.perf_counter()
+    for invoice_id in range(1, invoices + 1):
+        fields = [(rng.choice(MERCHANTS), WEIGHT_MERCHANT), (generate_document(rng), WEIGHT_RAW_TEXT)]
+        fields.extend((rng.choice(PRODUCTS), WEIGHT_ITEM) for _ in range(args.items_per_invoice))
+        index.add(invoice_id, fields)
+    print(f"  build: {time.perf_counter() - start:.1f}s, {len(index.postings):,} token")
+
+    latencies, hits = [], 0
+    for _ in range(args.queries):
+        query = rng.choice(QUERIES)
+        start = time.perf_counter()
+        total, results = index.search(query, limit=args.limit, offset=rng.choice([0, 0, 0, args.limit]))
+        latencies.append((time.perf_counter() - start) * 1000)
+        hits += total
+    print(f"  {args.queries:,} query: p50 {percentile(latencies, 0.50):.1f}ms  p95 {percentile(latencies, 0.95):.1f}ms  "
+          f"p99 {percentile(latencies, 0.99):.1f}ms  (trung bình {hits / args.queries:,.0f} kết quả/query)")
+
+
+if __name__ == "__main__":
+    main()
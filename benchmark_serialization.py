@@ -0,0 +1,95 @@
+"""
+Benchmark serialize + nén cho các response JSON lớn
+- Thời gian encode: json.dumps(jsonable_encoder(...)) (đường mặc định của FastAPI) so với orjson.dumps
+- Số byte trên đường truyền và p50 latency theo Accept-Encoding: identity / gzip / br (nếu có brotli)
+DB là SQLite tạm seed bằng benchmark_endpoints.seed; response cache tắt để mỗi request đều serialize lại
+Sử dụng: python benchmark_serialization.py [--invoices 5000] [--requests 50]
+"""
+import os
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import tempfile
+import orjson
+from benchmark_endpoints import seed
+
+PATHS = [
+    "/products/by-category?items_limit=200",
+    "/invoices?limit=200&fields=id,merchant_name,date,total_amount,items,raw_text",
+    "/products/by-category/1?items_limit=500",
+    "/statistics/by-category",
+]
+
+
+def p50(samples: list) -> float:
+    return sorted(samples)[len(samples) // 2]
+
+
+def time_encoders(obj, rounds: int) -> tuple:
+    """ms cho 1 lần encode: (json + jsonable_encoder, orjson)"""
+    from fastapi.encoders import jsonable_encoder
+    std, fast = [], []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        json.dumps(jsonable_encoder(obj), ensure_ascii=False, separators=(",", ":")).encode()
+        std.append((time.perf_counter() - start) * 1000)
+        start = time.perf_counter()
+        orjson.dumps(obj)
+        fast.append((time.perf_counter() - start) * 1000)
+    return p50(std), p50(fast)
+
+
+async def run(server, args):
+    import httpx
+    encodings = ["identity", "gzip"] + (["br"] if server.brotli is not None else [])
+    transport = httpx.ASGITransport(app=server.app)
+    async with server.lifespan(server.app), httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=120) as client:
+        await server.warm_up()
+        print(f"  {'endpoint':<44} {'encoding':<9} {'byte':>10} {'p50':>9}")
+        for path in PATHS:
+            for encoding in encodings:
+                latencies, size = [], 0
+                for _ in range(args.requests):
+                    start = time.perf_counter()
+                    response = await client.get(path, headers={"Accept-Encoding": encoding})
+                    await response.aread()
+                    latencies.append((time.perf_counter() - start) * 1000)
+                    size = response.num_bytes_downloaded
+                print(f"  {path[:44]:<44} {encoding:<9} {size:>10,} {p50(latencies):>7.1f}ms")
+            body = (await client.get(path, headers={"Accept-Encoding": "identity"})).json()
+            std_ms, fast_ms = time_encoders(body, args.requests)
+            print(f"  {'':<44} encode    json {std_ms:.2f}ms / orjson {fast_ms:.2f}ms (x{std_ms / max(fast_ms, 1e-6):.1f})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark serialize + nén response JSON")
+    parser.add_argument("--invoices", type=int, default=5000)
+    parser.add_argument("--items-per-invoice", type=int, default=5)
+    parser.add_argument("--categories", type=int, default=20)
+    parser.add_argument("--requests", type=int, default=50, help="Số request đo cho mỗi endpoint / encoding")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Cấu hình phải có trước khi import server
+        os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+        os.environ.pop("ASYNC_DATABASE_URL", None)
+        os.environ.update({"OCR_BACKEND": "stub", "OCR_HEDGE_BACKEND": "", "OCR_CACHE_DIR": "",
+                           "SEARCH_INDEX_ENABLED": "false", "RESPONSE_CACHE_ENABLED": "false"})
+        import server
+        logging.getLogger("server").setLevel(logging.WARNING)
+
+        cfg = {"invoices": args.invoices, "items_per_invoice": args.items_per_invoice, "categories": max(args.categories, 20)}
+        print(f"📊 Seed {cfg['invoices']:,} hóa đơn x {cfg['items_per_invoice']} item...")
+        seed(server, cfg, random.Random(args.seed))
+        if server.brotli is None:
+            print("ℹ️  Chưa cài brotli: chỉ đo identity / gzip")
+        asyncio.run(run(server, args))
+        server.engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""
+Tiền xử lý ảnh hóa đơn trước khi gửi OCR: nhận dạng định dạng thật theo magic bytes, xoay theo EXIF,
+thu nhỏ về độ phân giải vừa đủ cho OCR, chuyển xám và nén lại JPEG
+Ảnh chụp điện thoại 8-12 MB thường còn vài trăm KB: upload nhanh hơn, OCR nhanh hơn, không mất chữ
+PDF nhiều trang được tách thành từng PDF 1 trang (pypdf) để OCR song song từng trang
+Pillow / pypdf là tùy chọn: không cài thì vẫn nhận dạng định dạng (để gửi đúng Content-Type) nhưng giữ nguyên bytes
+Các hàm ở đây là sync, tốn CPU: server chạy trong thread pool riêng, không chạy trên event loop
+"""
+import io
+import os
+from typing import List, NamedTuple, Optional
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow là tùy chọn: không cài thì bỏ qua bước thu nhỏ / nén lại
+    Image = ImageOps = None
+try:
+    from pypdf import PdfReader, PdfWriter
+    from pypdf.errors import PyPdfError
+except ImportError:  # pypdf là tùy chọn: không cài thì gửi nguyên file PDF cho OCR
+    PdfReader = PdfWriter = None
+
+# (định dạng, MIME, đuôi file) theo magic bytes ở đầu file
+FORMATS = {
+    "jpeg": ("image/jpeg", ".jpg"),
+    "png": ("image/png", ".png"),
+    "gif": ("image/gif", ".gif"),
+    "bmp": ("image/bmp", ".bmp"),
+    "tiff": ("image/tiff", ".tif"),
+    "webp": ("image/webp", ".webp"),
+    "heic": ("image/heic", ".heic"),
+    "pdf": ("application/pdf", ".pdf"),
+}
+UNKNOWN_TYPE = "application/octet-stream"
+
+
+class DocumentTooLargeError(ValueError):
+    """PDF có nhiều trang hơn giới hạn cho phép"""
+
+
+class PreparedImage(NamedTuple):
+    content: bytes
+    filename: str
+    content_type: str
+    format: str  # Định dạng gốc (jpeg, png, ... hoặc unknown)
+    action: str  # resized | recompressed | passthrough | split (1 trang tách từ PDF)
+
+
+def detect_format(content: bytes) -> Optional[str]:
+    """Định dạng thật của file theo magic bytes (không tin đuôi file / Content-Type client gửi)"""
+    head = content[:16]
+    if head.startswith(b"\xff\xd8\xff"):
+        return "jpeg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if head[:6] in (b"GIF87a", b"GIF89a"):
+        return "gif"
+    if head.startswith(b"BM"):
+        return "bmp"
+    if head[:4] in (b"II*\x00", b"MM\x00*"):
+        return "tiff"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    if head[4:8] == b"ftyp" and head[8:12] in (b"heic", b"heix", b"mif1", b"msf1"):
+        return "heic"
+    if head.startswith(b"%PDF"):
+        return "pdf"
+    return None
+
+
+def content_type_for(content: bytes) -> str:
+    fmt = detect_format(content)
+    return FORMATS[fmt][0] if fmt else UNKNOWN_TYPE
+
+
+def _with_extension(filename: str, extension: str) -> str:
+    stem = os.path.splitext(os.path.basename(filename or ""))[0] or "invoice"
+    return stem + extension
+
+
+def preprocess_image(content: bytes, filename: str, max_side: int = 2000, grayscale: bool = True,
+                     quality: int = 85) -> PreparedImage:
+    """Thu nhỏ cạnh dài về max_side, chuyển xám, nén JPEG; kết quả không nhỏ hơn bản gốc thì giữ bản gốc.
+    PDF, ảnh nhiều frame, định dạng lạ hoặc ảnh lỗi đều giữ nguyên bytes (chỉ gắn đúng Content-Type)"""
+    fmt = detect_format(content)
+    if fmt is None:
+        return PreparedImage(content, filename, UNKNOWN_TYPE, "unknown", "passthrough")
+    content_type, extension = FORMATS[fmt]
+    passthrough = PreparedImage(content, _with_extension(filename, extension), content_type, fmt, "passthrough")
+    if Image is None or fmt == "pdf":
+        return passthrough
+
+    try:
+        with Image.open(io.BytesIO(content)) as image:
+            if getattr(image, "n_frames", 1) > 1:
+                return passthrough
+            # JPEG: giải mã thẳng ở độ phân giải thấp (scale trong DCT), nhanh hơn nhiều so với giải mã đủ rồi resize
+            image.draft("L" if grayscale else "RGB", (max_side, max_side))
+            image = ImageOps.exif_transpose(image)  # Ảnh điện thoại: xoay theo EXIF trước khi bỏ metadata
+            image = image.convert("L" if grayscale else "RGB")
+            resized = max(image.size) > max_side
+            if resized:
+                image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+            output = io.BytesIO()
+            image.save(output, "JPEG", quality=quality, optimize=True)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return passthrough
+
+    result = output.getvalue()
+    if len(result) >= len(content) and not resized:
+        return passthrough
+    return PreparedImage(result, _with_extension(filename, ".jpg"), "image/jpeg", fmt, "resized" if resized else "recompressed")
+
+
+def split_pdf_pages(prepared: PreparedImage, max_pages: int = 50) -> List[PreparedImage]:
+    """Tách PDF thành từng PDF 1 trang theo đúng thứ tự; ảnh, PDF 1 trang hoặc PDF không đọc được thì giữ nguyên.
+    Raise DocumentTooLargeError khi PDF có hơn max_pages trang"""
+    if prepared.format != "pdf" or PdfReader is None:
+        return [prepared]
+    try:
+        reader = PdfReader(io.BytesIO(prepared.content))
+        if reader.is_encrypted and not reader.decrypt(""):
+            return [prepared]
+        count = len(reader.pages)
+    except (PyPdfError, ValueError, OSError, KeyError):
+        return [prepared]  # PDF lỗi cấu trúc: để OCR backend tự xử lý cả file
+    if count <= 1:
+        return [prepared]
+    if count > max_pages:
+        raise DocumentTooLargeError(f"PDF có {count} trang, tối đa {max_pages} trang")
+
+    stem = os.path.splitext(prepared.filename)[0]
+    pages = []
+    try:
+        for number, page in enumerate(reader.pages, start=1):
+            writer = PdfWriter()
+            writer.add_page(page)
+            output = io.BytesIO()
+            writer.write(output)
+            pages.append(PreparedImage(output.getvalue(), f"{stem}_p{number}.pdf", prepared.content_type, "pdf", "split"))
+    except (PyPdfError, ValueError, OSError, KeyError):
+        return [prepared]
+    return pages
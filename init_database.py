@@ -0,0 +1,20 @@
+"""
+Script khởi tạo database: tạo các bảng còn thiếu + 20 danh mục sản phẩm mẫu
+server.py không còn tự tạo bảng khi import; chạy script này 1 lần khi dựng DB mới
+(hoặc đặt DB_CREATE_SCHEMA=true để server tự làm lúc khởi động, tiện cho môi trường dev)
+Sử dụng: python init_database.py
+"""
+import time
+from server import init_schema
+
+def main():
+    print("🔄 Đang khởi tạo database...")
+    start = time.perf_counter()
+    try:
+        init_schema()
+        print(f"✅ Hoàn tất ({time.perf_counter() - start:.1f}s)")
+    except Exception as e:
+        print(f"❌ Lỗi khởi tạo database: {e}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""
+Parser text OCR của hóa đơn -> dict (merchant, ngày, items, tổng tiền)
+Tách riêng khỏi server.py để có thể chạy song song trên process pool mà không kéo theo kết nối DB
+"""
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional
+
+# --- PATTERNS (compile 1 lần khi import) ---
+NON_DIGIT_RE = re.compile(r'[^\d]')
+DATE_RE = re.compile(r'\b\d{1,2}[/-]\d{1,2}[/-]\d{4}\b|\b\d{4}-\d{1,2}-\d{1,2}\b')
+# Số tiền ở cuối dòng, cho phép đuôi đ/vnd ("Bánh mì: 20.000", "Giấy A4 .... 500,000đ")
+# Không dùng IGNORECASE và chỉ thử match từ đầu dãy dấu ngăn cách: search nhanh hơn ~30% trên dòng sản phẩm
+AMOUNT_TAIL_RE = re.compile(r'(?<![\s.:])[\s.:]+(?P<amount>\d[\d,.]*)\s*(?:[đdĐD]|[vV][nN][đdĐD])?$')
+# Đuôi dòng sản phẩm: tìm thành tiền ở cuối dòng trước (AMOUNT_TAIL_RE), sau đó mới tìm "số lượng x đơn giá" ở phần
+# còn lại; qty và unit bắt buộc có dấu ngăn (x * @ hoặc khoảng trắng) để "40.000" không bị tách thành 4 x 0 + 000
+QTY_UNIT_TAIL_RE = re.compile(r'\s(?P<qty>\d{1,4})(?:\s*[xX*@]\s*|\s+)(?P<unit>\d[\d,.]*)$')
+# "... x2" (chỉ có số lượng)
+QTY_ONLY_TAIL_RE = re.compile(r'\s[xX*]\s*(?P<qty>\d{1,4})$')
+PHONE_RE = re.compile(r'(?<![\d.,])(?:\+84|0)\d{2,3}[\s.-]?\d{3}[\s.-]?\d{3,4}(?![\d.,])')
+# Dòng tổng tiền (nhóm "total") / thông tin chung, không phải sản phẩm; gộp 1 regex để mỗi dòng chỉ match 1 lần
+# Các từ cũng hay nằm trong tên sản phẩm (thuế, ngày, cash, change, ...) chỉ tính là nhãn khi đứng ngay trước
+# ":", "(", "%", số hoặc VAT/GTGT, vd "Thuế VAT 10%: 5.000" nhưng không phải "Thue kho 50.000"
+KEYWORD_RE = re.compile(r'^(?:(?:(?P<total>tổng\s*cộng|tong\s*cong|tổng\s*tiền|tong\s*tien|tổng|tong|total|thành\s*tiền|thanh\s*tien|'
+                        r'thanh\s*toán|thanh\s*toan|cộng\s*tiền\s*hàng|cong\s*tien\s*hang|grand\s*total|amount\s*due)|'
+                        r'tiền\s*khách|tien\s*khach|tiền\s*thối|tien\s*thoi|tiền\s*thừa|tien\s*thua|giảm\s*giá|giam\s*gia|'
+                        r'chiết\s*khấu|chiet\s*khau|điện\s*thoại|dien\s*thoai|đt|dt|'
+                        r'tel|phone|hotline|mst|mã\s*số\s*thuế|ma\s*so\s*thue|số\s*hđ|so\s*hd|số\s*hóa\s*đơn|so\s*hoa\s*don|'
+                        r'hóa\s*đơn|hoa\s*don|subtotal|thu\s*ngân|thu\s*ngan)\b|'
+                        r'(?:thuế|thue|vat|ngày|ngay|date|invoice|cash|change)(?=\s*(?:[:(%#]|\d|vat\b|gtgt\b)))', re.IGNORECASE)
+AMOUNT_END_CHARS = frozenset('0123456789đdĐD')
+
+
+class InvoiceParserService:
+    @staticmethod
+    def parse_money(text: str) -> int:
+        if not text: return 0
+        clean_text = NON_DIGIT_RE.sub('', text)
+        try: return int(clean_text)
+        except ValueError: return 0
+
+    @staticmethod
+    def _amount(text: str) -> int:
+        # Nhóm đã match \d[\d,.]* nên chỉ cần bỏ dấu ngăn cách, nhanh hơn regex sub của parse_money
+        return int(text.replace('.', '').replace(',', ''))
+
+    @classmethod
+    def parse_item(cls, line: str) -> Optional[dict]:
+        """Tách 1 dòng thành item {name, quantity, unit_price, price}; None nếu không phải dòng sản phẩm"""
+        # Lọc nhanh: dòng sản phẩm luôn kết thúc bằng số tiền
+        if line[-1] not in AMOUNT_END_CHARS:
+            return None
+        match = AMOUNT_TAIL_RE.search(line)
+        if not match:
+            return None
+        price = cls._amount(match.group('amount'))
+        if price <= 0:
+            return None
+
+        name, quantity, unit_price = line[:match.start()].strip(), 1, price
+        detail = QTY_UNIT_TAIL_RE.search(name)
+        if detail:
+            qty, unit = int(detail.group('qty')), cls._amount(detail.group('unit'))
+            # Chỉ nhận khi số lượng x đơn giá khớp thành tiền, tránh nhầm số trong tên sản phẩm
+            if qty > 0 and qty * unit == price:
+                name, quantity, unit_price = name[:detail.start()].strip(), qty, unit
+        else:
+            detail = QTY_ONLY_TAIL_RE.search(name)
+            if detail and int(detail.group('qty')) > 0:
+                quantity = int(detail.group('qty'))
+                name, unit_price = name[:detail.start()].strip(), price // quantity
+
+        if len(name) <= 2:
+            return None
+        return {"name": name, "quantity": quantity, "unit_price": unit_price, "price": price}
+
+    @classmethod
+    def parse(cls, raw_text: str) -> dict:
+        default_res = {"merchant_name": "Unknown", "date": "", "items": [], "total_amount": 0, "raw_text": raw_text}
+        if not raw_text: return default_res
+
+        text = raw_text.replace('\r\n', '\n').replace('\r', '\n') if '\r' in raw_text else raw_text
+        lines = [line for line in map(str.strip, text.split('\n')) if line]
+        if not lines: return default_res
+
+        default_res["merchant_name"] = lines[0]
+
+        items = []
+        total_amount = 0
+        printed_total = 0
+        for line in lines[1:]:
+            if '/' in line or '-' in line:
+                date_match = DATE_RE.search(line)
+                if date_match:
+                    if not default_res["date"]:
+                        default_res["date"] = date_match.group(0)
+                    continue
+            # Dòng không kết thúc bằng số tiền thì không phải item cũng không phải dòng tổng
+            if line[-1] not in AMOUNT_END_CHARS:
+                continue
+            keyword = KEYWORD_RE.match(line)
+            if keyword:
+                if keyword.group('total') and not printed_total:
+                    amount = AMOUNT_TAIL_RE.search(line)
+                    printed_total = cls._amount(amount.group('amount')) if amount else 0
+                continue
+
+            item = cls.parse_item(line)
+            # Dòng có "số lượng x đơn giá" khớp thành tiền thì không thể là số điện thoại, chỉ kiểm tra dòng còn lại
+            if item and (item["quantity"] > 1 or not PHONE_RE.search(line)):
+                items.append(item)
+                total_amount += item["price"]  # Tổng tất cả items
+
+        default_res["items"] = items
+        # Tổng tiền = tổng tất cả items; không đọc được item nào thì dùng dòng "Tổng cộng" trên hóa đơn
+        default_res["total_amount"] = total_amount if items else printed_total
+        return default_res
+
+    @classmethod
+    def parse_many(cls, raw_texts: List[str], processes: Optional[int] = None, chunksize: int = 64) -> List[dict]:
+        """Parse nhiều text cùng lúc; processes > 1 thì chia ra process pool (giữ nguyên thứ tự)"""
+        # Không quá số CPU (pool trên máy 1 CPU chậm hơn tuần tự ~1.4 lần); vừa 1 chunk thì cũng chỉ 1 process làm việc
+        processes = min(processes or 1, os.cpu_count() or 1)
+        if processes <= 1 or len(raw_texts) <= chunksize:
+            return [cls.parse(text) for text in raw_texts]
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            return list(pool.map(_parse_text, raw_texts, chunksize=chunksize))
+
+
+def _parse_text(raw_text: str) -> dict:
+    # Hàm cấp module để pickle được khi gửi sang process con
+    return InvoiceParserService.parse(raw_text)
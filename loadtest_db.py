@@ -0,0 +1,64 @@
+"""
+Load test các endpoint đọc DB ở nhiều mức concurrency, đo throughput và độ trễ p50/p95
+Chạy với server đang chạy sẵn (uvicorn server:app); so sánh mức concurrency dưới / trên giới hạn threadpool
+của Starlette (40 thread) để thấy endpoint async không còn bị chặn bởi số thread
+Sử dụng: python loadtest_db.py [--url http://localhost:8000] [--concurrency 10,40,80,160] [--duration 10]
+"""
+import time
+import asyncio
+import argparse
+import httpx
+
+DEFAULT_PATHS = "/invoices?limit=20,/categories,/statistics/by-category,/products/by-category/1?items_limit=20"
+THREADPOOL_LIMIT = 40  # Số thread mặc định của anyio cho endpoint sync
+
+
+async def worker(client: httpx.AsyncClient, paths: list, deadline: float, offset: int, latencies: list, errors: list):
+    i = offset
+    while time.perf_counter() < deadline:
+        path = paths[i % len(paths)]
+        i += 1
+        start = time.perf_counter()
+        try:
+            response = await client.get(path)
+            if response.status_code >= 400:
+                errors.append(response.status_code)
+                continue
+        except httpx.HTTPError as e:
+            errors.append(type(e).__name__)
+            continue
+        latencies.append((time.perf_counter() - start) * 1000)
+
+
+async def run_level(url: str, paths: list, concurrency: int, duration: float) -> dict:
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=60) as client:
+        await client.get(paths[0])  # Warm-up: nạp cache danh mục, mở kết nối
+        latencies, errors = [], []
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(client, paths, start + duration, n, latencies, errors) for n in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    latencies.sort()
+    pick = lambda q: latencies[min(int(len(latencies) * q), len(latencies) - 1)] if latencies else 0.0
+    return {"rps": len(latencies) / elapsed, "p50": pick(0.50), "p95": pick(0.95), "errors": len(errors)}
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Load test endpoint DB")
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--paths", default=DEFAULT_PATHS, help="Danh sách path, phân cách bằng dấu phẩy")
+    parser.add_argument("--concurrency", default="10,40,80,160", help="Các mức concurrency, phân cách bằng dấu phẩy")
+    parser.add_argument("--duration", type=float, default=10, help="Thời gian chạy mỗi mức (giây)")
+    args = parser.parse_args()
+
+    paths = [p.strip() for p in args.paths.split(",") if p.strip()]
+    print(f"📊 Load test {args.url}: {', '.join(paths)}")
+    print(f"  {'concurrency':>11}  {'req/s':>9}  {'p50':>9}  {'p95':>9}  lỗi")
+    for concurrency in (int(c) for c in args.concurrency.split(",")):
+        result = await run_level(args.url, paths, concurrency, args.duration)
+        marker = "  (> threadpool)" if concurrency > THREADPOOL_LIMIT else ""
+        print(f"  {concurrency:>11}  {result['rps']:>9,.0f}  {result['p50']:>7.1f}ms  {result['p95']:>7.1f}ms  {result['errors']}{marker}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -84,6 +84,56 @@ def migrate_database():
             else:
                 print(f"  ⚠️  Lỗi khi thêm index: {e}")
         
+        # Kiểm tra và thêm parsed_date (ngày đã chuẩn hóa, điền dữ liệu cũ bằng backfill_invoice_dates.py)
+        try:
+            cursor.execute("ALTER TABLE invoices ADD COLUMN parsed_date DATE NULL AFTER date")
+            print("  ✅ Đã thêm cột parsed_date")
+        except Exception as e:
+            if "Duplicate column name" in str(e):
+                print("  ℹ️  Cột parsed_date đã tồn tại")
+            else:
+                print(f"  ⚠️  Lỗi khi thêm parsed_date: {e}")
+        
+        # Index (parsed_date, id) cho lọc theo khoảng ngày
+        try:
+            cursor.execute("CREATE INDEX ix_invoices_parsed_date_id ON invoices(parsed_date, id)")
+            print("  ✅ Đã thêm index cho parsed_date")
+        except Exception as e:
+            if "Duplicate key name" in str(e):
+                print("  ℹ️  Index parsed_date đã tồn tại")
+            else:
+                print(f"  ⚠️  Lỗi khi thêm index parsed_date: {e}")
+        
+        # Kiểm tra và thêm fingerprint (chống trùng hóa đơn, điền dữ liệu cũ bằng backfill_invoice_fingerprints.py)
+        try:
+            cursor.execute("ALTER TABLE invoices ADD COLUMN fingerprint VARCHAR(64) NULL AFTER vat_amount")
+            print("  ✅ Đã thêm cột fingerprint")
+        except Exception as e:
+            if "Duplicate column name" in str(e):
+                print("  ℹ️  Cột fingerprint đã tồn tại")
+            else:
+                print(f"  ⚠️  Lỗi khi thêm fingerprint: {e}")
+        
+        # Unique index cho fingerprint (NULL không tính là trùng)
+        try:
+            cursor.execute("CREATE UNIQUE INDEX ux_invoices_fingerprint ON invoices(fingerprint)")
+            print("  ✅ Đã thêm unique index cho fingerprint")
+        except Exception as e:
+            if "Duplicate key name" in str(e):
+                print("  ℹ️  Index fingerprint đã tồn tại")
+            else:
+                print(f"  ⚠️  Lỗi khi thêm index fingerprint: {e}")
+        
+        # Sentinel cho bulk insert (server._insert_invoice_rows đọc lại id theo sentinel, dữ liệu cũ để NULL)
+        try:
+            cursor.execute("ALTER TABLE invoices ADD COLUMN bulk_sentinel BIGINT NULL AFTER fingerprint")
+            print("  ✅ Đã thêm cột bulk_sentinel")
+        except Exception as e:
+            if "Duplicate column name" in str(e):
+                print("  ℹ️  Cột bulk_sentinel đã tồn tại")
+            else:
+                print(f"  ⚠️  Lỗi khi thêm bulk_sentinel: {e}")
+        
         # Kiểm tra và thêm cột vào bảng invoice_items
         print("\n📋 Cập nhật bảng invoice_items...")
         
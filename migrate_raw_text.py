@@ -0,0 +1,68 @@
+"""
+Script chuyển raw_text từ cột inline invoices.raw_text sang bảng invoice_raw_texts (nén zlib)
+Chạy theo từng chunk id tăng dần, mỗi chunk 1 transaction: có thể dừng giữa chừng và chạy lại an toàn
+Sử dụng: python migrate_raw_text.py [--batch-size 1000] [--optimize]
+"""
+import time
+import argparse
+from sqlalchemy import select, insert, update, func, text
+from server import SessionLocal, Base, InvoiceDB, InvoiceRawTextDB, raw_text_values
+
+def migrate_chunk(db, last_id: int, batch_size: int) -> tuple:
+    """Chuyển 1 chunk, trả về (id cuối cùng đã xử lý, số dòng đã chuyển); id cuối = None khi hết dữ liệu"""
+    rows = db.execute(
+        select(InvoiceDB.id, InvoiceDB.legacy_raw_text)
+        .where(InvoiceDB.id > last_id, InvoiceDB.legacy_raw_text.isnot(None))
+        .order_by(InvoiceDB.id).limit(batch_size)
+    ).all()
+    if not rows:
+        return None, 0
+
+    ids = [row.id for row in rows]
+    # Bỏ qua invoice đã có bản nén (chạy lại sau khi bị dừng giữa chừng)
+    existing = set(db.execute(select(InvoiceRawTextDB.invoice_id).where(InvoiceRawTextDB.invoice_id.in_(ids))).scalars())
+    values = [{**raw_text_values(row.legacy_raw_text), "invoice_id": row.id}
+              for row in rows if row.id not in existing and row.legacy_raw_text]
+    if values:
+        db.execute(insert(InvoiceRawTextDB.__table__), values)
+    db.execute(update(InvoiceDB.__table__).where(InvoiceDB.__table__.c.id.in_(ids)).values(raw_text=None))
+    db.commit()
+    return ids[-1], len(values)
+
+def main():
+    parser = argparse.ArgumentParser(description="Chuyển raw_text sang bảng nén invoice_raw_texts")
+    parser.add_argument("--batch-size", type=int, default=1000, help="Số invoice mỗi transaction")
+    parser.add_argument("--optimize", action="store_true", help="Chạy OPTIMIZE TABLE invoices sau khi xong (MySQL) để thu hồi dung lượng")
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        # Tạo bảng invoice_raw_texts nếu chưa có (server không còn tự tạo bảng khi import)
+        Base.metadata.create_all(bind=db.get_bind(), tables=[InvoiceRawTextDB.__table__])
+        print("🔄 Đang chuyển raw_text sang invoice_raw_texts...")
+        start, last_id, total = time.perf_counter(), 0, 0
+        while True:
+            last_id, moved = migrate_chunk(db, last_id, args.batch_size)
+            if last_id is None:
+                break
+            total += moved
+            print(f"  ✅ Đến invoice #{last_id}: đã chuyển {total} raw_text ({time.perf_counter() - start:.1f}s)")
+
+        raw_size, stored_size = db.execute(
+            select(func.sum(InvoiceRawTextDB.raw_size), func.sum(func.length(InvoiceRawTextDB.content)))
+        ).one()
+        if raw_size:
+            print(f"📦 {raw_size:,} byte -> {stored_size:,} byte sau khi nén ({stored_size / raw_size:.0%})")
+
+        if args.optimize and db.get_bind().dialect.name == "mysql":
+            print("🧹 OPTIMIZE TABLE invoices...")
+            db.execute(text("OPTIMIZE TABLE invoices"))
+        print(f"✅ Hoàn tất: {total} invoice")
+    except Exception as e:
+        db.rollback()
+        print(f"❌ Lỗi migration (chạy lại để tiếp tục từ chunk lỗi): {e}")
+    finally:
+        db.close()
+
+if __name__ == "__main__":
+    main()
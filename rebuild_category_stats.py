@@ -0,0 +1,23 @@
+"""
+Script tính lại bảng category_statistics từ invoice_items
+Chạy khi nâng cấp DB cũ (backfill) hoặc khi nghi ngờ số liệu thống kê bị lệch
+Sử dụng: python rebuild_category_stats.py
+"""
+from server import SessionLocal, Base, CategoryStatsDB, rebuild_category_stats
+
+def main():
+    db = SessionLocal()
+    try:
+        # Tạo bảng category_statistics nếu chưa có (server không còn tự tạo bảng khi import)
+        Base.metadata.create_all(bind=db.get_bind(), tables=[CategoryStatsDB.__table__])
+        print("🔄 Đang tính lại thống kê theo danh mục...")
+        rows = rebuild_category_stats(db)
+        print(f"✅ Đã cập nhật {rows} dòng thống kê")
+    except Exception as e:
+        db.rollback()
+        print(f"❌ Lỗi rebuild thống kê: {e}")
+    finally:
+        db.close()
+
+if __name__ == "__main__":
+    main()
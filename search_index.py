@@ -0,0 +1,142 @@
+"""
+Inverted index trong RAM để tìm kiếm hóa đơn theo raw_text, tên cửa hàng / nhà cung cấp và tên sản phẩm
+Bỏ dấu tiếng Việt khi index và khi tìm ("banh mi" khớp "Bánh mì"), xếp hạng theo trọng số field x IDF
+Không phụ thuộc DB: server.py lo việc nạp dữ liệu và cập nhật khi có invoice mới
+"""
+import re
+import math
+import heapq
+import threading
+import unicodedata
+from typing import Iterable, List, Optional, Tuple
+
+TOKEN_RE = re.compile(r'\w{2,}')
+
+# Trọng số theo field: khớp tên cửa hàng > tên sản phẩm > text OCR
+WEIGHT_MERCHANT = 3
+WEIGHT_ITEM = 2
+WEIGHT_RAW_TEXT = 1
+# Trần trọng số của 1 token trong 1 invoice (nhiều item trùng tên): giữ số bucket mỗi token nhỏ
+WEIGHT_CAP = 8
+# Số kết quả tối đa để chấm điểm từng invoice; nhiều hơn thì duyệt bucket theo điểm giảm dần và dừng khi đủ trang
+DIRECT_SCORE_LIMIT = 5000
+
+
+def fold(text: str) -> str:
+    """Chữ thường + bỏ dấu tiếng Việt (đ -> d)"""
+    decomposed = unicodedata.normalize('NFD', text.lower().replace('đ', 'd'))
+    return ''.join(ch for ch in decomposed if not unicodedata.combining(ch))
+
+
+def tokenize(text: Optional[str]) -> List[str]:
+    if not text:
+        return []
+    return TOKEN_RE.findall(fold(text))
+
+
+class InvoiceSearchIndex:
+    def __init__(self):
+        # token -> {trọng số: set(invoice_id)}; gom theo trọng số để giao tập hợp và xếp hạng chạy bằng set của C
+        self.postings: dict = {}
+        self.token_docs: dict = {}  # token -> set(invoice_id) (hợp của các bucket)
+        self.indexed_ids: set = set()
+        self.max_id = 0
+        self.lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self.indexed_ids)
+
+    def add(self, invoice_id: int, fields: Iterable[Tuple[Optional[str], int]]):
+        """Thêm (hoặc bổ sung field cho) 1 invoice; fields = [(text, trọng số), ...]"""
+        weights = {}
+        for text, weight in fields:
+            # Mỗi token chỉ tính 1 lần cho mỗi field để text dài không lấn át
+            for token in set(tokenize(text)):
+                weights[token] = weights.get(token, 0) + weight
+
+        with self.lock:
+            for token, weight in weights.items():
+                docs = self.token_docs.get(token)
+                if docs is None:
+                    docs = self.token_docs[token] = set()
+                    self.postings[token] = {}
+                buckets = self.postings[token]
+                if invoice_id in docs:
+                    # Invoice đã có token này: chuyển sang bucket có trọng số mới
+                    for old_weight, ids in buckets.items():
+                        if invoice_id in ids:
+                            ids.discard(invoice_id)
+                            if not ids:
+                                del buckets[old_weight]
+                            weight += old_weight
+                            break
+                docs.add(invoice_id)
+                buckets.setdefault(min(weight, WEIGHT_CAP), set()).add(invoice_id)
+            self.indexed_ids.add(invoice_id)
+            if invoice_id > self.max_id:
+                self.max_id = invoice_id
+
+    def search(self, query: str, limit: int = 20, offset: int = 0) -> Tuple[int, List[Tuple[int, float]]]:
+        """Trả về (tổng số kết quả, [(invoice_id, điểm)]) cho trang yêu cầu; mọi token trong query đều phải khớp.
+        Điểm = tổng (trọng số field x IDF) của các token, bằng điểm thì invoice mới hơn đứng trước"""
+        tokens = list(dict.fromkeys(tokenize(query)))
+        if not tokens:
+            return 0, []
+        need = offset + limit
+        with self.lock:
+            docs = [self.token_docs.get(token) for token in tokens]
+            if any(not d for d in docs):
+                return 0, []
+            total_docs = max(len(self.indexed_ids), 1)
+            idfs = [math.log(1 + total_docs / len(d)) for d in docs]
+            ordered = sorted(docs, key=len)
+            matched = ordered[0].intersection(*ordered[1:])
+            if len(matched) <= DIRECT_SCORE_LIMIT:
+                top = self._score_all(tokens, idfs, matched, need)
+            else:
+                top = self._score_buckets(tokens, idfs, need)
+        return len(matched), top[offset:need]
+
+    def _score_all(self, tokens: List[str], idfs: List[float], matched: set, need: int) -> List[Tuple[int, float]]:
+        scores = dict.fromkeys(matched, 0.0)
+        for token, idf in zip(tokens, idfs):
+            for weight, ids in self.postings[token].items():
+                for invoice_id in ids & matched:
+                    scores[invoice_id] += weight * idf
+        return heapq.nlargest(need, scores.items(), key=lambda item: (round(item[1], 9), item[0]))
+
+    def _score_buckets(self, tokens: List[str], idfs: List[float], need: int) -> List[Tuple[int, float]]:
+        """Duyệt tổ hợp bucket theo điểm giảm dần (best-first), giao set của từng tổ hợp, dừng khi đủ `need` kết quả"""
+        lists = [sorted(((weight * idf, ids) for weight, ids in self.postings[token].items()), key=lambda b: b[0], reverse=True)
+                 for token, idf in zip(tokens, idfs)]
+
+        def combo_score(combo):
+            return round(sum(lists[k][i][0] for k, i in enumerate(combo)), 9)
+
+        first = (0,) * len(lists)
+        heap, seen = [(-combo_score(first), first)], {first}
+        top, cutoff = [], None
+        while heap:
+            neg_score, combo = heapq.heappop(heap)
+            if cutoff is not None and -neg_score < cutoff:
+                break  # Các tổ hợp còn lại đều có điểm thấp hơn kết quả thứ `need`
+            sets = sorted((lists[k][i][1] for k, i in enumerate(combo)), key=len)
+            ids = sets[0].intersection(*sets[1:])
+            if ids:
+                top.extend((invoice_id, -neg_score) for invoice_id in heapq.nlargest(need, ids))
+                if cutoff is None and len(top) >= need:
+                    cutoff = -neg_score  # Vẫn lấy tiếp các tổ hợp bằng điểm để xếp theo id cho đúng
+            for k in range(len(combo)):
+                if combo[k] + 1 < len(lists[k]):
+                    nxt = combo[:k] + (combo[k] + 1,) + combo[k + 1:]
+                    if nxt not in seen:
+                        seen.add(nxt)
+                        heapq.heappush(heap, (-combo_score(nxt), nxt))
+        top.sort(key=lambda item: (item[1], item[0]), reverse=True)
+        return top[:need]
+
+    @staticmethod
+    def matches(query: str, text: Optional[str]) -> bool:
+        """text có chứa ít nhất 1 token của query không (dùng để đánh dấu item khớp)"""
+        tokens = set(tokenize(query))
+        return bool(tokens) and not tokens.isdisjoint(tokenize(text))
@@ -1,42 +1,224 @@
 import os
 import re
 import json
+import time
+import asyncio
+import hashlib
+import unicodedata
+import sqlite3
+import threading
 import logging
-import requests
 import traceback
-from typing import List, Optional, Any
-from sqlalchemy import create_engine, Column, Integer, String, Text, ForeignKey, BigInteger
-from sqlalchemy.orm import sessionmaker, declarative_base, Session, relationship
-from sqlalchemy.exc import SQLAlchemyError
-from fastapi import FastAPI, UploadFile, File, HTTPException, Depends, status
+import uuid
+import datetime
+import csv
+import io
+import zlib
+import httpx
+import orjson
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import List, Optional, Any, AsyncIterator, Awaitable, Callable
+from sqlalchemy import create_engine, Column, Integer, String, Text, ForeignKey, BigInteger, Date, DateTime, LargeBinary, Index, TypeDecorator, select, insert, insert_sentinel, func, event, text
+from sqlalchemy.orm import sessionmaker, declarative_base, Session, relationship, selectinload, load_only, deferred
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+from sqlalchemy.exc import SQLAlchemyError, IntegrityError
+from fastapi import FastAPI, UploadFile, File, HTTPException, Depends, Query, Body, Header, Response, status
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field, field_validator
+from fastapi.responses import StreamingResponse, PlainTextResponse, JSONResponse
+from starlette.datastructures import MutableHeaders
+from pydantic import BaseModel, Field, ValidationError, field_validator
 from dotenv import load_dotenv
+from invoice_parser import InvoiceParserService
+from search_index import InvoiceSearchIndex, WEIGHT_MERCHANT, WEIGHT_ITEM, WEIGHT_RAW_TEXT
+from metrics import MetricsRegistry
+from image_preprocess import PreparedImage, DocumentTooLargeError, preprocess_image, split_pdf_pages, detect_format, content_type_for, Image
+from sql_profiler import SqlProfile, current_sql_profile, PROFILE_HEADER
+try:
+    import brotli
+except ImportError:  # brotli là tùy chọn: không cài thì chỉ nén gzip
+    brotli = None
 
 # --- CONFIG ---
 load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
+logging.getLogger("httpx").setLevel(logging.WARNING)  # Tránh log mỗi request OCR
 
 API_KEY = os.getenv("OCR_API_KEY", "helloworld") # Key mặc định để test
+OCR_API_URL = os.getenv("OCR_API_URL", "https://api.ocr.space/parse/image")
+OCR_TIMEOUT = float(os.getenv("OCR_TIMEOUT", "20"))  # Deadline cho mỗi request OCR (giây)
+OCR_MAX_CONCURRENCY = int(os.getenv("OCR_MAX_CONCURRENCY", "8"))  # Số request OCR chạy song song tối đa
+OCR_POOL_SIZE = int(os.getenv("OCR_POOL_SIZE", "16"))  # Số kết nối keep-alive giữ trong pool
+OCR_LANGUAGE = os.getenv("OCR_LANGUAGE", "eng")
+OCR_ENGINE = int(os.getenv("OCR_ENGINE", "2"))
+OCR_SCALE = os.getenv("OCR_SCALE", "true").lower() == "true"
+OCR_CACHE_SIZE = int(os.getenv("OCR_CACHE_SIZE", "512"))  # Số kết quả giữ trong RAM (LRU)
+OCR_CACHE_TTL = int(os.getenv("OCR_CACHE_TTL", "86400"))  # Thời gian sống của 1 kết quả (giây)
+OCR_CACHE_DIR = os.getenv("OCR_CACHE_DIR", "")  # Để trống = tắt cache trên đĩa
+OCR_CACHE_DISK_MAX_ENTRIES = int(os.getenv("OCR_CACHE_DISK_MAX_ENTRIES", "10000"))
+BATCH_MAX_WORKERS = int(os.getenv("BATCH_MAX_WORKERS", "4"))  # Số file xử lý song song trong 1 batch
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))  # Số worker nền xử lý job OCR
+JOB_QUEUE_MAXSIZE = int(os.getenv("JOB_QUEUE_MAXSIZE", "1000"))  # Số job tối đa đang chờ
+JOB_RETENTION_SECONDS = int(os.getenv("JOB_RETENTION_SECONDS", "3600"))  # Giữ kết quả job bao lâu sau khi xong
+JOB_MAX_TRACKED = int(os.getenv("JOB_MAX_TRACKED", "10000"))  # Số job tối đa giữ trong RAM (chờ + đang chạy + đã xong)
+OCR_BACKEND = os.getenv("OCR_BACKEND", "ocrspace")  # Backend chính: ocrspace | ocrspace_alt | stub
+OCR_HEDGE_BACKEND = os.getenv("OCR_HEDGE_BACKEND", "")  # Backend dự phòng cho hedged request, để trống = tắt
+OCR_HEDGE_DEFAULT_DELAY = float(os.getenv("OCR_HEDGE_DEFAULT_DELAY", "3.0"))  # Dùng khi chưa đủ mẫu để tính p95
+OCR_HEDGE_MIN_DELAY = float(os.getenv("OCR_HEDGE_MIN_DELAY", "0.2"))
+OCR_HEDGE_MIN_SAMPLES = int(os.getenv("OCR_HEDGE_MIN_SAMPLES", "20"))
+OCR_ALT_API_KEY = os.getenv("OCR_ALT_API_KEY", API_KEY)
+OCR_ALT_ENGINE = int(os.getenv("OCR_ALT_ENGINE", "1"))
+OCR_STUB_FIXTURES_DIR = str(Path(__file__).resolve().parent / os.getenv("OCR_STUB_FIXTURES_DIR", "ocr_fixtures"))  # Đường dẫn tương đối tính từ thư mục chứa server.py, không phải cwd
+OCR_STUB_LATENCY = float(os.getenv("OCR_STUB_LATENCY", "0"))  # Giả lập độ trễ của stub (giây)
+BULK_CHUNK_SIZE = int(os.getenv("BULK_CHUNK_SIZE", "500"))  # Số invoice mỗi transaction khi import bulk
+BULK_MAX_RECORDS = int(os.getenv("BULK_MAX_RECORDS", "10000"))  # Số invoice tối đa mỗi request bulk
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "2000"))  # Số dòng đọc mỗi lần từ server-side cursor khi export
+CATEGORY_CACHE_TTL = int(os.getenv("CATEGORY_CACHE_TTL", "300"))  # Tự nạp lại danh mục sau N giây (thay đổi trực tiếp trong DB)
+CATEGORY_MISS_RELOAD_INTERVAL = float(os.getenv("CATEGORY_MISS_RELOAD_INTERVAL", "5"))  # Gặp id lạ thì nạp lại, tối đa 1 lần / N giây
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "true").lower() == "true"  # Cache response + ETag cho các endpoint dashboard
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "60"))  # Giới hạn độ cũ khi DB bị ghi từ worker / script khác (giây)
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "256"))
+RESPONSE_CACHE_MAX_ENTRY_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRY_BYTES", str(1024 * 1024)))  # Response lớn hơn thì stream thẳng, không ETag, không cache
+RESPONSE_CACHE_PATHS = ("/categories", "/statistics/by-category", "/products/by-category")  # Path (và path con) được cache
+COMPRESS_ENABLED = os.getenv("COMPRESS_ENABLED", "true").lower() == "true"  # Nén response theo Accept-Encoding (br / gzip)
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "1024"))  # Response nhỏ hơn (byte) thì gửi thẳng, nén không đáng
+COMPRESS_GZIP_LEVEL = int(os.getenv("COMPRESS_GZIP_LEVEL", "5"))  # 1-9, mức 5-6 cân bằng CPU / kích thước
+COMPRESS_BROTLI_QUALITY = int(os.getenv("COMPRESS_BROTLI_QUALITY", "4"))  # 0-11, >5 quá tốn CPU cho response động
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(20 * 1024 * 1024)))  # Kích thước tối đa 1 file upload (byte), vượt thì 413
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+OCR_PREPROCESS_ENABLED = os.getenv("OCR_PREPROCESS_ENABLED", "true").lower() == "true"  # Thu nhỏ / chuyển xám / nén ảnh trước khi OCR (cần Pillow)
+OCR_PREPROCESS_WORKERS = int(os.getenv("OCR_PREPROCESS_WORKERS", str(min(4, os.cpu_count() or 1))))  # Số thread xử lý ảnh song song
+OCR_IMAGE_MAX_SIDE = int(os.getenv("OCR_IMAGE_MAX_SIDE", "2000"))  # Cạnh dài tối đa (px): đủ cho chữ hóa đơn, ảnh lớn hơn chỉ tốn băng thông
+OCR_IMAGE_GRAYSCALE = os.getenv("OCR_IMAGE_GRAYSCALE", "true").lower() == "true"
+OCR_IMAGE_QUALITY = int(os.getenv("OCR_IMAGE_QUALITY", "85"))  # Chất lượng JPEG sau khi nén lại
+OCR_PDF_MAX_PAGES = int(os.getenv("OCR_PDF_MAX_PAGES", "50"))  # PDF nhiều trang hơn thì 413
+OCR_PDF_PAGE_CONCURRENCY = int(os.getenv("OCR_PDF_PAGE_CONCURRENCY", "4"))  # Số trang của 1 PDF OCR song song (vẫn chung giới hạn OCR_MAX_CONCURRENCY)
+OCR_RECORD_FIXTURES_DIR = os.getenv("OCR_RECORD_FIXTURES_DIR", "")  # Ghi lại kết quả OCR thật làm fixture cho stub
+RAW_TEXT_COMPRESS_LEVEL = int(os.getenv("RAW_TEXT_COMPRESS_LEVEL", "6"))  # Mức nén zlib cho raw_text (1-9)
+SEARCH_INDEX_ENABLED = os.getenv("SEARCH_INDEX_ENABLED", "true").lower() == "true"
+SEARCH_SYNC_INTERVAL = float(os.getenv("SEARCH_SYNC_INTERVAL", "2"))  # Khoảng cách tối thiểu giữa 2 lần đồng bộ index với DB (giây)
+SEARCH_SYNC_OVERLAP = int(os.getenv("SEARCH_SYNC_OVERLAP", "1000"))  # Quét lại id của N invoice cuối để bắt transaction commit muộn (chỉ đọc raw_text của id chưa có trong index)
 DB_USER = os.getenv("DB_USER", "root")
 DB_PASSWORD = os.getenv("DB_PASSWORD", "")
 DB_HOST = os.getenv("DB_HOST", "localhost")
 DB_PORT = os.getenv("DB_PORT", "3306")
 DB_NAME = os.getenv("DB_NAME", "invoice_db")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))  # Số kết nối giữ sẵn trong pool (mỗi engine)
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))  # Số kết nối mở thêm khi pool hết
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))  # Thời gian chờ lấy kết nối từ pool (giây)
+DB_POOL_WARM = int(os.getenv("DB_POOL_WARM", "2"))  # Số kết nối mở sẵn khi khởi động (warm-up)
+DB_CREATE_SCHEMA = os.getenv("DB_CREATE_SCHEMA", "false").lower() == "true"  # Tạo bảng + danh mục mẫu khi khởi động (dev); production chạy init_database.py
+READINESS_TIMEOUT = float(os.getenv("READINESS_TIMEOUT", "2"))  # Deadline kiểm tra DB của /readyz (giây)
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"  # Đo latency HTTP / DB cho /metrics
+SQL_PROFILE_ENABLED = os.getenv("SQL_PROFILE_ENABLED", "false").lower() == "true"  # Profile SQL từng request + header X-SQL-Profile (dev / test)
+SQL_SLOW_QUERY_MS = float(os.getenv("SQL_SLOW_QUERY_MS", "200"))  # Log câu SQL chậm hơn ngưỡng kèm tham số (khi bật profile)
+SQL_N_PLUS_ONE_THRESHOLD = int(os.getenv("SQL_N_PLUS_ONE_THRESHOLD", "5"))  # Cùng 1 dạng SELECT lặp >= N lần trong 1 request = nghi N+1
+SQL_QUERY_BUDGET = int(os.getenv("SQL_QUERY_BUDGET", "0"))  # Cảnh báo khi 1 request chạy quá N query, 0 = tắt
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", "86400"))  # Thời gian giữ response của 1 Idempotency-Key (giây)
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+
+# --- METRICS ---
+metrics = MetricsRegistry()
+HTTP_REQUESTS = metrics.counter("http_requests_total", "Số request HTTP theo route và status", ("method", "route", "status"))
+HTTP_LATENCY = metrics.histogram("http_request_duration_seconds", "Thời gian xử lý request (tới byte cuối của response)", ("method", "route"))
+HTTP_IN_FLIGHT = metrics.gauge("http_requests_in_flight", "Số request đang xử lý", ("method",))
+OCR_LATENCY = metrics.histogram("ocr_request_duration_seconds", "Thời gian gọi OCR (gồm hedge)", ("backend", "outcome"),
+                                buckets=(0.1, 0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 10.0, 20.0, 30.0))
+PARSE_LATENCY = metrics.histogram("invoice_parse_duration_seconds", "Thời gian InvoiceParserService.parse",
+                                  buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1))
+DB_QUERY_LATENCY = metrics.histogram("db_query_duration_seconds", "Thời gian thực thi câu SQL", ("engine", "statement"),
+                                     buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0, 5.0))
+INVOICE_DEDUP = metrics.counter("invoice_dedup_total", "Số request / bản ghi tạo hóa đơn bỏ qua vì trùng", ("reason",))
+OCR_PREPROCESS_LATENCY = metrics.histogram("ocr_preprocess_duration_seconds", "Thời gian tiền xử lý ảnh trước OCR", ("format", "action"),
+                                           buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5))
+OCR_PREPROCESS_BYTES = metrics.counter("ocr_preprocess_bytes_total", "Tổng byte trước (input) / sau (output) tiền xử lý ảnh", ("stage",))
+OCR_UPLOAD_BYTES = metrics.histogram("ocr_upload_bytes", "Kích thước file gửi tới OCR backend (byte)",
+                                     buckets=(50e3, 100e3, 250e3, 500e3, 1e6, 2e6, 5e6, 10e6, 20e6))
+OCR_PAGES = metrics.counter("ocr_pdf_pages_total", "Số trang PDF đã OCR theo kết quả", ("outcome",))
+DB_POOL_WAIT = metrics.histogram("db_pool_checkout_wait_seconds", "Thời gian chờ lấy kết nối từ pool", ("engine",),
+                                 buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0))
+
+class _TimedCheckout:
+    """Mixin cho pool: đo thời gian chờ checkout (pool không có event trước khi checkout)"""
+    metrics_label = ""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            DB_POOL_WAIT.observe(time.perf_counter() - start, (self.metrics_label,))
+
+class TimedQueuePool(_TimedCheckout, QueuePool):
+    metrics_label = "sync"
+
+class TimedAsyncQueuePool(_TimedCheckout, AsyncAdaptedQueuePool):
+    metrics_label = "async"
 
-# Setup DB hỗ trợ tiếng Việt
-DATABASE_URL = f"mysql+pymysql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}?charset=utf8mb4"
+# Setup DB hỗ trợ tiếng Việt; DATABASE_URL (vd sqlite:///./local.db) ghi đè cấu hình MySQL
+DATABASE_URL = os.getenv("DATABASE_URL") or f"mysql+pymysql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}?charset=utf8mb4"
+# Driver async tương ứng cho API (engine sync vẫn dùng cho script / khởi tạo / search index)
+ASYNC_DRIVERS = {"mysql": "mysql+aiomysql", "mysql+pymysql": "mysql+aiomysql", "sqlite": "sqlite+aiosqlite", "sqlite+pysqlite": "sqlite+aiosqlite"}
+
+def to_async_url(url: str) -> str:
+    parsed = make_url(url)
+    return parsed.set(drivername=ASYNC_DRIVERS.get(parsed.drivername, parsed.drivername)).render_as_string(hide_password=False)
+
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL") or to_async_url(DATABASE_URL)
+
+def engine_options(url: str) -> dict:
+    parsed = make_url(url)
+    if parsed.get_backend_name() == "sqlite":
+        return {}  # SQLite dùng pool mặc định
+    poolclass = TimedAsyncQueuePool if parsed.get_dialect().is_async else TimedQueuePool
+    return {"poolclass": poolclass, "pool_size": DB_POOL_SIZE, "max_overflow": DB_MAX_OVERFLOW, "pool_timeout": DB_POOL_TIMEOUT,
+            "pool_recycle": 3600, "pool_pre_ping": True, "connect_args": {"charset": "utf8mb4"}}
 
 try:
-    engine = create_engine(DATABASE_URL, pool_recycle=3600, pool_pre_ping=True, connect_args={"charset": "utf8mb4"})
+    engine = create_engine(DATABASE_URL, **engine_options(DATABASE_URL))
     SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    async_engine = create_async_engine(ASYNC_DATABASE_URL, **engine_options(ASYNC_DATABASE_URL))
+    # expire_on_commit=False: đọc lại id / field sau commit không phải query thêm (lazy load không dùng được với async)
+    AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
     Base = declarative_base()
-    logger.info("✅ Database Connected!")
+    logger.info("✅ Database engine configured (kết nối mở khi khởi động app)")
 except Exception as e:
     logger.critical(f"❌ Database Connection Failed: {e}")
     raise e
 
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info["query_started_at"] = time.perf_counter()
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.pop("query_started_at", None)
+    if started is None:
+        return
+    elapsed = time.perf_counter() - started
+    if METRICS_ENABLED:
+        kind = statement.lstrip()[:6].upper()
+        DB_QUERY_LATENCY.observe(elapsed, ("sync" if conn.engine is engine else "async",
+                                 kind if kind in ("SELECT", "INSERT", "UPDATE", "DELETE") else "OTHER"))
+    if SQL_PROFILE_ENABLED:
+        profile = current_sql_profile.get()
+        if profile is not None:
+            profile.record(statement, elapsed)
+        if elapsed * 1000 >= SQL_SLOW_QUERY_MS:
+            params = repr(parameters)
+            logger.warning(f"🐢 SQL chậm {elapsed * 1000:.0f}ms: {' '.join(statement.split())[:1000]} | params: "
+                           f"{params[:500]}{'...' if len(params) > 500 else ''}")
+
+if METRICS_ENABLED or SQL_PROFILE_ENABLED:
+    event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+
 # --- MODELS (SQLAlchemy - Safe Mode) ---
 class ProductCategoryDB(Base):
     __tablename__ = "product_categories"
@@ -53,14 +235,65 @@ class InvoiceDB(Base):
     invoice_number = Column(String(100), nullable=True, index=True)  # Số hóa đơn từ OCR
     merchant_name = Column(String(500), nullable=True)  # Tên cửa hàng
     supplier_name = Column(String(500), nullable=True)  # Nhà cung cấp từ OCR
-    date = Column(String(100), nullable=True)
+    date = Column(String(100), nullable=True)  # Ngày nguyên văn từ OCR / client
+    parsed_date = Column(Date, nullable=True)  # Ngày đã chuẩn hóa (parse_invoice_date), dùng để lọc / sắp xếp
     total_amount = Column(BigInteger, nullable=True)
     vat_rate = Column(Integer, nullable=True)  # % thuế VAT
     vat_amount = Column(BigInteger, nullable=True)  # Số tiền thuế VAT
-    raw_text = Column(Text, nullable=True)
+    # sha256 của nhà cung cấp + số hóa đơn + ngày + tổng tiền đã chuẩn hóa (invoice_fingerprint); NULL khi không có số hóa đơn
+    fingerprint = Column(String(64), nullable=True)
+    # Sentinel cho bulk insert: INSERT nhiều dòng ... RETURNING trả id đúng thứ tự; MySQL dùng để đọc lại id (_insert_invoice_rows)
+    bulk_sentinel = insert_sentinel("bulk_sentinel", BigInteger)
+    # Cột raw_text cũ (inline, không nén): migrate_raw_text.py chuyển sang invoice_raw_texts rồi set NULL
+    legacy_raw_text = deferred(Column("raw_text", Text, nullable=True))
     
     # Quan hệ với bảng Items
     items = relationship("InvoiceItemDB", back_populates="invoice", cascade="all, delete-orphan")
+    # raw_text nén nằm ở bảng riêng, chỉ load khi truy cập (hoặc selectinload khi API yêu cầu)
+    raw_text_row = relationship("InvoiceRawTextDB", uselist=False, cascade="all, delete-orphan")
+
+    # Lọc theo khoảng ngày thành range scan trên index; id đi kèm để sắp xếp / phân trang không cần đọc bảng
+    # Fingerprint unique: tra trùng O(log n) trên index, 2 request ghi cùng hóa đơn song song thì 1 bên lỗi IntegrityError
+    __table_args__ = (Index("ix_invoices_parsed_date_id", "parsed_date", "id"),
+                      Index("ux_invoices_fingerprint", "fingerprint", unique=True))
+
+    @property
+    def raw_text(self) -> Optional[str]:
+        if self.raw_text_row is not None:
+            return self.raw_text_row.content
+        return self.legacy_raw_text
+
+    @raw_text.setter
+    def raw_text(self, value: Optional[str]):
+        self.raw_text_row = InvoiceRawTextDB(**raw_text_values(value)) if value else None
+
+class CompressedText(TypeDecorator):
+    """Text nén zlib khi ghi, giải nén khi đọc; lưu dạng BLOB (MEDIUMBLOB trên MySQL)"""
+    impl = LargeBinary(length=2 ** 24 - 1)
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return None if value is None else zlib.compress(value.encode("utf-8"), RAW_TEXT_COMPRESS_LEVEL)
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else zlib.decompress(value).decode("utf-8")
+
+class InvoiceRawTextDB(Base):
+    __tablename__ = "invoice_raw_texts"
+    invoice_id = Column(Integer, ForeignKey("invoices.id", ondelete="CASCADE"), primary_key=True)
+    content = Column(CompressedText, nullable=False)  # Text OCR gốc (nén)
+    raw_size = Column(Integer, nullable=False, default=0)  # Kích thước trước khi nén (byte UTF-8)
+
+def raw_text_values(raw_text: str) -> dict:
+    """Giá trị cột của invoice_raw_texts cho 1 raw_text (chưa có invoice_id)"""
+    return {"content": raw_text, "raw_size": len(raw_text.encode("utf-8"))}
+
+# Dùng trong select Core (search index, export): outerjoin invoice_raw_texts rồi pick_raw_text(row)
+RAW_TEXT_COLUMNS = (InvoiceRawTextDB.content.label("raw_text_content"), InvoiceDB.legacy_raw_text.label("raw_text_legacy"))
+
+def pick_raw_text(row) -> Optional[str]:
+    """raw_text của 1 dòng select có RAW_TEXT_COLUMNS (ưu tiên bản nén, chưa migrate thì lấy cột cũ)"""
+    return row.raw_text_content if row.raw_text_content is not None else row.raw_text_legacy
 
 class InvoiceItemDB(Base):
     __tablename__ = "invoice_items"
@@ -77,7 +310,167 @@ class InvoiceItemDB(Base):
     invoice = relationship("InvoiceDB", back_populates="items")
     category = relationship("ProductCategoryDB", back_populates="items")
 
-Base.metadata.create_all(bind=engine)
+class CategoryStatsDB(Base):
+    """Bảng tổng hợp thống kê theo danh mục, cập nhật cùng transaction khi tạo invoice"""
+    __tablename__ = "category_statistics"
+    category_id = Column(Integer, primary_key=True, autoincrement=False)  # 0 = chưa phân loại
+    total_items = Column(BigInteger, nullable=False, default=0)
+    total_amount = Column(BigInteger, nullable=False, default=0)
+    invoice_count = Column(BigInteger, nullable=False, default=0)  # Số hóa đơn khác nhau có item thuộc danh mục
+    updated_at = Column(DateTime, nullable=True)
+
+class IdempotencyKeyDB(Base):
+    """Response đã trả cho 1 Idempotency-Key: request gửi lại với cùng key được trả lại y nguyên, không ghi gì thêm"""
+    __tablename__ = "idempotency_keys"
+    key = Column(String(300), primary_key=True)  # "<path> <Idempotency-Key>"
+    request_hash = Column(String(64), nullable=False)  # sha256 body request: cùng key nhưng body khác = lỗi của client
+    status_code = Column(Integer, nullable=False)
+    response = Column(Text, nullable=False)  # Body JSON
+    created_at = Column(DateTime, nullable=False, index=True)
+
+# --- CATEGORY STATISTICS ---
+UNCATEGORIZED_STATS_KEY = 0  # Khóa chính không được NULL nên dùng 0 cho nhóm chưa phân loại
+
+def category_aggregates(db: Session, invoice_conditions: Optional[list] = None) -> dict:
+    """Tính thống kê trực tiếp bằng 1 query GROUP BY: {category_id: (số item, tổng tiền, số hóa đơn)}
+    invoice_conditions: điều kiện trên InvoiceDB (vd khoảng ngày), có thì join bảng invoices"""
+    query = db.query(
+        InvoiceItemDB.category_id,
+        func.count(InvoiceItemDB.id),
+        func.coalesce(func.sum(InvoiceItemDB.price), 0),
+        func.count(func.distinct(InvoiceItemDB.invoice_id)),
+    )
+    if invoice_conditions:
+        query = query.join(InvoiceDB, InvoiceItemDB.invoice_id == InvoiceDB.id).filter(*invoice_conditions)
+    rows = query.group_by(InvoiceItemDB.category_id).all()
+    return {category_id: (int(count), int(total), int(invoices)) for category_id, count, total, invoices in rows}
+
+def rebuild_category_stats(db: Session) -> int:
+    """Tính lại toàn bộ bảng category_statistics từ invoice_items (backfill / sửa lệch số liệu)"""
+    aggregates = category_aggregates(db)
+    now = datetime.datetime.utcnow()
+    db.query(CategoryStatsDB).delete(synchronize_session=False)
+    keys = [c.id for c in db.query(ProductCategoryDB.id).all()] + [UNCATEGORIZED_STATS_KEY]
+    for key in keys:
+        count, total, invoices = aggregates.get(key if key != UNCATEGORIZED_STATS_KEY else None, (0, 0, 0))
+        db.add(CategoryStatsDB(category_id=key, total_items=count, total_amount=total, invoice_count=invoices, updated_at=now))
+    db.commit()
+    return len(keys)
+
+def add_category_stats_delta(deltas: dict, item_rows: List[dict]) -> dict:
+    """Cộng item của 1 invoice mới vào deltas {category_id: (số item, tổng tiền, số hóa đơn)}"""
+    seen = set()
+    for item in item_rows:
+        key = item.get("category_id") or UNCATEGORIZED_STATS_KEY
+        count, total, invoices = deltas.get(key, (0, 0, 0))
+        # Invoice mới nên mỗi danh mục có mặt trong invoice tăng đúng 1 hóa đơn
+        deltas[key] = (count + 1, total + (item.get("price") or 0), invoices + (key not in seen))
+        seen.add(key)
+    return deltas
+
+def _upsert_category_stats(db: Session, values: dict):
+    """INSERT dòng thống kê, đã có (request khác vừa thêm cùng lúc) thì cộng dồn thay vì lỗi IntegrityError"""
+    table = CategoryStatsDB.__table__
+    added = {column: table.c[column] + values[column] for column in ("total_items", "total_amount", "invoice_count")}
+    if db.get_bind().dialect.name == "mysql":
+        stmt = mysql_insert(table).values(**values)
+        stmt = stmt.on_duplicate_key_update(**added, updated_at=stmt.inserted.updated_at)
+    else:
+        stmt = sqlite_insert(table).values(**values)
+        stmt = stmt.on_conflict_do_update(index_elements=[table.c.category_id], set_={**added, "updated_at": stmt.excluded.updated_at})
+    db.execute(stmt)
+
+def apply_category_stats(db: Session, deltas: dict):
+    """Ghi deltas vào bảng thống kê; gọi trước db.commit() để chung transaction với invoice"""
+    now = datetime.datetime.utcnow()
+    summary_built = None
+    for key, (count, total, invoices) in deltas.items():
+        updated = db.query(CategoryStatsDB).filter(CategoryStatsDB.category_id == key).update({
+            CategoryStatsDB.total_items: CategoryStatsDB.total_items + count,
+            CategoryStatsDB.total_amount: CategoryStatsDB.total_amount + total,
+            CategoryStatsDB.invoice_count: CategoryStatsDB.invoice_count + invoices,
+            CategoryStatsDB.updated_at: now,
+        }, synchronize_session=False)
+        if updated:
+            continue
+        # Chưa có dòng: chỉ thêm khi bảng đã được build, nếu không số liệu cũ sẽ bị thiếu -> chờ rebuild
+        if summary_built is None:
+            summary_built = db.query(CategoryStatsDB.category_id).filter(
+                CategoryStatsDB.category_id == UNCATEGORIZED_STATS_KEY).first() is not None
+        if summary_built:
+            _upsert_category_stats(db, {"category_id": key, "total_items": count, "total_amount": total,
+                                        "invoice_count": invoices, "updated_at": now})
+
+# --- CATEGORY REGISTRY ---
+class CategoryRegistry:
+    """Cache trong process cho bảng product_categories (nhỏ, hiếm khi đổi): nạp 1 lần, tra id -> danh mục từ RAM"""
+
+    def __init__(self, ttl: int = CATEGORY_CACHE_TTL, miss_reload_interval: float = CATEGORY_MISS_RELOAD_INTERVAL):
+        self.ttl = ttl
+        self.miss_reload_interval = miss_reload_interval
+        self._categories: Optional[dict] = None  # {id: {"id", "name", "description"}} theo thứ tự id
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "loads": 0}
+
+    def snapshot(self, db: Session) -> dict:
+        """Trả về dict id -> danh mục; chỉ query DB khi chưa nạp, đã bị invalidate hoặc quá TTL"""
+        categories = self._categories
+        if categories is not None and time.monotonic() - self._loaded_at < self.ttl:
+            self.stats["hits"] += 1
+            return categories
+        # Query ngoài lock: qua AsyncSession.run_sync, query nhường event loop cho request khác; giữ threading.Lock
+        # qua đó thì request thứ 2 cũng cần nạp sẽ chặn luôn event loop (deadlock). Nạp trùng 1 lần thì vô hại.
+        rows = db.query(ProductCategoryDB).order_by(ProductCategoryDB.id).all()
+        categories = {c.id: {"id": c.id, "name": c.name, "description": c.description} for c in rows}
+        with self._lock:
+            self._categories, self._loaded_at = categories, time.monotonic()
+            self.stats["loads"] += 1
+        logger.info(f"📚 Đã nạp {len(categories)} danh mục vào cache")
+        return categories
+
+    def all(self, db: Session) -> List[dict]:
+        return list(self.snapshot(db).values())
+
+    def _reload_on_miss(self, db: Session) -> dict:
+        """Gặp id không có trong cache: danh mục có thể vừa được thêm từ worker / script khác nên nạp lại 1 lần.
+        Đã nạp trong miss_reload_interval giây gần đây thì dùng bản hiện có: client gửi id sai liên tục không làm
+        mỗi request đều query lại DB"""
+        if self._categories is not None and time.monotonic() - self._loaded_at < self.miss_reload_interval:
+            return self.snapshot(db)
+        self.invalidate()
+        return self.snapshot(db)
+
+    def get(self, db: Session, category_id: Any) -> Optional[dict]:
+        try:
+            category_id = int(category_id)
+        except (TypeError, ValueError):
+            return None
+        category = self.snapshot(db).get(category_id)
+        if category is None:
+            category = self._reload_on_miss(db).get(category_id)
+        return category
+
+    def validate_ids(self, db: Session, category_ids) -> set:
+        """Kiểm tra một lần cả danh sách id, trả về tập id không tồn tại (có id lạ thì _reload_on_miss rồi kiểm tra lại)"""
+        category_ids = [category_id for category_id in category_ids if category_id]
+        missing = {category_id for category_id in category_ids if category_id not in self.snapshot(db)}
+        if missing:
+            known = self._reload_on_miss(db)
+            missing = {category_id for category_id in missing if category_id not in known}
+        return missing
+
+    def invalidate(self):
+        self._categories = None
+
+category_registry = CategoryRegistry()
+
+@event.listens_for(Session, "after_flush")  # Cả session sync lẫn session bên dưới AsyncSession
+def _invalidate_category_registry(session, flush_context):
+    # Có thêm/sửa/xóa danh mục qua ORM thì nạp lại ở lần đọc sau
+    if any(isinstance(obj, ProductCategoryDB) for obj in (*session.new, *session.dirty, *session.deleted)):
+        category_registry.invalidate()
+        response_cache.bump()
 
 # --- INITIALIZE CATEGORIES ---
 def init_categories():
@@ -119,14 +512,18 @@ def init_categories():
         
         db.commit()
         logger.info(f"✅ Đã tạo {len(categories_data)} danh mục sản phẩm")
+        # DB mới tạo: build luôn bảng thống kê để các invoice sau được cộng dồn
+        rebuild_category_stats(db)
     except Exception as e:
         db.rollback()
         logger.error(f"❌ Lỗi khởi tạo categories: {e}")
     finally:
         db.close()
 
-# Khởi tạo categories khi start server
-init_categories()
+def init_schema():
+    """Tạo các bảng còn thiếu + danh mục mẫu (chỉ chạy khi DB_CREATE_SCHEMA=true hoặc qua init_database.py)"""
+    Base.metadata.create_all(bind=engine)
+    init_categories()
 
 # --- SCHEMAS (Pydantic V2 - Auto Fix Data) ---
 # Đây là phần quan trọng nhất để sửa lỗi JSON input
@@ -134,6 +531,8 @@ init_categories()
 class ItemSchema(BaseModel):
     name: Optional[str] = "Unknown Item"
     price: Optional[int] = 0
+    quantity: Optional[int] = None  # Số lượng (parser OCR tách được thì có)
+    unit_price: Optional[int] = None  # Đơn giá
     category_id: Optional[int] = None  # ID của danh mục sản phẩm
 
     # Validator: Tự động xóa dấu chấm/phẩy trong giá tiền nếu lỡ gửi chuỗi
@@ -149,6 +548,17 @@ class ItemSchema(BaseModel):
             return int(v) if v >= 0 else 0
         return 0
     
+    @field_validator('quantity', 'unit_price', mode='before')
+    def clean_optional_number(cls, v):
+        if v is None:
+            return None
+        if isinstance(v, str):
+            clean = re.sub(r'[^\d]', '', v)
+            return int(clean) if clean else None
+        if isinstance(v, (int, float)):
+            return int(v) if v >= 0 else None
+        return None
+
     @field_validator('name', mode='before')
     def clean_name(cls, v):
         if v is None:
@@ -261,413 +671,2073 @@ class OcrInvoiceCreateSchema(BaseModel):
         return v
 
 # --- SERVICES ---
-class OCRService:
-    OCR_URL = "https://api.ocr.space/parse/image"
+class AsyncOCRClient:
+    """HTTP client bất đồng bộ dùng chung cho OCR: pool kết nối keep-alive + giới hạn số request song song"""
+
+    def __init__(self, max_concurrency: int = OCR_MAX_CONCURRENCY, pool_size: int = OCR_POOL_SIZE, timeout: float = OCR_TIMEOUT):
+        self.max_concurrency = max_concurrency
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self._client: Optional[httpx.AsyncClient] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    def _get_client(self) -> httpx.AsyncClient:
+        # Tạo lazily để client gắn với event loop đang chạy
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.timeout),
+                limits=httpx.Limits(max_connections=max(self.pool_size, self.max_concurrency), max_keepalive_connections=self.pool_size),
+            )
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._client
+
+    async def post(self, url: str, data: dict, files: dict, timeout: Optional[float] = None) -> httpx.Response:
+        client = self._get_client()
+        deadline = timeout if timeout is not None else self.timeout
+        # Deadline tính cả thời gian chờ slot trong semaphore
+        async def _send():
+            async with self._semaphore:
+                return await client.post(url, data=data, files=files)
+        return await asyncio.wait_for(_send(), timeout=deadline)
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+            self._semaphore = None
+
+ocr_client = AsyncOCRClient()
+
+class OcrResultCache:
+    """Cache kết quả phân tích hóa đơn theo hash nội dung file + backend OCR đã trả text (tên, engine, ngôn ngữ...).
+
+    Tầng 1: LRU trong RAM. Tầng 2 (tùy chọn): SQLite trên đĩa, giữ lại được sau khi restart.
+    """
+
+    def __init__(self, max_entries: int = OCR_CACHE_SIZE, ttl: int = OCR_CACHE_TTL,
+                 cache_dir: str = OCR_CACHE_DIR, disk_max_entries: int = OCR_CACHE_DISK_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.disk_max_entries = disk_max_entries
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk: Optional[sqlite3.Connection] = None
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0}
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            self._disk = sqlite3.connect(os.path.join(cache_dir, "ocr_cache.sqlite3"), check_same_thread=False)
+            self._disk.execute("CREATE TABLE IF NOT EXISTS ocr_cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL)")
+            self._disk.execute("CREATE INDEX IF NOT EXISTS idx_ocr_cache_created_at ON ocr_cache(created_at)")
+            self._disk.commit()
 
     @staticmethod
-    def process_image(file_bytes: bytes, filename: str) -> str:
-        if not file_bytes: return ""
-        payload = {'apikey': API_KEY, 'language': 'eng', 'isOverlayRequired': False, 'scale': True, 'OCREngine': 2}
-        files = {'file': (filename, file_bytes, 'image/png')}
+    def make_key(file_bytes: bytes, backend: str, preprocess: str = "") -> str:
+        # Hash file gốc (trước tiền xử lý): cache hit thì bỏ qua luôn bước xử lý ảnh
+        # backend = OCRBackend.cache_id của backend đã trả text, không phải cấu hình OCR toàn cục
+        digest = hashlib.sha256(file_bytes)
+        digest.update(f"|{backend}{preprocess}".encode())
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[dict]:
+        return self.get_any([key])
+
+    def get_any(self, keys: List[str]) -> Optional[dict]:
+        """Trả về kết quả của key đầu tiên còn trong cache (thống kê hit/miss tính 1 lần cho cả lượt tra)"""
+        now = time.time()
+        with self._lock:
+            for key in keys:
+                entry = self._memory.get(key)
+                if entry is not None:
+                    created_at, value = entry
+                    if now - created_at <= self.ttl:
+                        self._memory.move_to_end(key)
+                        self.stats["memory_hits"] += 1
+                        return value
+                    del self._memory[key]
+
+                if self._disk is not None:
+                    row = self._disk.execute("SELECT value, created_at FROM ocr_cache WHERE key = ?", (key,)).fetchone()
+                    if row and now - row[1] <= self.ttl:
+                        value = json.loads(row[0])
+                        self._put_memory(key, value, row[1])
+                        self.stats["disk_hits"] += 1
+                        return value
+
+            self.stats["misses"] += 1
+            return None
+
+    def set(self, key: str, value: dict):
+        now = time.time()
+        with self._lock:
+            self._put_memory(key, value, now)
+            if self._disk is not None:
+                self._disk.execute("INSERT OR REPLACE INTO ocr_cache (key, value, created_at) VALUES (?, ?, ?)",
+                                   (key, json.dumps(value, ensure_ascii=False), now))
+                # Dọn bản ghi hết hạn và giữ tổng số bản ghi dưới giới hạn
+                self._disk.execute("DELETE FROM ocr_cache WHERE created_at < ?", (now - self.ttl,))
+                self._disk.execute(
+                    "DELETE FROM ocr_cache WHERE key IN (SELECT key FROM ocr_cache ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                    (self.disk_max_entries,))
+                self._disk.commit()
+
+    def _put_memory(self, key: str, value: dict, created_at: float):
+        self._memory[key] = (created_at, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            hits = self.stats["memory_hits"] + self.stats["disk_hits"]
+            total = hits + self.stats["misses"]
+            return {
+                **self.stats,
+                "memory_entries": len(self._memory),
+                "disk_enabled": self._disk is not None,
+                "hit_ratio": hits / total if total else 0.0,
+            }
+
+ocr_cache = OcrResultCache()
+
+class ResponseCache:
+    """Cache body response GET trong RAM (LRU) theo path + query, kèm ETag mạnh (hash nội dung).
+
+    Mọi lần ghi dữ liệu (tạo invoice, bulk, đổi danh mục) tăng version: entry của version cũ coi như hết hạn.
+    Version chỉ có trong process nên thêm TTL để giới hạn độ cũ khi worker / script khác ghi DB.
+    """
+
+    def __init__(self, max_entries: int = RESPONSE_CACHE_MAX_ENTRIES, ttl: int = RESPONSE_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.version = 0
+        self._entries: OrderedDict = OrderedDict()  # key -> (version, stored_at, etag, status, headers, body)
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "not_modified": 0}
+
+    @staticmethod
+    def make_key(scope: dict) -> str:
+        query = "&".join(sorted(scope.get("query_string", b"").decode("latin-1").split("&")))
+        return f"{scope['path']}?{query}"
+
+    @staticmethod
+    def make_etag(body: bytes) -> str:
+        return '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+
+    def bump(self):
+        with self._lock:
+            self.version += 1
+
+    def get(self, key: str) -> Optional[tuple]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != self.version or time.monotonic() - entry[1] >= self.ttl:
+                self.stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry
+
+    def set(self, key: str, version: int, etag: str, status_code: int, headers: list, body: bytes):
+        with self._lock:
+            if version != self.version:
+                return  # Dữ liệu đã đổi trong lúc tính response
+            self._entries[key] = (version, time.monotonic(), etag, status_code, headers, body)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+response_cache = ResponseCache()
+
+class OcrJobQueue:
+    """Hàng đợi job OCR trong process: nhận file, trả job id ngay, worker nền chạy OCR + parse"""
+
+    def __init__(self, handler: Callable[[bytes, str], Awaitable[dict]], workers: int = JOB_WORKERS,
+                 maxsize: int = JOB_QUEUE_MAXSIZE, retention: int = JOB_RETENTION_SECONDS, max_tracked: int = JOB_MAX_TRACKED):
+        self.handler = handler
+        self.workers = workers
+        self.maxsize = max(1, maxsize)  # asyncio.Queue(maxsize=0) là không giới hạn
+        self.retention = max(0, retention)
+        self.max_tracked = max(self.maxsize + workers, max_tracked)  # Luôn đủ chỗ cho job đang chờ + đang chạy
+        self.jobs: dict = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+
+    def start(self):
+        self._queue = asyncio.Queue(maxsize=self.maxsize)
+        self._tasks = [asyncio.create_task(self._worker(n)) for n in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._janitor()))
+        logger.info(f"👷 Đã khởi động {self.workers} OCR worker (queue tối đa {self.maxsize})")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, content: bytes, filename: str) -> dict:
+        """Đưa file vào hàng đợi; raise asyncio.QueueFull nếu hàng đợi đầy hoặc đã giữ max_tracked job"""
+        if len(self.jobs) >= self.max_tracked:
+            self._evict_finished()
+            if len(self.jobs) >= self.max_tracked:
+                raise asyncio.QueueFull
+        job_id = uuid.uuid4().hex
+        job = {"id": job_id, "filename": filename, "status": "queued", "created_at": time.time(),
+               "started_at": None, "finished_at": None, "result": None, "error": None}
+        self._queue.put_nowait((job_id, content))
+        self.jobs[job_id] = job
+        return job
+
+    def get(self, job_id: str) -> Optional[dict]:
+        return self.jobs.get(job_id)
+
+    def stats(self) -> dict:
+        return {"workers": self.workers, "queue_depth": self._queue.qsize() if self._queue else 0,
+                "queue_maxsize": self.maxsize, "jobs": len(self.jobs), "jobs_max": self.max_tracked}
+
+    async def _worker(self, number: int):
+        while True:
+            job_id, content = await self._queue.get()
+            job = self.jobs.get(job_id)
+            if job is None:
+                self._queue.task_done()
+                continue
+            job["status"] = "running"
+            job["started_at"] = time.time()
+            try:
+                job["result"] = await self.handler(content, job["filename"])
+                job["status"] = "done"
+            except Exception as e:
+                logger.error(f"❌ Job {job_id} lỗi: {e}")
+                job["status"] = "failed"
+                job["error"] = str(e)
+            finally:
+                job["finished_at"] = time.time()
+                self._queue.task_done()
+
+    def _evict_finished(self):
+        """Đủ max_tracked job: bỏ bớt job đã xong cũ nhất (10%) trước hạn retention để nhận job mới"""
+        finished = [job_id for job_id, job in self.jobs.items() if job["finished_at"] is not None]
+        for job_id in finished[:max(1, self.max_tracked // 10)]:
+            self.jobs.pop(job_id, None)
+
+    async def _janitor(self):
+        # Xóa job đã xong quá thời gian lưu giữ (tối thiểu 1 giây / lần: retention=0 không thành vòng lặp bận)
+        while True:
+            await asyncio.sleep(max(1, min(60, self.retention)))
+            cutoff = time.time() - self.retention
+            expired = [job_id for job_id, job in self.jobs.items()
+                       if job["finished_at"] is not None and job["finished_at"] < cutoff]
+            for job_id in expired:
+                self.jobs.pop(job_id, None)
+
+class OCRBackendError(Exception):
+    """Lỗi từ một OCR backend (timeout, HTTP lỗi, API báo lỗi xử lý...)"""
+
+class OCRBackend(ABC):
+    """Interface chung cho các OCR engine: nhận bytes ảnh (kèm MIME thật của file), trả về text.
+    Lớp con thiếu recognize sẽ lỗi ngay lúc khởi tạo (TypeError), không đợi tới request OCR đầu tiên."""
+    name = "base"
+
+    @property
+    def cache_id(self) -> str:
+        """Định danh cấu hình backend trong key cache OCR: cùng file + cùng cache_id thì cho cùng text"""
+        return self.name
+
+    @abstractmethod
+    async def recognize(self, file_bytes: bytes, filename: str, timeout: Optional[float] = None,
+                        content_type: str = "image/png") -> str:
+        ...
+
+class OcrSpaceBackend(OCRBackend):
+    """OCR qua API ocr.space"""
+
+    def __init__(self, name: str = "ocrspace", url: str = OCR_API_URL, api_key: str = API_KEY,
+                 engine: int = OCR_ENGINE, language: str = OCR_LANGUAGE, scale: bool = OCR_SCALE):
+        self.name = name
+        self.url = url
+        self.api_key = api_key
+        self.engine = engine
+        self.language = language
+        self.scale = scale
+
+    @property
+    def cache_id(self) -> str:
+        return f"{self.name}|{self.engine}|{self.language}|{self.scale}"
+
+    async def recognize(self, file_bytes: bytes, filename: str, timeout: Optional[float] = None,
+                        content_type: str = "image/png") -> str:
+        payload = {'apikey': self.api_key, 'language': self.language, 'isOverlayRequired': False, 'scale': self.scale, 'OCREngine': self.engine}
+        files = {'file': (filename, file_bytes, content_type)}
         try:
-            logger.info("📡 Gọi API OCR...")
-            response = requests.post(OCRService.OCR_URL, files=files, data=payload, timeout=20)
+            response = await ocr_client.post(self.url, data=payload, files=files, timeout=timeout)
+            response.raise_for_status()
             result = response.json()
-            if result.get("IsErroredOnProcessing"): return ""
-            parsed = result.get("ParsedResults")
-            if parsed and parsed[0].get("ParsedText"):
-                return parsed[0].get("ParsedText")
-            return ""
-        except Exception:
+        except asyncio.TimeoutError:
+            raise OCRBackendError(f"{self.name}: quá thời gian chờ")
+        except (httpx.HTTPError, ValueError) as e:
+            raise OCRBackendError(f"{self.name}: {e}")
+        if result.get("IsErroredOnProcessing"):
+            raise OCRBackendError(f"{self.name}: {result.get('ErrorMessage')}")
+        # PDF gửi nguyên file (không tách trang được): mỗi trang 1 phần tử, nối lại theo thứ tự
+        return "\n".join(page.get("ParsedText") or "" for page in result.get("ParsedResults") or []).strip("\n")
+
+class StubOCRBackend(OCRBackend):
+    """Engine giả lập: trả lại text đã ghi sẵn trong thư mục fixtures, không cần mạng.
+
+    Tìm lần lượt <sha256 của file>.txt, <tên file>.txt rồi default.txt.
+    """
+    name = "stub"
+
+    def __init__(self, fixtures_dir: str = OCR_STUB_FIXTURES_DIR, latency: float = OCR_STUB_LATENCY):
+        self.fixtures_dir = fixtures_dir
+        self.latency = latency
+
+    @staticmethod
+    def record(fixtures_dir: str, file_bytes: bytes, text: str):
+        os.makedirs(fixtures_dir, exist_ok=True)
+        path = os.path.join(fixtures_dir, f"{hashlib.sha256(file_bytes).hexdigest()}.txt")
+        with open(path, "w", encoding="utf-8", newline="") as f:
+            f.write(text)
+
+    async def recognize(self, file_bytes: bytes, filename: str, timeout: Optional[float] = None,
+                        content_type: str = "image/png") -> str:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        candidates = [hashlib.sha256(file_bytes).hexdigest(), os.path.splitext(os.path.basename(filename or ""))[0], "default"]
+        for candidate in candidates:
+            path = os.path.join(self.fixtures_dir, f"{candidate}.txt")
+            if candidate and os.path.isfile(path):
+                with open(path, encoding="utf-8", newline="") as f:
+                    return f.read()
+        raise OCRBackendError(f"{self.name}: không có fixture cho {filename}")
+
+# Đăng ký backend theo tên; engine tự host chỉ cần thêm 1 factory vào đây
+OCR_BACKENDS: dict = {
+    "ocrspace": lambda: OcrSpaceBackend(),
+    "ocrspace_alt": lambda: OcrSpaceBackend(name="ocrspace_alt", api_key=OCR_ALT_API_KEY, engine=OCR_ALT_ENGINE),
+    "stub": lambda: StubOCRBackend(),
+}
+
+def build_ocr_backend(name: str) -> OCRBackend:
+    if name not in OCR_BACKENDS:
+        raise ValueError(f"OCR backend không hợp lệ: {name} (có: {', '.join(OCR_BACKENDS)})")
+    return OCR_BACKENDS[name]()
+
+class HedgedOCR:
+    """Gọi backend chính; nếu quá độ trễ p95 mà chưa có kết quả thì bắn thêm backend phụ, lấy kết quả nào về trước"""
+
+    def __init__(self, primary: OCRBackend, secondary: Optional[OCRBackend] = None,
+                 default_delay: float = OCR_HEDGE_DEFAULT_DELAY, min_delay: float = OCR_HEDGE_MIN_DELAY,
+                 min_samples: int = OCR_HEDGE_MIN_SAMPLES):
+        self.primary = primary
+        self.secondary = secondary
+        self.default_delay = default_delay
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self.latencies = deque(maxlen=500)  # Độ trễ các lần gọi backend chính thành công
+        self.stats = {"calls": 0, "hedged": 0, "secondary_wins": 0}
+
+    def hedge_delay(self) -> float:
+        if len(self.latencies) < self.min_samples:
+            return self.default_delay
+        ordered = sorted(self.latencies)
+        p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+        return max(self.min_delay, p95)
+
+    async def _timed_primary(self, file_bytes: bytes, filename: str, timeout: Optional[float], content_type: str) -> str:
+        started = time.perf_counter()
+        text = await self.primary.recognize(file_bytes, filename, timeout, content_type)
+        self.latencies.append(time.perf_counter() - started)
+        return text
+
+    @property
+    def cache_ids(self) -> List[str]:
+        """cache_id các backend có thể trả kết quả, theo thứ tự ưu tiên khi tra cache"""
+        return [self.primary.cache_id] + ([self.secondary.cache_id] if self.secondary is not None else [])
+
+    async def recognize(self, file_bytes: bytes, filename: str, timeout: Optional[float] = None,
+                        content_type: str = "image/png") -> tuple:
+        """Trả về (text, backend đã trả text): backend chính, hoặc backend phụ nếu hedge về trước"""
+        self.stats["calls"] += 1
+        primary = asyncio.create_task(self._timed_primary(file_bytes, filename, timeout, content_type))
+        if self.secondary is None:
+            return await primary, self.primary
+
+        done, _ = await asyncio.wait({primary}, timeout=self.hedge_delay())
+        if done and primary.exception() is None:
+            return primary.result(), self.primary
+
+        # Backend chính chậm hoặc lỗi -> gọi thêm backend phụ
+        self.stats["hedged"] += 1
+        logger.info(f"🔀 Hedge OCR sang {self.secondary.name}")
+        secondary = asyncio.create_task(self.secondary.recognize(file_bytes, filename, timeout, content_type))
+        pending = {secondary} if done else {primary, secondary}
+        last_error: Optional[BaseException] = primary.exception() if done else None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is secondary:
+                            self.stats["secondary_wins"] += 1
+                            return task.result(), self.secondary
+                        return task.result(), self.primary
+                    last_error = task.exception()
+            raise last_error
+        finally:
+            for task in pending:
+                task.cancel()
+
+class OCRService:
+    engine = HedgedOCR(build_ocr_backend(OCR_BACKEND), build_ocr_backend(OCR_HEDGE_BACKEND) if OCR_HEDGE_BACKEND else None)
+
+    @staticmethod
+    async def recognize_with_backend(file_bytes: bytes, filename: str, timeout: Optional[float] = None,
+                                     content_type: Optional[str] = None) -> tuple:
+        """OCR một file, trả về (text, backend đã trả text); raise OCRBackendError nếu mọi backend đều lỗi.
+        Không truyền content_type thì lấy theo magic bytes của file"""
+        if not file_bytes: return "", OCRService.engine.primary
+        logger.info("📡 Gọi API OCR...")
+        OCR_UPLOAD_BYTES.observe(len(file_bytes))
+        start, outcome = time.perf_counter(), "error"
+        try:
+            text, backend = await OCRService.engine.recognize(file_bytes, filename, timeout, content_type or content_type_for(file_bytes))
+            outcome = "ok"
+        finally:
+            OCR_LATENCY.observe(time.perf_counter() - start, (OCRService.engine.primary.name, outcome))
+        if text and OCR_RECORD_FIXTURES_DIR:
+            StubOCRBackend.record(OCR_RECORD_FIXTURES_DIR, file_bytes, text)
+        return text, backend
+
+    @staticmethod
+    async def recognize(file_bytes: bytes, filename: str, timeout: Optional[float] = None,
+                        content_type: Optional[str] = None) -> str:
+        """Như recognize_with_backend nhưng chỉ trả text"""
+        text, _ = await OCRService.recognize_with_backend(file_bytes, filename, timeout, content_type)
+        return text
+
+    @staticmethod
+    async def process_image(file_bytes: bytes, filename: str, timeout: Optional[float] = None) -> str:
+        """Giữ hành vi cũ: trả về chuỗi rỗng khi OCR lỗi"""
+        try:
+            return await OCRService.recognize(file_bytes, filename, timeout)
+        except OCRBackendError as e:
+            logger.warning(f"⚠️  OCR lỗi: {e}")
             return ""
 
-class InvoiceParserService:
+class ImagePreprocessor:
+    """Chạy preprocess_image trong thread pool riêng: giải mã / resize / nén của Pillow nhả GIL nên chạy song song được,
+    pool riêng giới hạn số ảnh xử lý cùng lúc và không chiếm thread pool mặc định (to_thread của DB / cache)"""
+
+    def __init__(self, workers: int = OCR_PREPROCESS_WORKERS, enabled: bool = OCR_PREPROCESS_ENABLED):
+        self.workers = workers
+        self.enabled = enabled and Image is not None
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    @property
+    def cache_suffix(self) -> str:
+        """Phần thêm vào key cache OCR: đổi cấu hình xử lý ảnh thì kết quả OCR cũ không dùng lại"""
+        return f"|{OCR_IMAGE_MAX_SIDE}|{OCR_IMAGE_GRAYSCALE}|{OCR_IMAGE_QUALITY}" if self.enabled else ""
+
+    async def _run_in_pool(self, func, *args):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="ocr-preprocess")
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def run(self, content: bytes, filename: str) -> PreparedImage:
+        if not self.enabled:
+            fmt = detect_format(content)
+            return PreparedImage(content, filename, content_type_for(content), fmt or "unknown", "passthrough")
+        start = time.perf_counter()
+        prepared = await self._run_in_pool(preprocess_image, content, filename, OCR_IMAGE_MAX_SIDE, OCR_IMAGE_GRAYSCALE, OCR_IMAGE_QUALITY)
+        elapsed = time.perf_counter() - start
+        OCR_PREPROCESS_LATENCY.observe(elapsed, (prepared.format, prepared.action))
+        OCR_PREPROCESS_BYTES.inc(len(content), ("input",))
+        OCR_PREPROCESS_BYTES.inc(len(prepared.content), ("output",))
+        if prepared.action != "passthrough":
+            logger.info(f"🖼️  Ảnh {prepared.format} {len(content) / 1024:.0f}KB -> {len(prepared.content) / 1024:.0f}KB "
+                        f"({prepared.action}, {elapsed * 1000:.0f}ms)")
+        return prepared
+
+    async def split_pages(self, prepared: PreparedImage) -> List[PreparedImage]:
+        """PDF -> danh sách PDF 1 trang theo thứ tự; ảnh thì [prepared]"""
+        if prepared.format != "pdf":
+            return [prepared]
+        return await self._run_in_pool(split_pdf_pages, prepared, OCR_PDF_MAX_PAGES)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+image_preprocessor = ImagePreprocessor()
+
+# --- LIFECYCLE ---
+_readiness = {"ready": False, "error": None, "warmup_ms": None, "attempts": 0}
+_warmup_lock = asyncio.Lock()
+
+def _error_summary(e: Exception) -> str:
+    return (str(e).splitlines() or [type(e).__name__])[0]
+
+async def _ping_database():
+    async with async_engine.connect() as conn:
+        await conn.execute(text("SELECT 1"))
+
+async def warm_up() -> bool:
+    """Mở sẵn kết nối trong pool + nạp cache danh mục; lỗi thì app vẫn chạy, /readyz trả 503 và thử lại"""
+    attempt = _readiness["attempts"]
+    async with _warmup_lock:
+        if _readiness["ready"] or _readiness["attempts"] != attempt:
+            return _readiness["ready"]  # Lần thử khác vừa xong trong lúc chờ lock: dùng luôn kết quả
+        start = time.perf_counter()
+        try:
+            # Mở song song để pool giữ lại DB_POOL_WARM kết nối cho các request đầu tiên
+            await asyncio.wait_for(asyncio.gather(*(_ping_database() for _ in range(max(DB_POOL_WARM, 1)))), READINESS_TIMEOUT)
+            async with AsyncSessionLocal() as db:
+                await asyncio.wait_for(db.run_sync(category_registry.snapshot), READINESS_TIMEOUT)
+            _readiness.update(ready=True, error=None, warmup_ms=round((time.perf_counter() - start) * 1000, 1))
+            logger.info(f"✅ Database sẵn sàng (warm-up {_readiness['warmup_ms']}ms)")
+        except (SQLAlchemyError, OSError, asyncio.TimeoutError) as e:
+            _readiness.update(ready=False, error=_error_summary(e))
+            logger.warning(f"⚠️  Warm-up database lỗi, /readyz sẽ thử lại: {_readiness['error']}")
+        _readiness["attempts"] += 1
+        return _readiness["ready"]
+
+async def build_search_index():
+    """Dựng index tìm kiếm ở nền (thread) để request /search đầu tiên không phải chờ; lỗi chỉ log, /search sẽ thử lại.
+    Không tính vào readiness: DB lớn dựng index lâu, /readyz báo ready trước và trả search_index_built=false tới khi xong
+    (trong lúc đó /search trả 503 "Index tìm kiếm chưa sẵn sàng")"""
+    try:
+        await asyncio.to_thread(sync_search_index)  # Lỗi DB đã được log trong sync_search_index
+    except Exception as e:
+        logger.error(f"❌ Dựng search index lỗi: {e}")
+        logger.error(f"❌ Full traceback: {traceback.format_exc()}")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Không làm gì với DB lúc import: mọi kết nối / tạo bảng / nạp cache đều nằm ở đây
+    if DB_CREATE_SCHEMA:
+        await asyncio.to_thread(init_schema)
+    job_queue.start()
+    warmup = asyncio.create_task(warm_up())  # Không chặn startup: /healthz trả lời ngay, /readyz chờ warm-up
+    background = [warmup]
+    if SEARCH_INDEX_ENABLED:
+        background.append(asyncio.create_task(build_search_index()))
+    yield
+    # Thread đang dựng index không hủy được: chỉ bỏ chờ, executor mặc định đợi nó xong khi event loop đóng
+    for task in background:
+        task.cancel()
+    await asyncio.gather(*background, return_exceptions=True)
+    await job_queue.stop()
+    await ocr_client.aclose()
+    image_preprocessor.shutdown()
+    await async_engine.dispose()
+
+class MetricsMiddleware:
+    """ASGI middleware đo latency theo route template (không theo path thật để giữ ít series) + số request đang chạy"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        method, status_code = scope["method"], [500]
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status_code[0] = message["status"]
+            await send(message)
+
+        HTTP_IN_FLIGHT.inc(labels=(method,))
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            HTTP_IN_FLIGHT.dec(labels=(method,))
+            route = getattr(scope.get("route"), "path", "unmatched")
+            HTTP_LATENCY.observe(time.perf_counter() - start, (method, route))
+            HTTP_REQUESTS.inc(labels=(method, route, str(status_code[0])))
+
+class SqlProfilerMiddleware:
+    """Gắn SqlProfile vào request (ContextVar), trả tóm tắt qua header X-SQL-Profile, log khi nghi N+1 / vượt ngân sách.
+
+    Với response streaming, header chỉ tính các query chạy trước khi gửi header; log cuối request thì đủ.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        profile = SqlProfile()
+        token = current_sql_profile.set(profile)
+
+        async def send_with_profile(message):
+            if message["type"] == "http.response.start":
+                header = profile.header_value(SQL_N_PLUS_ONE_THRESHOLD)
+                message["headers"] = [*message.get("headers", []), (PROFILE_HEADER.lower().encode(), header.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_profile)
+        finally:
+            current_sql_profile.reset(token)
+            route = getattr(scope.get("route"), "path", scope["path"])
+            logger.info(f"🧮 {scope['method']} {route}: {profile.queries} query, {profile.db_time * 1000:.1f}ms DB")
+            for shape, count in profile.repeated(SQL_N_PLUS_ONE_THRESHOLD):
+                logger.warning(f"🔁 Nghi N+1 ở {scope['method']} {route}: {count} lần {shape[:300]}")
+            if SQL_QUERY_BUDGET and profile.queries > SQL_QUERY_BUDGET:
+                logger.warning(f"💸 {scope['method']} {route}: {profile.queries} query > ngân sách {SQL_QUERY_BUDGET} "
+                               f"({profile.db_time * 1000:.1f}ms DB)")
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+class ResponseCacheMiddleware:
+    """Cache GET của các endpoint dashboard: hit trả từ RAM (0 query), If-None-Match khớp ETag trả 304 không body.
+
+    Miss thì gom body (kể cả StreamingResponse) để tính ETag. Body vượt RESPONSE_CACHE_MAX_ENTRY_BYTES hoặc response khác 200
+    thì ngừng gom: gửi phần đã gom rồi stream thẳng phần còn lại, không ETag (báo cáo lớn không bao giờ nằm trọn trong RAM).
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        path = scope.get("path", "")
+        if scope["type"] != "http" or scope["method"] != "GET" or not any(
+                path == prefix or path.startswith(prefix + "/") for prefix in RESPONSE_CACHE_PATHS):
+            return await self.app(scope, receive, send)
+        if_none_match = next((v.decode("latin-1") for k, v in scope["headers"] if k == b"if-none-match"), "")
+        key = ResponseCache.make_key(scope)
+        entry = response_cache.get(key)
+        if entry is not None:
+            _, _, etag, status_code, headers, body = entry
+            return await self._respond(send, status_code, headers, etag, body, if_none_match, "HIT")
+
+        version = response_cache.version
+        start, chunks, size, passthrough = None, [], 0, False
+
+        async def capture(message):
+            nonlocal start, size, passthrough
+            if message["type"] == "http.response.start":
+                start = message
+                return
+            if message["type"] != "http.response.body":
+                return await send(message)
+            if passthrough:
+                return await send(message)
+            chunks.append(message.get("body", b""))
+            size += len(chunks[-1])
+            if start["status"] != 200 or size > RESPONSE_CACHE_MAX_ENTRY_BYTES:
+                # Không cache, không ETag: gửi header gốc + phần đã gom rồi chuyển sang stream thẳng
+                passthrough = True
+                await send(start)
+                await send({"type": "http.response.body", "body": b"".join(chunks), "more_body": message.get("more_body", False)})
+                chunks.clear()
+
+        await self.app(scope, receive, capture)
+        if passthrough or start is None:
+            return
+        body = b"".join(chunks)
+        headers = [(k, v) for k, v in start["headers"] if k not in (b"content-length", b"etag", b"cache-control")]
+        etag = ResponseCache.make_etag(body)
+        response_cache.set(key, version, etag, start["status"], headers, body)
+        await self._respond(send, start["status"], headers, etag, body, if_none_match, "MISS")
+
     @staticmethod
-    def parse_money(text: str) -> int:
-        if not text: return 0
-        clean_text = re.sub(r'[^\d]', '', text)
-        try: return int(clean_text)
-        except ValueError: return 0
+    async def _respond(send, status_code: int, headers: list, etag: str, body: bytes, if_none_match: str, cache_status: str):
+        # no-cache: trình duyệt vẫn giữ bản cũ nhưng luôn hỏi lại bằng If-None-Match
+        common = [(b"etag", etag.encode()), (b"cache-control", b"no-cache"), (b"x-cache", cache_status.encode())]
+        if if_none_match and _etag_matches(if_none_match, etag):
+            response_cache.stats["not_modified"] += 1
+            await send({"type": "http.response.start", "status": 304, "headers": common})
+            await send({"type": "http.response.body", "body": b""})
+            return
+        await send({"type": "http.response.start", "status": status_code,
+                    "headers": [*headers, *common, (b"content-length", str(len(body)).encode())]})
+        await send({"type": "http.response.body", "body": body})
 
-    @classmethod
-    def parse(cls, raw_text: str) -> dict:
-        default_res = {"merchant_name": "Unknown", "date": "", "items": [], "total_amount": 0, "raw_text": raw_text}
-        if not raw_text: return default_res
+class FastJSONResponse(JSONResponse):
+    """JSON encode bằng orjson: nhanh hơn json.dumps nhiều lần, ra thẳng bytes UTF-8.
 
-        lines = [line.strip() for line in raw_text.split('\r\n') if line.strip()]
-        if not lines: return default_res
+    Endpoint trả dữ liệu lớn có shape cố định (dict / list thuần) thì return FastJSONResponse(...) trực tiếp
+    để bỏ qua jsonable_encoder của FastAPI (duyệt lại toàn bộ dữ liệu).
+    """
 
-        default_res["merchant_name"] = lines[0]
-        
-        # Tìm ngày
-        date_match = re.search(r'\b\d{1,2}[/-]\d{1,2}[/-]\d{4}\b', raw_text)
-        if date_match: default_res["date"] = date_match.group(0)
-
-        # Tìm items
-        items = []
-        total_amount = 0
-        for line in lines:
-            match = re.search(r'(.+?)[\s\.:]+([\d,.]+)$', line)
-            if match:
-                name = match.group(1).strip()
-                price_str = match.group(2)
-                price = cls.parse_money(price_str)
-                if price > 0 and len(name) > 2:
-                    items.append({"name": name, "price": price})
-                    total_amount += price  # Tổng tất cả items
-        
-        default_res["items"] = items
-        default_res["total_amount"] = total_amount  # Tổng tiền = tổng tất cả items
-        return default_res
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
+COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "text/")
+
+def negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    """Chọn content-encoding theo Accept-Encoding (có q-value): ưu tiên br (nếu cài brotli) rồi gzip"""
+    accepted = {}
+    for part in accept_encoding.lower().split(","):
+        name, _, params = part.strip().partition(";")
+        try:
+            accepted[name.strip()] = float(params.strip()[2:]) if params.strip().startswith("q=") else 1.0
+        except ValueError:
+            continue
+    for encoding in (["br"] if brotli is not None else []) + ["gzip"]:
+        if accepted.get(encoding, accepted.get("*", 0)) > 0:
+            return encoding
+    return None
+
+class _StreamCompressor:
+    """Nén từng chunk; mỗi chunk được flush để client nhận dần (NDJSON / JSON stream) thay vì chờ hết response"""
+
+    def __init__(self, encoding: str):
+        if encoding == "br":
+            self._brotli = brotli.Compressor(quality=COMPRESS_BROTLI_QUALITY)
+        else:
+            self._brotli = None
+            self._gzip = zlib.compressobj(COMPRESS_GZIP_LEVEL, zlib.DEFLATED, 31)  # wbits=31 -> định dạng gzip
+
+    def compress(self, data: bytes, final: bool) -> bytes:
+        if self._brotli is not None:
+            return self._brotli.process(data) + (self._brotli.finish() if final else self._brotli.flush())
+        return self._gzip.compress(data) + self._gzip.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+class CompressionMiddleware:
+    """Nén br / gzip theo Accept-Encoding cho JSON / NDJSON / text lớn hơn COMPRESS_MIN_SIZE (kể cả response stream).
+
+    ETag của bản nén đổi thành weak (W/...) vì bytes khác bản gốc; If-None-Match so sánh weak nên 304 vẫn hoạt động.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        accept_encoding = next((v.decode("latin-1") for k, v in scope["headers"] if k == b"accept-encoding"), "")
+        encoding = negotiate_encoding(accept_encoding) if accept_encoding else None
+        if encoding is None:
+            return await self.app(scope, receive, send)
+
+        start, compressor, passthrough = None, None, False
+
+        async def send_compressed(message):
+            nonlocal start, compressor, passthrough
+            if message["type"] == "http.response.start":
+                start = message
+                return
+            if message["type"] != "http.response.body" or passthrough:
+                return await send(message)
+            body, more_body = message.get("body", b""), message.get("more_body", False)
+            if compressor is None:
+                # Body đầu tiên: quyết định nén hay không (response 1 message nhỏ thì gửi thẳng)
+                headers = MutableHeaders(raw=start["headers"])
+                compressible = headers.get("content-type", "").startswith(COMPRESSIBLE_TYPES)
+                if compressible:
+                    headers.add_vary_header("Accept-Encoding")
+                if (not compressible or "content-encoding" in headers or start["status"] in (204, 304)
+                        or (not more_body and len(body) < COMPRESS_MIN_SIZE)):
+                    passthrough = True
+                    await send(start)
+                    return await send(message)
+                compressor = _StreamCompressor(encoding)
+                headers["content-encoding"] = encoding
+                if "content-length" in headers:
+                    del headers["content-length"]
+                if not headers.get("etag", "W/").startswith("W/"):
+                    headers["etag"] = "W/" + headers["etag"]
+                if not more_body:
+                    data = compressor.compress(body, final=True)
+                    headers["content-length"] = str(len(data))
+                    await send(start)
+                    return await send({"type": "http.response.body", "body": data})
+                await send(start)
+            await send({"type": "http.response.body", "body": compressor.compress(body, final=not more_body), "more_body": more_body})
+
+        await self.app(scope, receive, send_compressed)
 
 # --- API ---
-app = FastAPI()
-app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
+app = FastAPI(lifespan=lifespan, default_response_class=FastJSONResponse)
+if RESPONSE_CACHE_ENABLED:
+    app.add_middleware(ResponseCacheMiddleware)  # Nằm trong CORS để response từ cache vẫn có header CORS
+if COMPRESS_ENABLED:
+    app.add_middleware(CompressionMiddleware)  # Bên ngoài cache: cache giữ bản gốc, nén theo từng client
+app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"], expose_headers=["X-Next-Cursor", "ETag", "X-Cache", PROFILE_HEADER])
+if SQL_PROFILE_ENABLED:
+    app.add_middleware(SqlProfilerMiddleware)
+if METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
 
-def get_db():
-    db = SessionLocal()
-    try: yield db
-    finally: db.close()
+@app.get("/healthz")
+async def healthz():
+    """Liveness: process còn phục vụ request, không chạm DB"""
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz(response: Response):
+    """Readiness: DB trả lời được + cache đã nạp; 503 khi chưa sẵn sàng để load balancer chưa đẩy traffic vào.
+    Index tìm kiếm dựng ở nền, không chặn readiness: search_index_built=false nghĩa là /search tạm trả 503"""
+    ready = _readiness["ready"]
+    if ready:
+        try:
+            await asyncio.wait_for(_ping_database(), READINESS_TIMEOUT)
+        except (SQLAlchemyError, OSError, asyncio.TimeoutError) as e:
+            _readiness.update(ready=False, error=_error_summary(e))
+            ready = False
+    else:
+        ready = await warm_up()
+    if not ready:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    return {"status": "ready" if ready else "not_ready", "database": _readiness["error"] or "ok",
+            "warmup_ms": _readiness["warmup_ms"], "search_index_built": _search_state["built"]}
+
+def _queue_pools():
+    return [(label, pool) for label, pool in (("sync", engine.pool), ("async", async_engine.sync_engine.pool))
+            if isinstance(pool, QueuePool)]
+
+def _pool_samples():
+    for label, pool in _queue_pools():
+        yield (label, "checked_out"), pool.checkedout()
+        yield (label, "idle"), pool.checkedin()
+        yield (label, "overflow"), max(pool.overflow(), 0)
+
+def _pool_utilisation_samples():
+    for label, pool in _queue_pools():
+        capacity = pool.size() + max(pool._max_overflow, 0)
+        yield (label,), pool.checkedout() / capacity if capacity else 0.0
+
+def _cache_samples():
+    cache = ocr_cache.snapshot()
+    yield ("ocr", "hit"), cache["memory_hits"] + cache["disk_hits"]
+    yield ("ocr", "miss"), cache["misses"]
+    yield ("category", "hit"), category_registry.stats["hits"]
+    yield ("category", "miss"), category_registry.stats["loads"]
+    yield ("response", "hit"), response_cache.stats["hits"]
+    yield ("response", "miss"), response_cache.stats["misses"]
+    yield ("response", "not_modified"), response_cache.stats["not_modified"]
+
+def _hit_ratio_samples():
+    cache = ocr_cache.snapshot()
+    yield ("ocr",), cache["hit_ratio"]
+    lookups = category_registry.stats["hits"] + category_registry.stats["loads"]
+    yield ("category",), category_registry.stats["hits"] / lookups if lookups else 0.0
+    lookups = response_cache.stats["hits"] + response_cache.stats["misses"]
+    yield ("response",), response_cache.stats["hits"] / lookups if lookups else 0.0
+
+metrics.callback("db_pool_connections", "Kết nối trong pool theo trạng thái", _pool_samples, ("engine", "state"))
+metrics.callback("db_pool_utilisation", "checked_out / (pool_size + max_overflow)", _pool_utilisation_samples, ("engine",))
+metrics.callback("cache_requests_total", "Số lần tra cache theo kết quả", _cache_samples, ("cache", "result"), "counter")
+metrics.callback("cache_hit_ratio", "Tỉ lệ hit của cache", _hit_ratio_samples, ("cache",))
+metrics.callback("ocr_hedge_total", "Số lần gọi OCR / bắn hedge / backend phụ về trước",
+                 lambda: [((key,), value) for key, value in OCRService.engine.stats.items()], ("event",), "counter")
+metrics.callback("ocr_job_queue_depth", "Số job OCR đang chờ trong hàng đợi", lambda: [((), job_queue.stats()["queue_depth"])])
+metrics.callback("search_index_documents", "Số hóa đơn trong index tìm kiếm", lambda: [((), len(search_index))])
+
+@app.get("/metrics")
+async def get_metrics():
+    """Metric dạng text của Prometheus"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+async def get_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+async def read_upload(file: UploadFile) -> bytes:
+    """Đọc file upload theo từng chunk; quá UPLOAD_MAX_BYTES thì 413 ngay, không đọc tiếp phần còn lại"""
+    too_large = HTTPException(status_code=413, detail=f"File {file.filename} vượt quá {UPLOAD_MAX_BYTES // (1024 * 1024)} MB")
+    if file.size is not None and file.size > UPLOAD_MAX_BYTES:
+        raise too_large
+    buffer = bytearray()
+    while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+        buffer += chunk
+        if len(buffer) > UPLOAD_MAX_BYTES:
+            raise too_large
+    return bytes(buffer)
+
+async def _recognize_pages(pages: List[PreparedImage]) -> AsyncIterator[tuple]:
+    """OCR các trang song song (tối đa OCR_PDF_PAGE_CONCURRENCY), yield (index, text, lỗi, backend) theo thứ tự xong trước"""
+    semaphore = asyncio.Semaphore(OCR_PDF_PAGE_CONCURRENCY)
+
+    async def recognize(index: int, page: PreparedImage) -> tuple:
+        async with semaphore:
+            try:
+                text_value, backend = await OCRService.recognize_with_backend(page.content, page.filename,
+                                                                               content_type=page.content_type)
+                OCR_PAGES.inc(labels=("ok",))
+                return index, text_value, None, backend
+            except OCRBackendError as e:
+                OCR_PAGES.inc(labels=("error",))
+                logger.warning(f"⚠️  OCR lỗi trang {index + 1}/{len(pages)} ({page.filename}): {e}")
+                return index, "", str(e), None
+
+    tasks = [asyncio.create_task(recognize(index, page)) for index, page in enumerate(pages)]
+    try:
+        for finished in asyncio.as_completed(tasks):
+            yield await finished
+    finally:
+        # Client ngắt stream giữa chừng (hoặc 1 trang lỗi ngoài OCRBackendError) thì hủy các trang còn lại
+        # và chờ chúng kết thúc hẳn: không để task chạy sau khi response đóng, không có lỗi "never retrieved"
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+async def analyze_events(content: bytes, filename: str) -> AsyncIterator[dict]:
+    """Tiền xử lý + OCR + parse một file. PDF nhiều trang: OCR song song từng trang, yield
+    {"type": "page", ...} khi mỗi trang xong, rồi nối text các trang theo đúng thứ tự và parse 1 lần
+    (item nằm vắt qua 2 trang vẫn đọc được). Luôn kết thúc bằng {"type": "result", "result": ...}"""
+    # Tra theo backend chính trước rồi tới backend hedge: kết quả nào đã cache cũng là kết quả service chấp nhận trả
+    cache_keys = [OcrResultCache.make_key(content, backend_id, preprocess=image_preprocessor.cache_suffix)
+                  for backend_id in OCRService.engine.cache_ids]
+    cached = await asyncio.to_thread(ocr_cache.get_any, cache_keys)
+    if cached is not None:
+        logger.info("♻️  OCR cache hit")
+        yield {"type": "result", "result": cached, "cached": True}
+        return
+
+    prepared = await image_preprocessor.run(content, filename)
+    pages = await image_preprocessor.split_pages(prepared)
+    failed = 0
+    if len(pages) == 1:
+        raw_text, backend = await OCRService.recognize_with_backend(pages[0].content, pages[0].filename,
+                                                                     content_type=pages[0].content_type)
+        backend_ids = {backend.cache_id}
+    else:
+        logger.info(f"📄 PDF {len(pages)} trang, OCR song song {min(OCR_PDF_PAGE_CONCURRENCY, len(pages))} trang")
+        texts = [""] * len(pages)
+        backend_ids = set()
+        async for index, page_text, error, backend in _recognize_pages(pages):
+            texts[index] = page_text
+            failed += error is not None
+            if backend is not None:
+                backend_ids.add(backend.cache_id)
+            yield {"type": "page", "page": index + 1, "pages": len(pages), "text": page_text, "error": error}
+        if failed == len(pages):
+            raise OCRBackendError(f"OCR lỗi cả {len(pages)} trang")
+        raw_text = "\n".join(texts)
+
+    start = time.perf_counter()
+    result = InvoiceParserService.parse(raw_text)
+    PARSE_LATENCY.observe(time.perf_counter() - start)
+    # Không cache kết quả rỗng / thiếu trang (OCR lỗi / timeout) để lần sau còn thử lại; cũng không cache khi các
+    # trang do nhiều backend khác nhau đọc (hedge chỉ về trước ở vài trang) vì không gắn được cho backend nào
+    if raw_text and not failed and len(backend_ids) == 1:
+        cache_key = OcrResultCache.make_key(content, backend_ids.pop(), preprocess=image_preprocessor.cache_suffix)
+        await asyncio.to_thread(ocr_cache.set, cache_key, result)
+    yield {"type": "result", "result": result, "cached": False, "pages": len(pages), "pages_failed": failed}
+
+async def analyze_bytes(content: bytes, filename: str) -> dict:
+    """Tiền xử lý ảnh + OCR + parse một file (PDF: gộp mọi trang), ưu tiên lấy kết quả từ cache"""
+    async for message in analyze_events(content, filename):
+        if message["type"] == "result":
+            return message["result"]
+
+job_queue = OcrJobQueue(analyze_bytes)
 
 @app.post("/analyze-invoice", response_model=InvoiceCreateSchema)
 async def analyze_invoice(file: UploadFile = File(...)):
-    content = await file.read()
-    raw_text = OCRService.process_image(content, file.filename)
-    return InvoiceParserService.parse(raw_text)
+    content = await read_upload(file)
+    try:
+        return await analyze_bytes(content, file.filename)
+    except DocumentTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except OCRBackendError as e:
+        logger.error(f"❌ OCR Error: {e}")
+        raise HTTPException(status_code=502, detail=f"Lỗi OCR: {e}")
+
+@app.post("/analyze-invoice/stream")
+async def analyze_invoice_stream(file: UploadFile = File(...)):
+    """Như /analyze-invoice nhưng trả NDJSON: PDF nhiều trang gửi từng trang ngay khi OCR xong
+    (text + item đọc được trên trang đó), dòng cuối là kết quả đã gộp mọi trang"""
+    content = await read_upload(file)
+    filename = file.filename
+
+    async def stream():
+        try:
+            async for message in analyze_events(content, filename):
+                if message["type"] == "page":
+                    message["items"] = InvoiceParserService.parse(message["text"])["items"]
+                else:
+                    message["result"] = InvoiceCreateSchema.model_validate(message["result"]).model_dump()
+                yield orjson.dumps(message).decode() + "\n"
+        except (DocumentTooLargeError, OCRBackendError) as e:
+            logger.error(f"❌ OCR Error ({filename}): {e}")
+            yield orjson.dumps({"type": "error", "error": str(e)}).decode() + "\n"
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+@app.post("/analyze-invoices/batch")
+async def analyze_invoices_batch(files: List[UploadFile] = File(...)):
+    """Phân tích nhiều hóa đơn song song, trả về từng kết quả dạng NDJSON ngay khi xong"""
+    # Đọc hết nội dung trước khi stream vì UploadFile sẽ bị đóng sau khi handler return
+    uploads = [(index, f.filename, await read_upload(f)) for index, f in enumerate(files)]
+    semaphore = asyncio.Semaphore(BATCH_MAX_WORKERS)
+
+    async def process(index: int, filename: str, content: bytes) -> dict:
+        async with semaphore:
+            try:
+                result = await analyze_bytes(content, filename)
+                return {"index": index, "filename": filename, "status": "ok",
+                        "result": InvoiceCreateSchema.model_validate(result).model_dump()}
+            except Exception as e:
+                logger.error(f"❌ Batch OCR lỗi file {filename}: {e}")
+                return {"index": index, "filename": filename, "status": "error", "error": str(e)}
+
+    async def stream():
+        tasks = [asyncio.create_task(process(*upload)) for upload in uploads]
+        try:
+            for finished in asyncio.as_completed(tasks):
+                yield orjson.dumps(await finished).decode() + "\n"
+        finally:
+            # Client ngắt kết nối giữa chừng thì hủy các file còn lại và chờ chúng kết thúc hẳn
+            # (không để OCR chạy tiếp sau khi response đóng, không có cảnh báo "Task was destroyed but it is pending")
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    logger.info(f"📦 Batch OCR {len(uploads)} file")
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+@app.post("/jobs", status_code=status.HTTP_202_ACCEPTED)
+async def submit_job(file: UploadFile = File(...)):
+    """Nhận ảnh hóa đơn, trả về job id ngay; kết quả lấy qua GET /jobs/{job_id}"""
+    content = await read_upload(file)
+    try:
+        job = job_queue.submit(content, file.filename)
+    except asyncio.QueueFull:
+        raise HTTPException(status_code=503, detail="Hàng đợi OCR đang đầy, vui lòng thử lại sau", headers={"Retry-After": "5"})
+    return {"job_id": job["id"], "status": job["status"]}
+
+@app.get("/jobs")
+def get_jobs(ids: str = Query(..., description="Danh sách job id, phân cách bằng dấu phẩy")):
+    """Tra cứu trạng thái nhiều job cùng lúc"""
+    result = []
+    for job_id in [i.strip() for i in ids.split(",") if i.strip()]:
+        job = job_queue.get(job_id)
+        result.append(job if job else {"id": job_id, "status": "not_found"})
+    return result
+
+@app.get("/jobs/stats")
+def get_job_stats():
+    """Độ sâu hàng đợi và số worker"""
+    return job_queue.stats()
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str):
+    """Trạng thái và kết quả của một job"""
+    job = job_queue.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@app.get("/ocr/stats")
+def get_ocr_stats():
+    """Thống kê hedged request và độ trễ hiện tại của OCR"""
+    engine = OCRService.engine
+    return {
+        **engine.stats,
+        "primary": engine.primary.name,
+        "secondary": engine.secondary.name if engine.secondary else None,
+        "hedge_delay": engine.hedge_delay(),
+    }
+
+@app.get("/ocr-cache/stats")
+def get_ocr_cache_stats():
+    """Thống kê hit/miss của cache OCR"""
+    return ocr_cache.snapshot()
+
+# --- INVOICE BUILDERS (dùng chung cho API tạo đơn lẻ và bulk) ---
+def truncate_string(s: Optional[str], max_length: int) -> Optional[str]:
+    """Cắt chuỗi nếu quá dài"""
+    if s is None:
+        return None
+    return s[:max_length] if len(s) > max_length else s
+
+# dd/mm/yyyy, dd-mm-yy, dd.mm.yyyy, yyyy-mm-dd, yyyy/mm/dd (có thể kèm giờ phía sau)
+NUMERIC_DATE_RE = re.compile(r'(?<!\d)(\d{1,4})[/.\-](\d{1,2})[/.\-](\d{1,4})(?!\d)')
+# "Ngày 12 tháng 03 năm 2024" (có dấu hoặc không dấu)
+TEXT_DATE_RE = re.compile(r'ng[àa]y\s*(\d{1,2})\s*th[áa]ng\s*(\d{1,2})\s*n[ăa]m\s*(\d{4})', re.IGNORECASE)
+MIN_INVOICE_YEAR, MAX_INVOICE_YEAR = 1990, 2100
+
+def parse_invoice_date(value: Optional[str]) -> Optional[datetime.date]:
+    """Chuẩn hóa ngày từ chuỗi tự do của OCR/client, không đọc được thì None.
+    Ưu tiên ngày/tháng kiểu Việt Nam; chỉ hiểu là tháng/ngày khi "tháng" > 12 (vd 03/25/2024)"""
+    if not value:
+        return None
+    match = TEXT_DATE_RE.search(value)
+    if match:
+        day, month, year = (int(g) for g in match.groups())
+    else:
+        match = NUMERIC_DATE_RE.search(value)
+        if not match:
+            return None
+        first, second, third = match.groups()
+        if len(first) == 4 and len(third) <= 2:
+            year, month, day = int(first), int(second), int(third)
+        elif len(first) <= 2 and len(third) in (2, 4):
+            day, month, year = int(first), int(second), int(third)
+            if len(third) == 2:
+                year += 2000
+        else:
+            return None
+        if month > 12 and day <= 12:
+            day, month = month, day
+    if not MIN_INVOICE_YEAR <= year <= MAX_INVOICE_YEAR:
+        return None
+    try:
+        return datetime.date(year, month, day)
+    except ValueError:
+        return None
+
+def _normalize_key_part(value) -> str:
+    """Chữ thường, bỏ dấu tiếng Việt, chỉ giữ chữ + số: "Công ty ABC, Đà Nẵng" -> congtyabcdanang"""
+    text_value = unicodedata.normalize("NFKD", str(value or "").replace("đ", "d").replace("Đ", "D"))
+    return re.sub(r"[^0-9a-z]", "", "".join(c for c in text_value if not unicodedata.combining(c)).lower())
+
+def invoice_fingerprint(supplier_name: Optional[str], invoice_number: Optional[str], date: Optional[str],
+                        parsed_date: Optional[datetime.date], total_amount: Optional[int]) -> Optional[str]:
+    """Khóa chống trùng của 1 hóa đơn: cùng nhà cung cấp + số hóa đơn + ngày + tổng tiền sau khi chuẩn hóa.
+    Không có số hóa đơn (hóa đơn bán lẻ) thì None: 2 lần mua giống hệt nhau trong ngày vẫn là 2 hóa đơn"""
+    number = _normalize_key_part(invoice_number)
+    if not number:
+        return None
+    day = parsed_date.isoformat() if parsed_date else _normalize_key_part(date)
+    key = "|".join((_normalize_key_part(supplier_name), number, day, str(total_amount or 0)))
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+def find_duplicate_invoices(db: Session, fingerprints) -> dict:
+    """fingerprint -> id hóa đơn đã có, 1 query trên ux_invoices_fingerprint cho cả danh sách"""
+    fingerprints = {f for f in fingerprints if f}
+    if not fingerprints:
+        return {}
+    return dict(db.execute(select(InvoiceDB.fingerprint, InvoiceDB.id).where(InvoiceDB.fingerprint.in_(fingerprints))).all())
+
+def invoice_date_conditions(date_from: Optional[datetime.date], date_to: Optional[datetime.date]) -> list:
+    """Điều kiện WHERE theo khoảng ngày trên InvoiceDB.parsed_date (range scan trên ix_invoices_parsed_date_id)"""
+    conditions = []
+    if date_from:
+        conditions.append(InvoiceDB.parsed_date >= date_from)
+    if date_to:
+        conditions.append(InvoiceDB.parsed_date <= date_to)
+    return conditions
+
+def build_invoice_rows(invoice: InvoiceCreateSchema, invalid_category_ids: set) -> tuple:
+    """Chuyển InvoiceCreateSchema thành (dict cột invoices, list dict cột invoice_items)"""
+    # Tính lại tổng tiền từ items (đảm bảo chính xác)
+    calculated_total = sum(item.price if item.price else 0 for item in invoice.items)
+    safe_total = calculated_total if calculated_total > 0 else (invoice.total_amount if invoice.total_amount else 0)
+
+    item_rows = []
+    for i in invoice.items:
+        item_rows.append({
+            "name": truncate_string(i.name, 500),
+            "quantity": i.quantity,
+            "unit_price": i.unit_price,
+            "price": i.price if i.price is not None else 0,
+            "category_id": i.category_id if i.category_id and i.category_id not in invalid_category_ids else None
+        })
+
+    invoice_row = {
+        "merchant_name": truncate_string(invoice.merchant_name, 500),
+        "date": truncate_string(invoice.date, 100),
+        "parsed_date": parse_invoice_date(invoice.date),
+        "total_amount": safe_total,
+        "raw_text": invoice.raw_text,  # Text không giới hạn
+    }
+    return invoice_row, item_rows
+
+def validate_ocr_invoice(db: Session, invoice: OcrInvoiceCreateSchema) -> int:
+    """Kiểm tra dữ liệu bắt buộc của invoice OCR, trả về category_id hợp lệ (raise HTTPException 400 nếu sai)"""
+    if not invoice.invoiceNumber:
+        raise HTTPException(status_code=400, detail="Số hóa đơn là bắt buộc")
+    
+    if not invoice.productCategory or not invoice.productCategory.get('id'):
+        raise HTTPException(status_code=400, detail="Danh mục sản phẩm là bắt buộc")
+
+    if not invoice.lineItems or len(invoice.lineItems) == 0:
+        raise HTTPException(status_code=400, detail="Phải có ít nhất một sản phẩm")
+
+    category_id = invoice.productCategory.get('id')
+    category = category_registry.get(db, category_id)
+    if not category:
+        raise HTTPException(status_code=400, detail=f"Danh mục ID {category_id} không tồn tại")
+    return category["id"]
+
+def build_ocr_invoice_rows(invoice: OcrInvoiceCreateSchema, category_id: int) -> tuple:
+    """Chuyển OcrInvoiceCreateSchema thành (dict cột invoices, list dict cột invoice_items)"""
+    item_rows = []
+    for item in invoice.lineItems:
+        product_name = truncate_string(item.productName, 500) or ""
+        quantity = item.quantity if item.quantity else 0
+        unit_price = item.unitPrice if item.unitPrice else 0
+        total = item.total if item.total else (quantity * unit_price)
+
+        item_rows.append({
+            "name": product_name,
+            "product_name": product_name,
+            "quantity": quantity,
+            "unit_price": unit_price,
+            "price": total,
+            "total": total,
+            "category_id": category_id
+        })
+
+    invoice_row = {
+        "invoice_number": truncate_string(invoice.invoiceNumber, 100),
+        "supplier_name": truncate_string(invoice.supplierName, 500),
+        "merchant_name": truncate_string(invoice.supplierName, 500),  # Dùng supplier_name làm merchant_name
+        "date": truncate_string(invoice.date, 100),
+        "parsed_date": parse_invoice_date(invoice.date),
+        "total_amount": invoice.totalAmount if invoice.totalAmount else 0,
+        "vat_rate": invoice.vatRate if invoice.vatRate else 0,
+        "vat_amount": invoice.vatAmount if invoice.vatAmount else 0,
+        "raw_text": invoice.rawText or "",
+    }
+    invoice_row["fingerprint"] = invoice_fingerprint(invoice_row["supplier_name"], invoice_row["invoice_number"],
+                                                     invoice_row["date"], invoice_row["parsed_date"], invoice_row["total_amount"])
+    return invoice_row, item_rows
+
+# --- IDEMPOTENCY ---
+# Client gửi header Idempotency-Key (vd UUID) cho mỗi thao tác tạo: retry với cùng key trả lại response lần đầu
+# Với POST đơn lẻ, response được ghi cùng transaction với hóa đơn: 2 request cùng key chạy song song thì
+# bên commit sau lỗi khóa chính và trả lại response của bên trước
+_idempotency_state = {"purged_at": 0.0}
+
+def idempotency_scope(path: str, key: Optional[str]) -> Optional[str]:
+    if key is None:
+        return None
+    key = key.strip()
+    if not key or len(key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+        raise HTTPException(status_code=400, detail=f"Idempotency-Key phải có 1-{IDEMPOTENCY_KEY_MAX_LENGTH} ký tự")
+    return f"{path} {key}"
+
+def request_hash(payload) -> str:
+    return hashlib.sha256(orjson.dumps(payload, option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS)).hexdigest()
+
+def load_idempotent_response(db: Session, scope: Optional[str], payload_hash: str) -> Optional[FastJSONResponse]:
+    """Response đã lưu của key (tra theo khóa chính), None nếu chưa có / đã hết hạn"""
+    if scope is None:
+        return None
+    row = db.get(IdempotencyKeyDB, scope)
+    if row is None:
+        return None
+    if row.created_at < datetime.datetime.utcnow() - datetime.timedelta(seconds=IDEMPOTENCY_TTL):
+        db.delete(row)  # Hết hạn: xóa cùng transaction với lần ghi mới của key
+        return None
+    if row.request_hash != payload_hash:
+        raise HTTPException(status_code=422, detail="Idempotency-Key đã được dùng cho 1 request khác")
+    INVOICE_DEDUP.inc(labels=("idempotency_key",))
+    logger.info(f"♻️  Idempotency-Key đã xử lý, trả lại response cũ: {scope}")
+    return FastJSONResponse(orjson.loads(row.response), status_code=row.status_code, headers={"Idempotent-Replayed": "true"})
+
+def save_idempotent_response(db: Session, scope: Optional[str], payload_hash: str, status_code: int, content: dict):
+    """Thêm response vào transaction hiện tại (caller commit); dọn key hết hạn tối đa 1 lần / giờ"""
+    if scope is None:
+        return
+    now = datetime.datetime.utcnow()
+    # add (không merge): request song song cùng key phải lỗi khóa chính thay vì ghi đè lẫn nhau
+    db.add(IdempotencyKeyDB(key=scope, request_hash=payload_hash, status_code=status_code,
+                            response=orjson.dumps(content).decode(), created_at=now))
+    if time.monotonic() - _idempotency_state["purged_at"] >= 3600:
+        _idempotency_state["purged_at"] = time.monotonic()
+        db.execute(IdempotencyKeyDB.__table__.delete().where(
+            IdempotencyKeyDB.created_at < now - datetime.timedelta(seconds=IDEMPOTENCY_TTL)))
+
+def commit_idempotent(db: Session, scope: Optional[str], payload_hash: str, status_code: int, content: dict):
+    """Lưu response của key trong transaction riêng (bulk: dữ liệu đã commit theo từng chunk)"""
+    if scope is None:
+        return
+    try:
+        save_idempotent_response(db, scope, payload_hash, status_code, content)
+        db.commit()
+    except IntegrityError:
+        db.rollback()  # Request song song cùng key đã lưu trước
+
+IDEMPOTENCY_KEY_HEADER = Header(None, alias="Idempotency-Key", description="Gửi lại request với cùng key trả lại response lần đầu, không tạo thêm")
+
+def duplicate_invoice_response(invoice_id: int, invoice_row: dict) -> FastJSONResponse:
+    """200 + id hóa đơn đã có (thay vì 201) khi hóa đơn trùng fingerprint"""
+    INVOICE_DEDUP.inc(labels=("fingerprint",))
+    logger.info(f"♻️  Hóa đơn {invoice_row['invoice_number']} đã có (ID {invoice_id}), bỏ qua")
+    return FastJSONResponse({"message": "Duplicate", "id": invoice_id, "invoiceNumber": invoice_row["invoice_number"],
+                             "totalAmount": invoice_row["total_amount"], "duplicate": True})
+
+def resolve_create_conflict(db: Session, scope: Optional[str], payload_hash: str,
+                            invoice_row: Optional[dict] = None) -> Optional[FastJSONResponse]:
+    """Sau IntegrityError (đã rollback): request song song cùng Idempotency-Key / cùng hóa đơn đã commit trước"""
+    replay = load_idempotent_response(db, scope, payload_hash)
+    if replay is not None or invoice_row is None:
+        return replay
+    existing = find_duplicate_invoices(db, [invoice_row.get("fingerprint")])
+    return duplicate_invoice_response(existing[invoice_row["fingerprint"]], invoice_row) if existing else None
 
 @app.post("/invoices", status_code=status.HTTP_201_CREATED)
-def create_invoice(invoice: InvoiceCreateSchema, db: Session = Depends(get_db)):
+async def create_invoice(invoice: InvoiceCreateSchema, db: AsyncSession = Depends(get_db),
+                         idempotency_key: Optional[str] = IDEMPOTENCY_KEY_HEADER):
+    scope = idempotency_scope("/invoices", idempotency_key)
+    payload_hash = request_hash(invoice.model_dump()) if scope else ""
     try:
+        if scope and (replay := await db.run_sync(load_idempotent_response, scope, payload_hash)):
+            return replay
+
         # In dữ liệu đã được Pydantic làm sạch ra log
         logger.info(f"📥 Data Validated: {invoice.model_dump()}")
 
-        # Hàm helper để cắt chuỗi nếu quá dài
-        def truncate_string(s: Optional[str], max_length: int) -> Optional[str]:
-            if s is None:
-                return None
-            return s[:max_length] if len(s) > max_length else s
-
-        # Tính lại tổng tiền từ items (đảm bảo chính xác)
-        calculated_total = sum(item.price if item.price else 0 for item in invoice.items)
-        safe_total = calculated_total if calculated_total > 0 else (invoice.total_amount if invoice.total_amount else 0)
-
-        # 1. Tạo các object Item trước (nhưng chưa lưu) với validation
-        db_items = []
-        for i in invoice.items:
-            safe_price = i.price if i.price is not None else 0
-            safe_name = truncate_string(i.name, 500)
-            # Kiểm tra category_id có tồn tại không
-            category_id = i.category_id if i.category_id else None
-            if category_id:
-                category_exists = db.query(ProductCategoryDB).filter(ProductCategoryDB.id == category_id).first()
-                if not category_exists:
-                    logger.warning(f"⚠️  Category ID {category_id} không tồn tại, bỏ qua category_id")
-                    category_id = None
-            
-            db_items.append(InvoiceItemDB(
-                name=safe_name, 
-                price=safe_price,
-                category_id=category_id
-            ))
-
-        # 2. Tạo Invoice cha và gán luôn items vào (SQLAlchemy tự xử lý ID)
-        db_invoice = InvoiceDB(
-            merchant_name=truncate_string(invoice.merchant_name, 500),
-            date=truncate_string(invoice.date, 100),
-            total_amount=safe_total,
-            raw_text=invoice.raw_text,  # Text không giới hạn
-            items=db_items # Gán trực tiếp list item vào đây
-        )
+        # Kiểm tra category_id của tất cả items một lần (từ cache danh mục)
+        invalid_category_ids = await db.run_sync(category_registry.validate_ids, {i.category_id for i in invoice.items})
+        if invalid_category_ids:
+            logger.warning(f"⚠️  Category ID {sorted(invalid_category_ids)} không tồn tại, bỏ qua category_id")
+
+        invoice_row, item_rows = build_invoice_rows(invoice, invalid_category_ids)
+
+        # Tạo Invoice cha và gán luôn items vào (SQLAlchemy tự xử lý ID)
+        db_invoice = InvoiceDB(**invoice_row, items=[InvoiceItemDB(**row) for row in item_rows])
 
         db.add(db_invoice)
-        db.commit() # Chỉ commit 1 lần duy nhất
-        db.refresh(db_invoice)
+        await db.run_sync(apply_category_stats, add_category_stats_delta({}, item_rows))
+        content = None
+        if scope:
+            await db.flush()  # Cần id để lưu response cùng transaction
+            content = {"message": "Success", "id": db_invoice.id}
+            await db.run_sync(save_idempotent_response, scope, payload_hash, status.HTTP_201_CREATED, content)
+        await db.commit() # Chỉ commit 1 lần duy nhất
+        index_invoice(db_invoice.id, invoice_row, item_rows)
+        response_cache.bump()
 
         logger.info(f"✅ Saved Invoice ID: {db_invoice.id}")
-        return {"message": "Success", "id": db_invoice.id}
+        return content or {"message": "Success", "id": db_invoice.id}
 
+    except HTTPException:
+        await db.rollback()
+        raise
+    except IntegrityError as e:
+        await db.rollback()
+        if scope and (replay := await db.run_sync(resolve_create_conflict, scope, payload_hash)):
+            return replay
+        logger.error(f"❌ Database Error: {e}")
+        raise HTTPException(status_code=500, detail=f"Lỗi lưu Database: {e}")
     except SQLAlchemyError as e:
-        db.rollback()
+        await db.rollback()
         error_msg = str(e)
         logger.error(f"❌ Database Error: {error_msg}")
         logger.error(f"❌ Full traceback: {traceback.format_exc()}")
         # Trả về thông báo lỗi chi tiết hơn để debug
         raise HTTPException(status_code=500, detail=f"Lỗi lưu Database: {error_msg}")
     except Exception as e:
-        db.rollback()  # Đảm bảo rollback trong mọi trường hợp
+        await db.rollback()  # Đảm bảo rollback trong mọi trường hợp
         error_msg = str(e)
         logger.error(f"❌ Unknown Error: {error_msg}")
         logger.error(f"❌ Full traceback: {traceback.format_exc()}")
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"Lỗi không xác định: {error_msg}")
 
+# Các field cho phép chọn qua ?fields= (mặc định trả về như cũ)
+# raw_text (bảng invoice_raw_texts, nén) chỉ load khi được chọn qua ?fields=
+INVOICE_DEFAULT_FIELDS = ["id", "merchant_name", "date", "total_amount", "items"]
+INVOICE_EXTRA_FIELDS = ["invoice_number", "supplier_name", "vat_rate", "vat_amount", "raw_text"]
+
 @app.get("/invoices")
-def read_invoices(db: Session = Depends(get_db)):
-    invoices = db.query(InvoiceDB).order_by(InvoiceDB.id.desc()).limit(20).all()
+async def read_invoices(
+    limit: int = Query(20, ge=1, le=200),
+    cursor: Optional[int] = Query(None, description="Lấy các hóa đơn có id nhỏ hơn cursor (giá trị header X-Next-Cursor của trang trước)"),
+    fields: Optional[str] = Query(None, description="Danh sách field cần lấy, phân cách bằng dấu phẩy"),
+    date_from: Optional[datetime.date] = Query(None, description="Từ ngày (YYYY-MM-DD)"),
+    date_to: Optional[datetime.date] = Query(None, description="Đến ngày (YYYY-MM-DD)"),
+    db: AsyncSession = Depends(get_db),
+):
+    selected = [f.strip() for f in fields.split(",") if f.strip()] if fields else INVOICE_DEFAULT_FIELDS
+    unknown = [f for f in selected if f not in INVOICE_DEFAULT_FIELDS + INVOICE_EXTRA_FIELDS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Field không hợp lệ: {', '.join(unknown)}")
+
+    # Chỉ load các cột được chọn; items / raw_text load bằng query riêng (selectin), tên danh mục lấy từ cache
+    columns = [getattr(InvoiceDB, f) for f in selected if f not in ("id", "items", "raw_text")]
+    if "raw_text" in selected:
+        columns.append(InvoiceDB.legacy_raw_text)
+    stmt = select(InvoiceDB).options(load_only(InvoiceDB.id, *columns))
+    if "raw_text" in selected:
+        stmt = stmt.options(selectinload(InvoiceDB.raw_text_row))
+    if "items" in selected:
+        stmt = stmt.options(selectinload(InvoiceDB.items))
+        categories = await db.run_sync(category_registry.snapshot)
+    if cursor is not None:
+        stmt = stmt.where(InvoiceDB.id < cursor)
+    stmt = stmt.where(*invoice_date_conditions(date_from, date_to))
+    # Lấy dư 1 bản ghi để biết còn trang sau hay không
+    invoices = (await db.execute(stmt.order_by(InvoiceDB.id.desc()).limit(limit + 1))).scalars().all()
+    headers = {}
+    if len(invoices) > limit:
+        invoices = invoices[:limit]
+        headers["X-Next-Cursor"] = str(invoices[-1].id)
+
     results = []
     for inv in invoices:
-        items_list = []
-        for i in inv.items:
-            item_data = {
-                "name": i.name, 
-                "price": i.price,
-                "category_id": i.category_id
-            }
-            if i.category:
-                item_data["category_name"] = i.category.name
-            items_list.append(item_data)
-        
-        results.append({
-            "id": inv.id,
-            "merchant_name": inv.merchant_name,
-            "date": inv.date,
-            "total_amount": inv.total_amount,
-            "items": items_list,
-            "raw_text": inv.raw_text
-        })
-    return results
+        data = {}
+        for field in selected:
+            if field == "items":
+                items_list = []
+                for i in inv.items:
+                    item_data = {
+                        "name": i.name, 
+                        "price": i.price,
+                        "category_id": i.category_id
+                    }
+                    if i.category_id in categories:
+                        item_data["category_name"] = categories[i.category_id]["name"]
+                    items_list.append(item_data)
+                data["items"] = items_list
+            else:
+                data[field] = getattr(inv, field)
+        results.append(data)
+    return FastJSONResponse(results, headers=headers)
 
 @app.get("/categories")
-def get_categories(db: Session = Depends(get_db)):
+async def get_categories(db: AsyncSession = Depends(get_db)):
     """Lấy danh sách tất cả danh mục sản phẩm"""
-    categories = db.query(ProductCategoryDB).order_by(ProductCategoryDB.id).all()
-    return [{"id": cat.id, "name": cat.name, "description": cat.description} for cat in categories]
+    return await db.run_sync(category_registry.all)
 
 @app.get("/categories/{category_id}")
-def get_category(category_id: int, db: Session = Depends(get_db)):
+async def get_category(category_id: int, db: AsyncSession = Depends(get_db)):
     """Lấy thông tin chi tiết một danh mục"""
-    category = db.query(ProductCategoryDB).filter(ProductCategoryDB.id == category_id).first()
+    category = await db.run_sync(category_registry.get, category_id)
     if not category:
         raise HTTPException(status_code=404, detail="Category not found")
-    return {"id": category.id, "name": category.name, "description": category.description}
+    return category
+
+UNCATEGORIZED_NAME = "Chưa phân loại"
+UNCATEGORIZED_DESCRIPTION = "Các sản phẩm chưa được chọn danh mục"
+STREAM_CHUNK_SIZE = 64 * 1024  # Gom JSON thành chunk ~64KB trước khi gửi
+
+def _category_items_stmt(category_id: Optional[int] = None, all_categories: bool = True,
+                         items_limit: Optional[int] = None, items_offset: int = 0):
+    """1 query join invoice_items + invoices, đánh số item trong từng danh mục để phân trang ngay trong SQL.
+
+    Sắp theo danh mục (chưa phân loại ở cuối) rồi id giảm dần.
+    """
+    rn = func.row_number().over(partition_by=InvoiceItemDB.category_id, order_by=InvoiceItemDB.id.desc()).label("rn")
+    ranked = select(
+        InvoiceItemDB.id, InvoiceItemDB.name, InvoiceItemDB.price, InvoiceItemDB.invoice_id, InvoiceItemDB.category_id,
+        InvoiceDB.date.label("invoice_date"), InvoiceDB.merchant_name, rn,
+    ).outerjoin(InvoiceDB, InvoiceItemDB.invoice_id == InvoiceDB.id)
+    if not all_categories:
+        ranked = ranked.where(InvoiceItemDB.category_id == category_id)
+    ranked = ranked.subquery()
+
+    stmt = select(ranked).where(ranked.c.rn > items_offset)
+    if items_limit is not None:
+        stmt = stmt.where(ranked.c.rn <= items_offset + items_limit)
+    return stmt.order_by(ranked.c.category_id.is_(None), ranked.c.category_id, ranked.c.rn)
+
+def _category_totals(db: Session) -> dict:
+    """Tổng số item và tổng tiền của từng danh mục (key None = chưa phân loại) bằng 1 query GROUP BY"""
+    rows = db.query(
+        InvoiceItemDB.category_id, func.count(InvoiceItemDB.id), func.coalesce(func.sum(InvoiceItemDB.price), 0)
+    ).group_by(InvoiceItemDB.category_id).all()
+    return {category_id: (int(count), int(total)) for category_id, count, total in rows}
+
+def _item_row_to_dict(row) -> dict:
+    return {
+        "id": row.id,
+        "name": row.name,
+        "price": row.price,
+        "invoice_id": row.invoice_id,
+        "invoice_date": row.invoice_date,
+        "merchant_name": row.merchant_name
+    }
+
+async def _chunked(parts, size: int = STREAM_CHUNK_SIZE):
+    buffer, length = [], 0
+    async for part in parts:
+        buffer.append(part)
+        length += len(part)
+        if length >= size:
+            yield b"".join(buffer)
+            buffer, length = [], 0
+    if buffer:
+        yield b"".join(buffer)
 
 @app.get("/products/by-category")
-def get_products_by_category(db: Session = Depends(get_db)):
-    """Lấy tất cả sản phẩm được nhóm theo danh mục (bảng tổng hợp)"""
-    categories = db.query(ProductCategoryDB).order_by(ProductCategoryDB.id).all()
-    result = []
-    
-    for category in categories:
-        # Lấy tất cả items thuộc danh mục này
-        items = db.query(InvoiceItemDB).filter(
-            InvoiceItemDB.category_id == category.id
-        ).order_by(InvoiceItemDB.id.desc()).all()
-        
-        items_list = []
-        total_amount = 0
-        for item in items:
-            items_list.append({
-                "id": item.id,
-                "name": item.name,
-                "price": item.price,
-                "invoice_id": item.invoice_id,
-                "invoice_date": item.invoice.date if item.invoice else None,
-                "merchant_name": item.invoice.merchant_name if item.invoice else None
-            })
-            total_amount += item.price if item.price else 0
-        
-        result.append({
-            "category_id": category.id,
-            "category_name": category.name,
-            "category_description": category.description,
-            "total_items": len(items_list),
-            "total_amount": total_amount,
-            "items": items_list
-        })
-    
-    # Thêm các sản phẩm chưa có danh mục
-    uncategorized_items = db.query(InvoiceItemDB).filter(
-        InvoiceItemDB.category_id.is_(None)
-    ).order_by(InvoiceItemDB.id.desc()).all()
-    
-    if uncategorized_items:
-        uncategorized_list = []
-        uncategorized_total = 0
-        for item in uncategorized_items:
-            uncategorized_list.append({
-                "id": item.id,
-                "name": item.name,
-                "price": item.price,
-                "invoice_id": item.invoice_id,
-                "invoice_date": item.invoice.date if item.invoice else None,
-                "merchant_name": item.invoice.merchant_name if item.invoice else None
-            })
-            uncategorized_total += item.price if item.price else 0
-        
-        result.append({
-            "category_id": None,
-            "category_name": "Chưa phân loại",
-            "category_description": "Các sản phẩm chưa được chọn danh mục",
-            "total_items": len(uncategorized_list),
-            "total_amount": uncategorized_total,
-            "items": uncategorized_list
-        })
-    
-    return result
+async def get_products_by_category(
+    items_limit: Optional[int] = Query(None, ge=1, description="Số sản phẩm tối đa trả về cho mỗi danh mục"),
+    items_offset: int = Query(0, ge=0, description="Bỏ qua N sản phẩm đầu của mỗi danh mục"),
+):
+    """Lấy tất cả sản phẩm được nhóm theo danh mục (bảng tổng hợp), stream JSON dần dần"""
+
+    async def generate():
+        # Tự mở session vì response stream kéo dài hơn vòng đời dependency get_db
+        async with AsyncSessionLocal() as db:
+            categories = await db.run_sync(category_registry.all)
+            totals = await db.run_sync(_category_totals)
+            # Đọc bằng server-side cursor
+            result = await db.stream(_category_items_stmt(items_limit=items_limit, items_offset=items_offset)
+                                     .execution_options(yield_per=1000))
+            rows = aiter(result)
+            row = await anext(rows, None)
+
+            groups = [(c["id"], c["name"], c["description"]) for c in categories]
+            if totals.get(None, (0, 0))[0]:
+                groups.append((None, UNCATEGORIZED_NAME, UNCATEGORIZED_DESCRIPTION))
+
+            yield b"["
+            for index, (category_id, name, description) in enumerate(groups):
+                header = orjson.dumps({"category_id": category_id, "category_name": name, "category_description": description})
+                yield (b"," if index else b"") + header[:-1] + b',"items":['
+                first = True
+                # Bỏ qua item của danh mục không còn tồn tại (không có trong bảng categories)
+                while row is not None and row.category_id is not None and (category_id is None or row.category_id < category_id):
+                    row = await anext(rows, None)
+                while row is not None and row.category_id == category_id:
+                    yield (b"" if first else b",") + orjson.dumps(_item_row_to_dict(row))
+                    first = False
+                    row = await anext(rows, None)
+                total_items, total_amount = totals.get(category_id, (0, 0))
+                yield f'],"total_items":{total_items},"total_amount":{total_amount}}}'.encode()
+            yield b"]"
+
+    return StreamingResponse(_chunked(generate()), media_type="application/json")
 
 @app.get("/products/by-category/{category_id}")
-def get_products_by_category_id(category_id: int, db: Session = Depends(get_db)):
+async def get_products_by_category_id(
+    category_id: int,
+    items_limit: Optional[int] = Query(None, ge=1, description="Số sản phẩm tối đa trả về"),
+    items_offset: int = Query(0, ge=0, description="Bỏ qua N sản phẩm đầu"),
+    db: AsyncSession = Depends(get_db),
+):
     """Lấy tất cả sản phẩm của một danh mục cụ thể"""
-    category = db.query(ProductCategoryDB).filter(ProductCategoryDB.id == category_id).first()
+    category = await db.run_sync(category_registry.get, category_id)
     if not category:
         raise HTTPException(status_code=404, detail="Category not found")
+
+    total_items, total_amount = (await db.execute(
+        select(func.count(InvoiceItemDB.id), func.coalesce(func.sum(InvoiceItemDB.price), 0))
+        .where(InvoiceItemDB.category_id == category_id)
+    )).one()
+    rows = await db.execute(_category_items_stmt(category_id=category_id, all_categories=False,
+                                                 items_limit=items_limit, items_offset=items_offset))
     
-    items = db.query(InvoiceItemDB).filter(
-        InvoiceItemDB.category_id == category_id
-    ).order_by(InvoiceItemDB.id.desc()).all()
-    
-    items_list = []
-    total_amount = 0
-    for item in items:
-        items_list.append({
-            "id": item.id,
-            "name": item.name,
-            "price": item.price,
-            "invoice_id": item.invoice_id,
-            "invoice_date": item.invoice.date if item.invoice else None,
-            "merchant_name": item.invoice.merchant_name if item.invoice else None
-        })
-        total_amount += item.price if item.price else 0
-    
-    return {
-        "category_id": category.id,
-        "category_name": category.name,
-        "category_description": category.description,
-        "total_items": len(items_list),
-        "total_amount": total_amount,
-        "items": items_list
-    }
+    return FastJSONResponse({
+        "category_id": category["id"],
+        "category_name": category["name"],
+        "category_description": category["description"],
+        "total_items": int(total_items),
+        "total_amount": int(total_amount),
+        "items": [_item_row_to_dict(row) for row in rows]
+    })
 
 @app.post("/ocr-invoices", status_code=status.HTTP_201_CREATED)
-def create_ocr_invoice(invoice: OcrInvoiceCreateSchema, db: Session = Depends(get_db)):
-    """API endpoint để lưu invoice từ OCR vào MySQL"""
+async def create_ocr_invoice(invoice: OcrInvoiceCreateSchema, db: AsyncSession = Depends(get_db),
+                             idempotency_key: Optional[str] = IDEMPOTENCY_KEY_HEADER):
+    """API endpoint để lưu invoice từ OCR vào MySQL.
+    Hóa đơn đã có (cùng nhà cung cấp + số hóa đơn + ngày + tổng tiền) không ghi lại: trả 200 kèm id cũ"""
+    scope = idempotency_scope("/ocr-invoices", idempotency_key)
+    payload_hash = request_hash(invoice.model_dump()) if scope else ""
+    invoice_row = None
     try:
-        logger.info(f"📥 OCR Invoice Data: {invoice.model_dump()}")
-
-        # Validation
-        if not invoice.invoiceNumber:
-            raise HTTPException(status_code=400, detail="Số hóa đơn là bắt buộc")
-        
-        if not invoice.productCategory or not invoice.productCategory.get('id'):
-            raise HTTPException(status_code=400, detail="Danh mục sản phẩm là bắt buộc")
+        if scope and (replay := await db.run_sync(load_idempotent_response, scope, payload_hash)):
+            return replay
 
-        if not invoice.lineItems or len(invoice.lineItems) == 0:
-            raise HTTPException(status_code=400, detail="Phải có ít nhất một sản phẩm")
+        logger.info(f"📥 OCR Invoice Data: {invoice.model_dump()}")
 
-        # Hàm helper để cắt chuỗi
-        def truncate_string(s: Optional[str], max_length: int) -> Optional[str]:
-            if s is None:
-                return None
-            return s[:max_length] if len(s) > max_length else s
-
-        # Lấy category_id
-        category_id = invoice.productCategory.get('id')
-        category_exists = db.query(ProductCategoryDB).filter(ProductCategoryDB.id == category_id).first()
-        if not category_exists:
-            raise HTTPException(status_code=400, detail=f"Danh mục ID {category_id} không tồn tại")
-
-        # Tạo các invoice items
-        db_items = []
-        for item in invoice.lineItems:
-            product_name = truncate_string(item.productName, 500) or ""
-            quantity = item.quantity if item.quantity else 0
-            unit_price = item.unitPrice if item.unitPrice else 0
-            total = item.total if item.total else (quantity * unit_price)
-
-            db_items.append(InvoiceItemDB(
-                name=product_name,
-                product_name=product_name,
-                quantity=quantity,
-                unit_price=unit_price,
-                price=total,
-                total=total,
-                category_id=category_id
-            ))
-
-        # Tạo invoice
-        db_invoice = InvoiceDB(
-            invoice_number=truncate_string(invoice.invoiceNumber, 100),
-            supplier_name=truncate_string(invoice.supplierName, 500),
-            merchant_name=truncate_string(invoice.supplierName, 500),  # Dùng supplier_name làm merchant_name
-            date=truncate_string(invoice.date, 100),
-            total_amount=invoice.totalAmount if invoice.totalAmount else 0,
-            vat_rate=invoice.vatRate if invoice.vatRate else 0,
-            vat_amount=invoice.vatAmount if invoice.vatAmount else 0,
-            raw_text=invoice.rawText or "",
-            items=db_items
-        )
+        category_id = await db.run_sync(validate_ocr_invoice, invoice)
+        invoice_row, item_rows = build_ocr_invoice_rows(invoice, category_id)
+        existing = await db.run_sync(find_duplicate_invoices, [invoice_row["fingerprint"]])
+        if existing:
+            return duplicate_invoice_response(existing[invoice_row["fingerprint"]], invoice_row)
+        db_invoice = InvoiceDB(**invoice_row, items=[InvoiceItemDB(**row) for row in item_rows])
 
         db.add(db_invoice)
-        db.commit()
-        db.refresh(db_invoice)
-
-        logger.info(f"✅ Saved OCR Invoice ID: {db_invoice.id}, Invoice Number: {db_invoice.invoice_number}")
-        
-        return {
+        await db.run_sync(apply_category_stats, add_category_stats_delta({}, item_rows))
+        await db.flush()
+        content = {
             "message": "Success",
             "id": db_invoice.id,
             "invoiceNumber": db_invoice.invoice_number,
             "totalAmount": db_invoice.total_amount
         }
+        await db.run_sync(save_idempotent_response, scope, payload_hash, status.HTTP_201_CREATED, content)
+        await db.commit()
+        index_invoice(db_invoice.id, invoice_row, item_rows)
+        response_cache.bump()
+
+        logger.info(f"✅ Saved OCR Invoice ID: {db_invoice.id}, Invoice Number: {db_invoice.invoice_number}")
+        return content
 
     except HTTPException:
-        db.rollback()
+        await db.rollback()
         raise
+    except IntegrityError as e:
+        # ux_invoices_fingerprint / khóa idempotency: request song song ghi cùng hóa đơn đã commit trước
+        await db.rollback()
+        if (resolved := await db.run_sync(resolve_create_conflict, scope, payload_hash, invoice_row)):
+            return resolved
+        logger.error(f"❌ Database Error: {e}")
+        raise HTTPException(status_code=500, detail=f"Lỗi lưu Database: {e}")
     except SQLAlchemyError as e:
-        db.rollback()
+        await db.rollback()
         error_msg = str(e)
         logger.error(f"❌ Database Error: {error_msg}")
         logger.error(f"❌ Full traceback: {traceback.format_exc()}")
         raise HTTPException(status_code=500, detail=f"Lỗi lưu Database: {error_msg}")
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         error_msg = str(e)
         logger.error(f"❌ Unknown Error: {error_msg}")
         logger.error(f"❌ Full traceback: {traceback.format_exc()}")
         raise HTTPException(status_code=500, detail=f"Lỗi không xác định: {error_msg}")
 
+# --- BULK INGEST ---
+def _insert_invoice_rows(db: Session, invoice_rows: List[dict]) -> List[int]:
+    """Insert các dòng invoices bằng 1 câu INSERT nhiều dòng, trả về id theo đúng thứ tự"""
+    table = InvoiceDB.__table__
+    if getattr(db.get_bind().dialect, "insert_executemany_returning_sort_by_parameter_order", False):
+        # SQLite / PostgreSQL: SQLAlchemy tự điền bulk_sentinel và sắp lại RETURNING theo thứ tự tham số
+        return db.execute(insert(table).returning(table.c.id, sort_by_parameter_order=True), invoice_rows).scalars().all()
+    # MySQL không có INSERT ... RETURNING: executemany (driver gộp thành 1 INSERT nhiều dòng) với bulk_sentinel = base + vị trí,
+    # rồi 1 SELECT đọc lại id. Id auto-increment mới luôn lớn hơn MAX(id) đọc trước đó nên SELECT chỉ quét khoảng id mới trên PK
+    floor = db.execute(select(func.coalesce(func.max(table.c.id), 0))).scalar()
+    base = uuid.uuid4().int >> 66  # 62 bit ngẫu nhiên: 2 chunk insert song song không trùng sentinel
+    db.execute(insert(table), [{**row, "bulk_sentinel": base + position} for position, row in enumerate(invoice_rows)])
+    ids = dict(db.execute(select(table.c.bulk_sentinel, table.c.id).where(
+        table.c.id > floor, table.c.bulk_sentinel.between(base, base + len(invoice_rows) - 1))).all())
+    return [ids[base + position] for position in range(len(invoice_rows))]
+
+def _insert_invoice_chunk(db: Session, chunk: List[tuple]) -> List[int]:
+    """Insert 1 chunk [(index, invoice_row, item_rows)] bằng multi-row INSERT, trả về id theo đúng thứ tự"""
+    item_table = InvoiceItemDB.__table__
+    # raw_text không nằm trong bảng invoices mà ghi nén vào invoice_raw_texts sau khi có id
+    ids = _insert_invoice_rows(db, [{k: v for k, v in invoice_row.items() if k != "raw_text"} for _, invoice_row, _ in chunk])
+
+    item_rows, raw_text_rows, deltas = [], [], {}
+    for invoice_id, (_, invoice_row, rows) in zip(ids, chunk):
+        item_rows.extend({**row, "invoice_id": invoice_id} for row in rows)
+        if invoice_row.get("raw_text"):
+            raw_text_rows.append({**raw_text_values(invoice_row["raw_text"]), "invoice_id": invoice_id})
+        add_category_stats_delta(deltas, rows)
+    if item_rows:
+        db.execute(insert(item_table), item_rows)
+    if raw_text_rows:
+        db.execute(insert(InvoiceRawTextDB.__table__), raw_text_rows)
+    apply_category_stats(db, deltas)
+    return ids
+
+def _bulk_insert(db: Session, prepared: List[tuple], errors: List[dict]) -> List[dict]:
+    """Ghi các invoice đã chuẩn bị theo từng chunk. Chunk lỗi thì rollback rồi chia đôi và ghi lại từng nửa,
+    tới khi chỉ còn đúng bản ghi gây lỗi: chỉ bản ghi đó bị báo lỗi, các bản ghi khác trong chunk vẫn được ghi"""
+    created = []
+    pending = deque(prepared[start:start + BULK_CHUNK_SIZE] for start in range(0, len(prepared), BULK_CHUNK_SIZE))
+    while pending:
+        chunk = pending.popleft()
+        try:
+            ids = _insert_invoice_chunk(db, chunk)
+            db.commit()
+        except SQLAlchemyError as e:
+            db.rollback()
+            if len(chunk) > 1:
+                logger.warning(f"⚠️  Bulk chunk lỗi (bản ghi {chunk[0][0]}-{chunk[-1][0]}), chia đôi để tìm bản ghi lỗi: {e.__class__.__name__}")
+                half = len(chunk) // 2
+                pending.extendleft([chunk[half:], chunk[:half]])  # Giữ thứ tự: nửa đầu ghi trước
+                continue
+            logger.error(f"❌ Bulk Database Error (bản ghi {chunk[0][0]}): {e}")
+            errors.append({"index": chunk[0][0], "error": f"Lỗi lưu Database: {e}"})
+            continue
+        for (_, invoice_row, item_rows), invoice_id in zip(chunk, ids):
+            index_invoice(invoice_id, invoice_row, item_rows)
+        response_cache.bump()
+        created.extend({"index": index, "id": invoice_id} for (index, _, _), invoice_id in zip(chunk, ids))
+    return created
+
+def _split_duplicates(db: Session, prepared: List[tuple]) -> tuple:
+    """Tách bản ghi trùng fingerprint với DB hoặc với bản ghi trước đó trong cùng request.
+    Trả về (bản ghi cần insert, [(index, fingerprint)] trùng, fingerprint -> id đã có trong DB)"""
+    existing = find_duplicate_invoices(db, [invoice_row.get("fingerprint") for _, invoice_row, _ in prepared])
+    fresh, duplicates, seen = [], [], set(existing)
+    for entry in prepared:
+        fingerprint = entry[1].get("fingerprint")
+        if fingerprint and fingerprint in seen:
+            duplicates.append((entry[0], fingerprint))
+            continue
+        if fingerprint:
+            seen.add(fingerprint)
+        fresh.append(entry)
+    return fresh, duplicates, existing
+
+def _resolve_duplicates(prepared: List[tuple], duplicates: List[tuple], existing: dict,
+                        created: List[dict], errors: List[dict]) -> List[dict]:
+    """Gán id cho bản ghi trùng: id đã có trong DB, hoặc id vừa tạo của bản ghi đầu tiên cùng fingerprint"""
+    fingerprints = {index: invoice_row.get("fingerprint") for index, invoice_row, _ in prepared}
+    ids = {**existing, **{fingerprints[c["index"]]: c["id"] for c in created if fingerprints.get(c["index"])}}
+    resolved = []
+    for index, fingerprint in duplicates:
+        if fingerprint in ids:
+            resolved.append({"index": index, "id": ids[fingerprint], "duplicate": True})
+        else:
+            errors.append({"index": index, "error": "Trùng với 1 bản ghi khác trong request bị lỗi"})
+    if resolved:
+        INVOICE_DEDUP.inc(len(resolved), ("fingerprint",))
+    return resolved
+
+def _bulk_status(content: dict) -> int:
+    """201: có bản ghi mới, không lỗi; 200: không lỗi nhưng tất cả đã có (trùng); 207: vừa có bản ghi thành công vừa có lỗi;
+    422: không bản ghi nào thành công"""
+    if not content["failed"]:
+        return status.HTTP_201_CREATED if content["created"] else status.HTTP_200_OK
+    if content["created"] or content["duplicates"]:
+        return status.HTTP_207_MULTI_STATUS
+    return 422  # Hằng số tên khác nhau giữa các bản Starlette
+
+def _bulk_response(total: int, created: List[dict], errors: List[dict], duplicates: Optional[List[dict]] = None) -> dict:
+    duplicates = duplicates or []
+    logger.info(f"✅ Bulk import: {len(created)}/{total} invoice, {len(duplicates)} trùng, {len(errors)} lỗi")
+    return {
+        "message": "Success" if not errors else "Partial",
+        "created": len(created),
+        "failed": len(errors),
+        "ids": created,
+        "duplicates": duplicates,
+        "errors": sorted(errors, key=lambda e: e["index"])
+    }
+
+@app.post("/invoices/bulk", status_code=status.HTTP_201_CREATED)
+async def create_invoices_bulk(records: List[dict] = Body(...), db: AsyncSession = Depends(get_db),
+                               idempotency_key: Optional[str] = IDEMPOTENCY_KEY_HEADER):
+    """Import nhiều invoice (schema như POST /invoices) bằng batch insert theo chunk"""
+    if len(records) > BULK_MAX_RECORDS:
+        raise HTTPException(status_code=413, detail=f"Tối đa {BULK_MAX_RECORDS} invoice mỗi request")
+    scope = idempotency_scope("/invoices/bulk", idempotency_key)
+    payload_hash = request_hash(records) if scope else ""
+    if scope and (replay := await db.run_sync(load_idempotent_response, scope, payload_hash)):
+        return replay
+
+    errors, invoices = [], []
+    for index, record in enumerate(records):
+        try:
+            invoices.append((index, InvoiceCreateSchema.model_validate(record)))
+        except ValidationError as e:
+            errors.append({"index": index, "error": str(e)})
+
+    invalid_category_ids = await db.run_sync(category_registry.validate_ids, {i.category_id for _, inv in invoices for i in inv.items})
+    prepared = [(index, *build_invoice_rows(invoice, invalid_category_ids)) for index, invoice in invoices]
+    content = _bulk_response(len(records), await db.run_sync(_bulk_insert, prepared, errors), errors)
+    status_code = _bulk_status(content)
+    await db.run_sync(commit_idempotent, scope, payload_hash, status_code, content)
+    return FastJSONResponse(content, status_code=status_code)
+
+@app.post("/ocr-invoices/bulk", status_code=status.HTTP_201_CREATED)
+async def create_ocr_invoices_bulk(records: List[dict] = Body(...), db: AsyncSession = Depends(get_db),
+                                   idempotency_key: Optional[str] = IDEMPOTENCY_KEY_HEADER):
+    """Import nhiều invoice OCR (schema như POST /ocr-invoices) bằng batch insert theo chunk.
+    Hóa đơn đã có trong DB hoặc lặp lại trong request không ghi lại, trả về trong "duplicates" kèm id"""
+    if len(records) > BULK_MAX_RECORDS:
+        raise HTTPException(status_code=413, detail=f"Tối đa {BULK_MAX_RECORDS} invoice mỗi request")
+    scope = idempotency_scope("/ocr-invoices/bulk", idempotency_key)
+    payload_hash = request_hash(records) if scope else ""
+    if scope and (replay := await db.run_sync(load_idempotent_response, scope, payload_hash)):
+        return replay
+
+    errors, prepared = [], []
+    for index, record in enumerate(records):
+        try:
+            invoice = OcrInvoiceCreateSchema.model_validate(record)
+            category_id = await db.run_sync(validate_ocr_invoice, invoice)
+            prepared.append((index, *build_ocr_invoice_rows(invoice, category_id)))
+        except ValidationError as e:
+            errors.append({"index": index, "error": str(e)})
+        except HTTPException as e:
+            errors.append({"index": index, "error": e.detail})
+    fresh, duplicates, existing = await db.run_sync(_split_duplicates, prepared)
+    created = await db.run_sync(_bulk_insert, fresh, errors)
+    resolved = _resolve_duplicates(prepared, duplicates, existing, created, errors)
+    content = _bulk_response(len(records), created, errors, resolved)
+    status_code = _bulk_status(content)
+    await db.run_sync(commit_idempotent, scope, payload_hash, status_code, content)
+    return FastJSONResponse(content, status_code=status_code)
+
+# --- SEARCH ---
+# Inverted index trong RAM (search_index.py); mỗi worker giữ 1 bản, đồng bộ với DB theo id tăng dần
+search_index = InvoiceSearchIndex()
+_search_sync_lock = threading.Lock()  # Chỉ 1 thread đồng bộ với DB tại 1 thời điểm (không dùng trên event loop)
+_search_pending: deque = deque()  # (invoice_id, fields) vừa commit, chờ thread đồng bộ / tìm kiếm đưa vào index
+_search_state = {"built": False, "synced_at": 0.0}
+
+def _search_fields(merchant_name: Optional[str], supplier_name: Optional[str], raw_text: Optional[str]) -> list:
+    fields = [(merchant_name, WEIGHT_MERCHANT), (raw_text, WEIGHT_RAW_TEXT)]
+    if supplier_name and supplier_name != merchant_name:
+        fields.append((supplier_name, WEIGHT_MERCHANT))
+    return fields
+
+def _item_search_fields(name: Optional[str], product_name: Optional[str]) -> list:
+    fields = [(name, WEIGHT_ITEM)]
+    if product_name and product_name != name:
+        fields.append((product_name, WEIGHT_ITEM))
+    return fields
+
+def index_invoice(invoice_id: int, invoice_row: dict, item_rows: List[dict]):
+    """Đưa invoice vừa commit vào hàng chờ của index (gọi sau khi tạo đơn lẻ / bulk, kể cả trên event loop).
+    Chỉ append vào deque, không lock / tokenize: thread tìm kiếm hoặc đồng bộ sẽ đưa vào index (apply_pending_search)"""
+    if not SEARCH_INDEX_ENABLED or not _search_state["built"]:
+        return  # Index chưa dựng xong: lần đồng bộ sau sẽ nạp từ DB
+    fields = _search_fields(invoice_row.get("merchant_name"), invoice_row.get("supplier_name"), invoice_row.get("raw_text"))
+    for row in item_rows:
+        fields.extend(_item_search_fields(row.get("name"), row.get("product_name")))
+    _search_pending.append((invoice_id, fields))
+
+def _add_to_search_index(invoice_id: int, fields: list) -> bool:
+    # Kiểm tra + thêm trong cùng lock của index: hàng chờ và lần đồng bộ có thể cùng gặp 1 invoice
+    with search_index.lock:
+        if invoice_id in search_index.indexed_ids:
+            return False
+        search_index.add(invoice_id, fields)
+        return True
+
+def apply_pending_search():
+    """Đưa các invoice trong hàng chờ vào index (chạy trong thread, trước khi tra index)"""
+    while _search_pending:
+        _add_to_search_index(*_search_pending.popleft())
+
+def _load_search_index(db: Session, min_id: int = 0) -> int:
+    """Nạp các invoice có id > min_id chưa có trong index (theo batch id tăng dần), trả về số invoice mới.
+    Mỗi batch quét id trước (chỉ đọc PK), rồi mới đọc + giải nén raw_text của các id chưa có trong index"""
+    count = 0
+    while True:
+        ids = db.execute(select(InvoiceDB.id).where(InvoiceDB.id > min_id).order_by(InvoiceDB.id).limit(EXPORT_BATCH_SIZE)).scalars().all()
+        if not ids:
+            return count
+        missing = [invoice_id for invoice_id in ids if invoice_id not in search_index.indexed_ids]
+        if missing:
+            rows = db.execute(
+                select(InvoiceDB.id, InvoiceDB.merchant_name, InvoiceDB.supplier_name, *RAW_TEXT_COLUMNS)
+                .outerjoin(InvoiceRawTextDB, InvoiceRawTextDB.invoice_id == InvoiceDB.id)
+                .where(InvoiceDB.id.in_(missing))
+            ).all()
+            fields = {row.id: _search_fields(row.merchant_name, row.supplier_name, pick_raw_text(row)) for row in rows}
+            item_stmt = select(InvoiceItemDB.invoice_id, InvoiceItemDB.name, InvoiceItemDB.product_name).where(InvoiceItemDB.invoice_id.in_(missing))
+            for item in db.execute(item_stmt):
+                fields[item.invoice_id].extend(_item_search_fields(item.name, item.product_name))
+            count += sum(_add_to_search_index(invoice_id, invoice_fields) for invoice_id, invoice_fields in fields.items())
+        min_id = ids[-1]
+
+def _search_sync_due() -> bool:
+    return not _search_state["built"] or time.monotonic() - _search_state["synced_at"] >= SEARCH_SYNC_INTERVAL
+
+def sync_search_index(db: Optional[Session] = None):
+    """Lần đầu: dựng index từ toàn bộ DB. Các lần sau: nạp invoice mới (do worker khác / ghi trực tiếp vào DB).
+    Chạy trong thread; _search_sync_lock chỉ giữ các thread đồng bộ khỏi chạy trùng, request ghi không chờ lock này"""
+    if not _search_sync_due():
+        return
+    own_session = db is None
+    db = db or SessionLocal()
+    try:
+        with _search_sync_lock:
+            if not _search_sync_due():
+                return
+            if not _search_state["built"]:
+                start = time.perf_counter()
+                count = _load_search_index(db)
+                _search_state["built"] = True
+                logger.info(f"🔎 Search index: {count} invoice, {len(search_index.postings)} token ({time.perf_counter() - start:.1f}s)")
+            else:
+                apply_pending_search()
+                _load_search_index(db, max(search_index.max_id - SEARCH_SYNC_OVERLAP, 0))
+            _search_state["synced_at"] = time.monotonic()
+    except SQLAlchemyError as e:
+        logger.error(f"❌ Search index sync lỗi: {e}")
+    finally:
+        if own_session:
+            db.close()
+
+def _search_with_pending(q: str, limit: int, offset: int) -> tuple:
+    apply_pending_search()  # Invoice vừa tạo trên worker này tìm thấy ngay, không chờ lần đồng bộ sau
+    return search_index.search(q, limit, offset)
+
+@app.get("/search")
+async def search_invoices(
+    q: str = Query(..., min_length=1, max_length=200, description="Từ khóa (có dấu hoặc không dấu)"),
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0, le=10000),
+    db: AsyncSession = Depends(get_db),
+):
+    """Tìm hóa đơn theo raw_text, tên cửa hàng / nhà cung cấp và tên sản phẩm; kết quả xếp theo độ liên quan"""
+    if not SEARCH_INDEX_ENABLED:
+        raise HTTPException(status_code=503, detail="Tìm kiếm đang tắt (SEARCH_INDEX_ENABLED=false)")
+    # Đồng bộ index (engine sync) và tra index (CPU) chạy trong thread để không chặn event loop
+    if _search_sync_due():
+        await asyncio.to_thread(sync_search_index)
+    if not _search_state["built"]:
+        raise HTTPException(status_code=503, detail="Index tìm kiếm chưa sẵn sàng")
+
+    total, hits = await asyncio.to_thread(_search_with_pending, q, limit, offset)
+    invoices = {}
+    if hits:
+        stmt = select(InvoiceDB).options(
+            load_only(InvoiceDB.id, InvoiceDB.invoice_number, InvoiceDB.merchant_name, InvoiceDB.supplier_name, InvoiceDB.date, InvoiceDB.total_amount),
+            selectinload(InvoiceDB.items).load_only(InvoiceItemDB.name, InvoiceItemDB.product_name, InvoiceItemDB.price),
+        ).where(InvoiceDB.id.in_([invoice_id for invoice_id, _ in hits]))
+        invoices = {inv.id: inv for inv in (await db.execute(stmt)).scalars()}
+
+    results = []
+    for invoice_id, score in hits:
+        inv = invoices.get(invoice_id)
+        if inv is None:
+            continue  # Đã bị xóa trực tiếp trong DB
+        results.append({
+            "id": inv.id,
+            "invoice_number": inv.invoice_number,
+            "merchant_name": inv.merchant_name,
+            "supplier_name": inv.supplier_name,
+            "date": inv.date,
+            "total_amount": inv.total_amount,
+            "score": round(score, 3),
+            "matched_items": [
+                {"name": i.name, "price": i.price} for i in inv.items
+                if search_index.matches(q, i.name) or search_index.matches(q, i.product_name)
+            ],
+        })
+    return FastJSONResponse({"query": q, "total": total, "limit": limit, "offset": offset, "results": results})
+
+# --- EXPORT ---
+EXPORT_INVOICE_COLUMNS = ["id", "invoice_number", "merchant_name", "supplier_name", "date", "total_amount", "vat_rate", "vat_amount"]
+EXPORT_ITEM_COLUMNS = ["id", "invoice_id", "invoice_number", "invoice_date", "merchant_name", "supplier_name", "category_id",
+                       "category_name", "name", "product_name", "quantity", "unit_price", "price"]
+async def _export_stream(stmt, columns: List[str], fmt: str, gzip_output: bool, row_mapper=None):
+    """Đọc stmt bằng server-side cursor theo từng batch và xuất ra CSV/NDJSON, bộ nhớ không phụ thuộc số dòng"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if gzip_output else None  # wbits=31 -> định dạng gzip
+    async with AsyncSessionLocal() as db:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer) if fmt == "csv" else None
+        if writer:
+            buffer.write("\ufeff")  # BOM để Excel đọc đúng tiếng Việt
+            writer.writerow(columns)
+
+        result = await db.stream(stmt.execution_options(yield_per=EXPORT_BATCH_SIZE))
+        async for batch in result.partitions():
+            for row in batch:
+                data = row_mapper(row) if row_mapper else row._mapping
+                if writer:
+                    writer.writerow([data[c] for c in columns])
+                else:
+                    buffer.write(orjson.dumps({c: data[c] for c in columns}).decode() + "\n")
+            chunk = buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+            yield compressor.compress(chunk) if compressor else chunk
+        tail = buffer.getvalue().encode("utf-8")
+        yield compressor.compress(tail) + compressor.flush() if compressor else tail
+
+def _export_response(name: str, stream, fmt: str, gzip_output: bool) -> StreamingResponse:
+    filename = f"{name}.{fmt}" + (".gz" if gzip_output else "")
+    media_type = "application/gzip" if gzip_output else ("text/csv; charset=utf-8" if fmt == "csv" else "application/x-ndjson")
+    return StreamingResponse(stream, media_type=media_type, headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+@app.get("/export/invoices")
+async def export_invoices(
+    format: str = Query("csv", pattern="^(csv|ndjson)$"),
+    date_from: Optional[datetime.date] = Query(None, description="Từ ngày (YYYY-MM-DD)"),
+    date_to: Optional[datetime.date] = Query(None, description="Đến ngày (YYYY-MM-DD)"),
+    category_id: Optional[int] = Query(None, description="Chỉ lấy hóa đơn có sản phẩm thuộc danh mục này"),
+    supplier: Optional[str] = Query(None, description="Lọc theo tên nhà cung cấp / cửa hàng (chứa chuỗi)"),
+    include_raw_text: bool = False,
+    gzip: bool = False,
+):
+    """Export toàn bộ hóa đơn dạng CSV/NDJSON (stream, có thể nén gzip)"""
+    columns = EXPORT_INVOICE_COLUMNS + (["raw_text"] if include_raw_text else [])
+    stmt = select(*[getattr(InvoiceDB, c) for c in EXPORT_INVOICE_COLUMNS])
+    if include_raw_text:
+        stmt = stmt.add_columns(*RAW_TEXT_COLUMNS).outerjoin(InvoiceRawTextDB, InvoiceRawTextDB.invoice_id == InvoiceDB.id)
+    if category_id is not None:
+        stmt = stmt.where(select(InvoiceItemDB.id).where(
+            InvoiceItemDB.invoice_id == InvoiceDB.id, InvoiceItemDB.category_id == category_id).exists())
+    if supplier:
+        stmt = stmt.where((InvoiceDB.supplier_name.contains(supplier)) | (InvoiceDB.merchant_name.contains(supplier)))
+    stmt = stmt.where(*invoice_date_conditions(date_from, date_to)).order_by(InvoiceDB.id)
+
+    def add_raw_text(row) -> dict:
+        return {**row._mapping, "raw_text": pick_raw_text(row)}
+
+    stream = _export_stream(stmt, columns, format, gzip, row_mapper=add_raw_text if include_raw_text else None)
+    return _export_response("invoices", stream, format, gzip)
+
+@app.get("/export/items")
+async def export_items(
+    format: str = Query("csv", pattern="^(csv|ndjson)$"),
+    date_from: Optional[datetime.date] = Query(None, description="Từ ngày (YYYY-MM-DD)"),
+    date_to: Optional[datetime.date] = Query(None, description="Đến ngày (YYYY-MM-DD)"),
+    category_id: Optional[int] = Query(None),
+    supplier: Optional[str] = Query(None, description="Lọc theo tên nhà cung cấp / cửa hàng (chứa chuỗi)"),
+    gzip: bool = False,
+):
+    """Export toàn bộ dòng sản phẩm kèm thông tin hóa đơn dạng CSV/NDJSON (stream, có thể nén gzip)"""
+    stmt = select(
+        InvoiceItemDB.id, InvoiceItemDB.invoice_id, InvoiceDB.invoice_number, InvoiceDB.date.label("invoice_date"),
+        InvoiceDB.merchant_name, InvoiceDB.supplier_name, InvoiceItemDB.category_id, InvoiceItemDB.name,
+        InvoiceItemDB.product_name, InvoiceItemDB.quantity, InvoiceItemDB.unit_price, InvoiceItemDB.price,
+    ).outerjoin(InvoiceDB, InvoiceItemDB.invoice_id == InvoiceDB.id)
+    if category_id is not None:
+        stmt = stmt.where(InvoiceItemDB.category_id == category_id)
+    if supplier:
+        stmt = stmt.where((InvoiceDB.supplier_name.contains(supplier)) | (InvoiceDB.merchant_name.contains(supplier)))
+    stmt = stmt.where(*invoice_date_conditions(date_from, date_to)).order_by(InvoiceItemDB.id)
+
+    # Tên danh mục lấy từ cache thay vì join thêm bảng
+    async with AsyncSessionLocal() as db:
+        categories = await db.run_sync(category_registry.snapshot)
+
+    def add_category_name(row) -> dict:
+        data = dict(row._mapping)
+        category = categories.get(data["category_id"])
+        data["category_name"] = category["name"] if category else None
+        return data
+
+    stream = _export_stream(stmt, EXPORT_ITEM_COLUMNS, format, gzip, row_mapper=add_category_name)
+    return _export_response("items", stream, format, gzip)
+
 @app.get("/statistics/by-category")
-def get_statistics_by_category(db: Session = Depends(get_db)):
-    """Thống kê tổng hợp theo danh mục"""
-    categories = db.query(ProductCategoryDB).order_by(ProductCategoryDB.id).all()
+async def get_statistics_by_category(
+    date_from: Optional[datetime.date] = Query(None, description="Từ ngày (YYYY-MM-DD)"),
+    date_to: Optional[datetime.date] = Query(None, description="Đến ngày (YYYY-MM-DD)"),
+    db: AsyncSession = Depends(get_db),
+):
+    """Thống kê tổng hợp theo danh mục (toàn bộ hoặc trong 1 khoảng ngày)"""
+    categories = await db.run_sync(category_registry.all)
+
+    # Có khoảng ngày: GROUP BY trên các invoice trong khoảng (range scan theo parsed_date)
+    # Không có: đọc từ bảng tổng hợp; chưa build (chưa có dòng "chưa phân loại") thì tính bằng GROUP BY
+    date_conditions = invoice_date_conditions(date_from, date_to)
+    if date_conditions:
+        stats = await db.run_sync(category_aggregates, date_conditions)
+    else:
+        summary = {row.category_id: (row.total_items, row.total_amount, row.invoice_count)
+                   for row in (await db.execute(select(CategoryStatsDB))).scalars()}
+        if UNCATEGORIZED_STATS_KEY in summary:
+            stats = {(None if key == UNCATEGORIZED_STATS_KEY else key): value for key, value in summary.items()}
+        else:
+            logger.warning("⚠️  Bảng category_statistics chưa được build, dùng GROUP BY (chạy rebuild_category_stats.py)")
+            stats = await db.run_sync(category_aggregates)
+
     result = []
-    
     for category in categories:
-        items = db.query(InvoiceItemDB).filter(
-            InvoiceItemDB.category_id == category.id
-        ).all()
-        
-        total_amount = sum(item.price if item.price else 0 for item in items)
-        invoice_count = len(set(item.invoice_id for item in items if item.invoice_id))
-        
+        total_items, total_amount, invoice_count = stats.get(category["id"], (0, 0, 0))
         result.append({
-            "category_id": category.id,
-            "category_name": category.name,
-            "total_items": len(items),
+            "category_id": category["id"],
+            "category_name": category["name"],
+            "total_items": total_items,
             "total_amount": total_amount,
             "invoice_count": invoice_count,
-            "average_per_item": total_amount / len(items) if items else 0
+            "average_per_item": total_amount / total_items if total_items else 0
         })
     
     # Thống kê chưa phân loại
-    uncategorized = db.query(InvoiceItemDB).filter(
-        InvoiceItemDB.category_id.is_(None)
-    ).all()
-    
-    if uncategorized:
-        uncategorized_total = sum(item.price if item.price else 0 for item in uncategorized)
-        uncategorized_invoices = len(set(item.invoice_id for item in uncategorized if item.invoice_id))
-        
+    uncategorized_items, uncategorized_total, uncategorized_invoices = stats.get(None, (0, 0, 0))
+    if uncategorized_items:
         result.append({
             "category_id": None,
-            "category_name": "Chưa phân loại",
-            "total_items": len(uncategorized),
+            "category_name": UNCATEGORIZED_NAME,
+            "total_items": uncategorized_items,
             "total_amount": uncategorized_total,
             "invoice_count": uncategorized_invoices,
-            "average_per_item": uncategorized_total / len(uncategorized) if uncategorized else 0
+            "average_per_item": uncategorized_total / uncategorized_items
         })
     
-    return result
+    return FastJSONResponse(result)
 
 if __name__ == "__main__":
     import uvicorn
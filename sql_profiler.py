@@ -0,0 +1,58 @@
+"""
+Profile SQL theo từng request: đếm query, tổng thời gian DB, phát hiện N+1 (cùng 1 dạng câu SELECT lặp lại nhiều lần)
+Profile hiện tại nằm trong ContextVar: engine event (chạy trong task / greenlet của request) ghi vào đúng request
+Server gắn tóm tắt vào header X-SQL-Profile; test dùng assert_query_budget(response, n) để giữ ngân sách query
+"""
+import re
+import contextvars
+from collections import Counter
+from typing import Optional
+
+PROFILE_HEADER = "X-SQL-Profile"
+# Danh sách placeholder trong IN (...) / VALUES nhiều dòng có độ dài thay đổi theo dữ liệu: gộp lại thành 1 dạng
+PLACEHOLDER_LIST_RE = re.compile(r"(?:\?|%s|%\(\w+\)s|:\w+)(?:\s*,\s*(?:\?|%s|%\(\w+\)s|:\w+))+")
+WHITESPACE_RE = re.compile(r"\s+")
+PROFILE_FIELD_RE = re.compile(r"(\w+)=([\d.]+)")
+
+current_sql_profile: contextvars.ContextVar = contextvars.ContextVar("current_sql_profile", default=None)
+
+
+def statement_shape(statement: str) -> str:
+    """Chuẩn hóa câu SQL để so sánh: bỏ khoảng trắng thừa, gộp danh sách placeholder"""
+    return PLACEHOLDER_LIST_RE.sub("?*", WHITESPACE_RE.sub(" ", statement).strip())
+
+
+class SqlProfile:
+    """Số liệu SQL của 1 request"""
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.shapes: Counter = Counter()  # Chỉ đếm SELECT: INSERT lặp lại theo chunk là bình thường
+
+    def record(self, statement: str, elapsed: float):
+        self.queries += 1
+        self.db_time += elapsed
+        if statement.lstrip()[:6].upper() == "SELECT":
+            self.shapes[statement_shape(statement)] += 1
+
+    def repeated(self, threshold: int) -> list:
+        """Các dạng SELECT chạy >= threshold lần trong request: nghi N+1 (lazy load trong vòng lặp)"""
+        return [(shape, count) for shape, count in self.shapes.most_common() if count >= threshold]
+
+    def header_value(self, threshold: int) -> str:
+        return f"queries={self.queries}; db_ms={self.db_time * 1000:.2f}; n_plus_one={len(self.repeated(threshold))}"
+
+
+def parse_profile_header(value: Optional[str]) -> dict:
+    """'queries=3; db_ms=1.20; n_plus_one=0' -> {"queries": 3.0, "db_ms": 1.2, "n_plus_one": 0.0}"""
+    return {key: float(number) for key, number in PROFILE_FIELD_RE.findall(value or "")}
+
+
+def assert_query_budget(response, max_queries: int, allow_n_plus_one: bool = False):
+    """Dùng trong test: response phải có header profile (SQL_PROFILE_ENABLED=true) và không vượt ngân sách query"""
+    header = response.headers.get(PROFILE_HEADER)
+    assert header, f"Thiếu header {PROFILE_HEADER}: bật SQL_PROFILE_ENABLED=true"
+    profile = parse_profile_header(header)
+    assert profile["queries"] <= max_queries, f"{profile['queries']:.0f} query > ngân sách {max_queries} ({header})"
+    assert allow_n_plus_one or not profile["n_plus_one"], f"Có dấu hiệu N+1 ({header})"
@@ -0,0 +1,41 @@
+"""
+Cấu hình chung cho test: server.py đọc cấu hình lúc import nên env phải được đặt trước lần import đầu tiên
+DB là SQLite tạm (1 file cho cả phiên test), OCR dùng backend stub, profile SQL bật để test kiểm tra ngân sách query
+"""
+import os
+import sys
+import random
+import tempfile
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+_tmp = tempfile.TemporaryDirectory()
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_tmp.name, 'test.db')}"
+os.environ.pop("ASYNC_DATABASE_URL", None)
+os.environ.update({"OCR_BACKEND": "stub", "OCR_HEDGE_BACKEND": "", "OCR_CACHE_DIR": "", "OCR_MAX_CONCURRENCY": "4",
+                   "SEARCH_INDEX_ENABLED": "false", "SQL_PROFILE_ENABLED": "true"})
+
+import server  # noqa: E402
+
+SEED = {"invoices": 300, "items_per_invoice": 3, "categories": 20}
+
+
+@pytest.fixture(scope="session")
+def seeded_server():
+    """server với DB đã seed (benchmark_endpoints.seed) và cache danh mục đã nạp"""
+    from benchmark_endpoints import seed
+    seed(server, SEED, random.Random(42))
+    with server.SessionLocal() as db:
+        server.category_registry.snapshot(db)
+    yield server
+    server.engine.dispose()
+
+
+@pytest.fixture(scope="session")
+def client(seeded_server):
+    from fastapi.testclient import TestClient
+    with TestClient(seeded_server.app) as test_client:
+        yield test_client
@@ -0,0 +1,59 @@
+"""
+Kiểm tra InvoiceParserService (invoice_parser) trên các dòng OCR mẫu: tách tên / số lượng / đơn giá / thành tiền,
+bỏ qua dòng tổng tiền, thuế, số điện thoại; parse_many giữ đúng thứ tự và cho cùng kết quả với parse
+"""
+import pytest
+
+from invoice_parser import InvoiceParserService
+
+# Dòng OCR -> (tên, số lượng, đơn giá, thành tiền) mong đợi; None = không phải dòng sản phẩm
+CASES = [
+    ("Com tam 35.000", ("Com tam", 1, 35000, 35000)),
+    ("Pho bo 45.000", ("Pho bo", 1, 45000, 45000)),
+    ("Coca 12.000", ("Coca", 1, 12000, 12000)),
+    ("Bánh mì 20.000đ", ("Bánh mì", 1, 20000, 20000)),
+    ("Giấy A4 .... 500,000đ", ("Giấy A4", 1, 500000, 500000)),
+    ("Sữa tươi 2 x 32.000 64.000", ("Sữa tươi", 2, 32000, 64000)),
+    ("Nước suối 3 5.000 15.000", ("Nước suối", 3, 5000, 15000)),
+    ("Giay A4 70g 2 x 50.000 100.000", ("Giay A4 70g", 2, 50000, 100000)),
+    ("Bút bi x3 15.000", ("Bút bi", 3, 5000, 15000)),
+    ("Thue kho 50.000", ("Thue kho", 1, 50000, 50000)),
+    ("Cash thu ho 40.000", ("Cash thu ho", 1, 40000, 40000)),
+    ("Thuế VAT 10%: 8.500", None),
+    ("Tổng cộng: 85.000đ", None),
+    ("Cash: 100.000", None),
+    ("Change 15.000", None),
+    ("ĐT: 0283 822 1234", None),
+    ("0909 123 456", None),
+]
+
+
+@pytest.mark.parametrize("line, expected", CASES)
+def test_parse_line(line, expected):
+    items = InvoiceParserService.parse("HEADER\n" + line)["items"]
+    got = (items[0]["name"], items[0]["quantity"], items[0]["unit_price"], items[0]["price"]) if items else None
+    assert got == expected
+
+
+@pytest.mark.parametrize("newline", ["\n", "\r\n", "\r"])
+def test_parse_document(newline):
+    text = newline.join(["SIÊU THỊ MINH ANH", "ĐT: 0283 822 1234", "Ngày: 05/03/2024",
+                         "Sữa tươi 2 x 32.000 64.000", "Coca 12.000", "Tổng cộng: 76.000đ", "Cảm ơn quý khách!"])
+    result = InvoiceParserService.parse(text)
+    assert result["merchant_name"] == "SIÊU THỊ MINH ANH"
+    assert result["date"] == "05/03/2024"
+    assert [item["name"] for item in result["items"]] == ["Sữa tươi", "Coca"]
+    assert result["total_amount"] == 76000
+    assert result["raw_text"] == text
+
+
+def test_total_falls_back_to_printed_total():
+    result = InvoiceParserService.parse("SHOP\nTổng cộng: 85.000đ")
+    assert result["items"] == []
+    assert result["total_amount"] == 85000
+
+
+def test_parse_many_matches_parse():
+    texts = [f"SHOP {i}\nCom tam {i + 1}.000" for i in range(300)]
+    expected = [InvoiceParserService.parse(text) for text in texts]
+    assert InvoiceParserService.parse_many(texts, processes=2, chunksize=16) == expected
@@ -0,0 +1,100 @@
+"""
+Kiểm tra AsyncOCRClient (ocr_client) với 1 OCR endpoint giả chạy local (asyncio server, HTTP/1.1 keep-alive):
+- Bắn nhiều request hơn OCR_MAX_CONCURRENCY: số request đang xử lý cùng lúc ở server đạt đúng giới hạn, không vượt
+- Client httpx được dùng lại giữa các lần gọi, kết nối keep-alive không mở lại cho mỗi request
+Chạy: python -m pytest tests
+"""
+import asyncio
+
+import server  # Env (DB tạm, OCR_MAX_CONCURRENCY) đặt trong conftest.py trước khi import
+
+RESPONSE_BODY = b'{"ParsedResults": [{"ParsedText": "HOA DON"}], "IsErroredOnProcessing": false}'
+
+
+class FakeOCRServer:
+    """OCR endpoint giả: mỗi request giữ delay giây rồi trả JSON; đếm số request đang xử lý và số kết nối TCP"""
+
+    def __init__(self, delay: float = 0.05):
+        self.delay = delay
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.requests = 0
+        self.connections = 0
+        self._server = None
+
+    async def __aenter__(self):
+        self._server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        return self
+
+    async def __aexit__(self, *exc):
+        self._server.close()
+        await self._server.wait_closed()
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.sockets[0].getsockname()[:2]
+        return f"http://{host}:{port}/parse/image"
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                length = next((int(line.split(b":", 1)[1]) for line in head.split(b"\r\n")
+                               if line.lower().startswith(b"content-length:")), 0)
+                await reader.readexactly(length)
+                self.requests += 1
+                self.in_flight += 1
+                self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+                await asyncio.sleep(self.delay)
+                self.in_flight -= 1
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                             b"Content-Length: " + str(len(RESPONSE_BODY)).encode() + b"\r\n\r\n" + RESPONSE_BODY)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+async def _post(url: str):
+    response = await server.ocr_client.post(url, data={"language": "vnm"}, files={"file": ("invoice.jpg", b"\xff\xd8\xff" + b"0" * 512)})
+    response.raise_for_status()
+    return response.json()
+
+
+def test_peak_in_flight_equals_max_concurrency():
+    limit = server.ocr_client.max_concurrency
+    assert limit == server.OCR_MAX_CONCURRENCY
+
+    async def run():
+        async with FakeOCRServer() as fake:
+            try:
+                results = await asyncio.gather(*(_post(fake.url) for _ in range(limit * 3)))
+            finally:
+                await server.ocr_client.aclose()
+            return fake, results
+
+    fake, results = asyncio.run(run())
+    assert len(results) == limit * 3 and all(r["ParsedResults"] for r in results)
+    assert fake.requests == limit * 3
+    assert fake.peak_in_flight == limit
+    assert fake.connections <= max(limit, server.ocr_client.pool_size)
+
+
+def test_client_reused_across_calls():
+    async def run():
+        async with FakeOCRServer(delay=0) as fake:
+            try:
+                await _post(fake.url)
+                client = server.ocr_client._get_client()
+                for _ in range(5):
+                    await _post(fake.url)
+                    assert server.ocr_client._get_client() is client
+            finally:
+                await server.ocr_client.aclose()
+            return fake
+
+    fake = asyncio.run(run())
+    assert fake.requests == 6
+    assert fake.connections == 1  # Gọi tuần tự: 1 kết nối keep-alive dùng cho cả 6 request
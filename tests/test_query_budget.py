@@ -0,0 +1,62 @@
+"""
+Ngân sách query SQL của các endpoint đọc chính (header X-SQL-Profile + sql_profiler.assert_query_budget):
+số query mỗi request cố định, không tăng theo số hóa đơn / item trong trang, không có N+1
+Response cache bị bump trước mỗi request: lần MISS gom đủ body (kể cả StreamingResponse) trước khi gửi header,
+nên header tính cả các query chạy trong lúc stream
+"""
+import pytest
+
+from sql_profiler import PROFILE_HEADER, assert_query_budget, parse_profile_header
+
+
+@pytest.fixture
+def get(client, seeded_server):
+    def _get(path: str, **params):
+        seeded_server.response_cache.bump()
+        response = client.get(path, params=params)
+        assert response.status_code == 200, response.text
+        return response
+    return _get
+
+
+def queries(response) -> int:
+    return int(parse_profile_header(response.headers[PROFILE_HEADER])["queries"])
+
+
+# (fields, ngân sách): 1 query trang hóa đơn + 1 query selectin cho items + 1 cho raw_text
+@pytest.mark.parametrize("fields,budget", [(None, 2), ("id,merchant_name,total_amount", 1), ("id,merchant_name,items,raw_text", 3)])
+def test_invoices_constant_queries_per_page(get, fields, budget):
+    params = {"fields": fields} if fields else {}
+    small, large = get("/invoices", limit=5, **params), get("/invoices", limit=200, **params)
+    assert len(large.json()) == 200
+    assert_query_budget(large, budget)
+    assert queries(small) == queries(large)
+
+
+def test_invoices_next_page_same_budget(get):
+    first = get("/invoices", limit=50)
+    second = get("/invoices", limit=50, cursor=first.headers["X-Next-Cursor"])
+    assert max(i["id"] for i in second.json()) < min(i["id"] for i in first.json())
+    assert queries(second) == queries(first)
+    assert_query_budget(second, 2)
+
+
+def test_invoices_date_range_budget(get):
+    assert_query_budget(get("/invoices", limit=100, date_from="2024-03-01", date_to="2024-06-30"), 2)
+
+
+def test_products_by_category_budget(get):
+    small, large = get("/products/by-category", items_limit=1), get("/products/by-category")
+    groups = large.json()
+    assert sum(len(group["items"]) for group in groups) == sum(group["total_items"] for group in groups) > 0
+    assert_query_budget(large, 2)
+    assert queries(small) == queries(large)
+
+
+def test_products_by_single_category_budget(get):
+    assert_query_budget(get("/products/by-category/1"), 2)
+
+
+@pytest.mark.parametrize("params", [{}, {"date_from": "2024-01-01", "date_to": "2024-12-31"}])
+def test_statistics_by_category_budget(get, params):
+    assert_query_budget(get("/statistics/by-category", **params), 1)